@@ -2,6 +2,8 @@ import os
 from houseagent.utils.config import Config
 from houseagent import config_file
 from houseagent.core.coordinator import Coordinator
+from houseagent.core.filters import ValueFilter
+from houseagent.core.journal import Journal
 from houseagent.core.events import EventHandler
 from houseagent.core.history import HistoryCollector, HistoryAggregator
 from houseagent.core.web import Web
@@ -26,9 +28,30 @@ class MainWrapper():
             database = Database(self.log, config.general.dbfile)
         
         self.log.debug("Starting HouseAgent coordinator...")
-        coordinator = Coordinator(self.log, database)
+        journal = None
+        if config.journal.enabled:
+            journal_path = config.journal.path or os.path.join(os.path.dirname(config.general.dbfile), 'journal')
+            journal = Journal(self.log, journal_path, config.journal.segment_size * 1024 * 1024, 
+                              retain=config.journal.retain, sync=config.journal.sync)
+        
+        value_filter = ValueFilter(self.log, config.filter.enabled, config.filter.deadband, config.filter.deadband_type,
+                                   config.filter.max_silence)
+        coordinator = Coordinator(self.log, database, config.ingestion.interval, config.ingestion.batch_size,
+                                  config.zmq.heartbeat_interval, config.zmq.heartbeat_misses,
+                                  config.general.tracesample, value_filter, journal)
 
-        coordinator.init_broker(config.zmq.broker_host, config.zmq.broker_port)
+        coordinator.init_broker(config.zmq.broker_host, config.zmq.broker_port, config.zmq.rpc_timeout,
+                                config.zmq.crud_port, config.zmq.endpoints)
+        
+        if config.workers.count and config.embedded.enabled:
+            self.log.warning("Worker processes are not supported in embedded mode, value updates are handled in the main process")
+        elif config.workers.count:
+            if journal:
+                self.log.warning("The journal is not supported with worker processes, value updates handled by workers are not journaled")
+            if config.filter.enabled:
+                self.log.warning("The value filter is not supported with worker processes, value updates handled by workers are not filtered")
+            coordinator.init_workers(config.workers.count, config.general.dbfile, config.workers.port,
+                                     config.ingestion.interval, config.ingestion.batch_size)
         
         self.log.debug("Starting HouseAgent event handler...")
         event_handler = EventHandler(self.log, coordinator, database)
@@ -0,0 +1,288 @@
+'''
+Admission control for value updates sent by plugins.
+
+Each plugin can have a token-bucket limit on the number of value update
+messages it sends. Messages over the limit are handled according to the
+policy of the plugin:
+
+drop      the message is thrown away
+coalesce  the update is kept, a newer update of the same device replaces it,
+          updates are released as soon as the bucket allows
+delay     the message is queued and handled as soon as the bucket allows
+'''
+import time
+from collections import deque
+from twisted.internet import reactor
+from houseagent.utils.encoding import decode_value_update, decode_value_updates
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+POLICIES = ('drop', 'coalesce', 'delay')
+
+class TokenBucket(object):
+    '''
+    A token bucket, tokens are added at a fixed rate up to the burst size.
+    '''
+
+    def __init__(self, rate, burst, now=None):
+        '''
+        Initialize a new TokenBucket instance, the bucket starts full.
+        @param rate: the number of tokens added per second
+        @param burst: the maximum number of tokens in the bucket
+        @param now: the current time, defaults to time.time()
+        '''
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.stamp = time.time() if now is None else now
+
+    def _refill(self, now):
+        if now is None:
+            now = time.time()
+
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, tokens=1, now=None):
+        '''
+        Take tokens from the bucket.
+        @param tokens: the number of tokens to take
+        @param now: the current time, defaults to time.time()
+
+        @return: True when there were enough tokens, False otherwise
+        '''
+        self._refill(now)
+
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+
+        return False
+
+    def wait(self, tokens=1, now=None):
+        '''
+        Returns the number of seconds until there are enough tokens in the bucket.
+        @param tokens: the number of tokens needed
+        @param now: the current time, defaults to time.time()
+        '''
+        self._refill(now)
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+class PluginLimiter(object):
+    '''
+    The limit and the held back messages of one plugin.
+    '''
+
+    def __init__(self, admission, rate, burst, policy):
+        self.admission = admission
+        self.bucket = TokenBucket(rate, burst)
+        self.policy = policy
+        self.plugin = None
+
+        # Held back messages, (type, payload) for delay and address -> (values, time, seq) for coalesce
+        self.queue = deque()
+        self.pending = OrderedDict()
+        self._release_call = None
+
+        # The highest sequence number of the coalesced messages, for plugins that use acknowledged delivery
+        self.max_seq = None
+
+        self.admitted = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.coalesced = 0
+
+    def admit(self, plugin, type, payload):
+        '''
+        Returns True when a message can be handled right away, otherwise the policy of the plugin is applied.
+        '''
+        self.plugin = plugin
+
+        # Once messages are held back newer messages have to wait their turn
+        if not self.queue and not self.pending and self.bucket.consume():
+            self.admitted += 1
+            return True
+
+        if self.policy == 'delay':
+            if len(self.queue) >= self.admission.max_queue:
+                self.dropped += 1
+                return False
+
+            self.queue.append((type, payload))
+            self.delayed += 1
+
+        elif self.policy == 'coalesce':
+            encoding = payload[1] if len(payload) > 1 else 'json'
+            seq = int(payload[2]) if len(payload) > 2 else None
+            if seq is not None:
+                self.max_seq = max(self.max_seq, seq)
+
+            if type == '\x08':
+                updates = decode_value_updates(encoding, payload[0])
+            else:
+                updates = [decode_value_update(encoding, payload[0])]
+
+            for address, values, timestamp in updates:
+                held_seq = seq
+                if address in self.pending:
+                    self.coalesced += 1
+                    merged = dict(self.pending[address][0])
+                    merged.update(values)
+                    values = merged
+                    # The held entry still carries the data of the oldest message
+                    held_seq = self.pending[address][2]
+
+                self.pending[address] = (values, timestamp, held_seq)
+
+        else:
+            self.dropped += 1
+            return False
+
+        self._schedule()
+        return False
+
+    def _schedule(self):
+        if self._release_call is None and (self.queue or self.pending):
+            self._release_call = reactor.callLater(self.bucket.wait(), self._release)
+
+    def _release(self):
+        '''
+        Hand held back messages to the coordinator for as far as the bucket allows.
+        '''
+        self._release_call = None
+
+        while (self.queue or self.pending) and self.bucket.consume():
+            self.admitted += 1
+            if self.queue:
+                type, payload = self.queue.popleft()
+                self.admission.release(self.plugin, type, payload)
+            else:
+                address = next(iter(self.pending))
+                values, timestamp, seq = self.pending.pop(address)
+                self.admission.release_updates(self.plugin, [(address, values, timestamp)], self._released_seq())
+
+        self._schedule()
+
+    def flush(self):
+        '''
+        Stop limiting, hand all held back messages to the coordinator.
+        '''
+        if self._release_call is not None:
+            self._release_call.cancel()
+            self._release_call = None
+
+        while self.queue:
+            type, payload = self.queue.popleft()
+            self.admission.release(self.plugin, type, payload)
+
+        if self.pending:
+            updates = [(address, values, timestamp) for address, (values, timestamp, seq) in self.pending.iteritems()]
+            self.pending.clear()
+            self.admission.release_updates(self.plugin, updates, self._released_seq())
+
+    def _released_seq(self):
+        '''
+        Returns the highest sequence number up to which all coalesced messages have been released,
+        or None when the messages have no sequence numbers.
+        '''
+        held = [seq for values, timestamp, seq in self.pending.itervalues() if seq is not None]
+        if held:
+            return min(held) - 1
+
+        seq, self.max_seq = self.max_seq, None
+        return seq
+
+    def stats(self):
+        return {'rate': self.bucket.rate,
+                'burst': self.bucket.burst,
+                'policy': self.policy,
+                'admitted': self.admitted,
+                'dropped': self.dropped,
+                'delayed': self.delayed,
+                'coalesced': self.coalesced,
+                'held': len(self.queue) + len(self.pending)}
+
+class AdmissionControl(object):
+    '''
+    This class applies the rate limits of plugins to their value update messages.
+    '''
+
+    def __init__(self, log, release, release_updates, max_queue=1000):
+        '''
+        Initialize a new AdmissionControl instance.
+        @param log: a reference to the HouseAgent logger
+        @param release: function called as release(plugin, type, payload) to handle a delayed message
+        @param release_updates: function called as release_updates(plugin, updates, seq) to handle coalesced updates,
+                                updates is a list of (address, values, time) tuples and seq the highest
+                                sequence number released completely, or None
+        @param max_queue: the maximum number of delayed messages per plugin, messages beyond are dropped
+        '''
+        self.log = log
+        self.release = release
+        self.release_updates = release_updates
+        self.max_queue = max_queue
+        self._limiters = {}
+
+    def set_limits(self, limits):
+        '''
+        Set the limits of all plugins, plugins without a limit are no longer limited.
+        Counters of plugins whose limit did not change are kept.
+        @param limits: a list of (plugin_id, rate, burst, policy) tuples
+        '''
+        limiters = {}
+
+        for plugin_id, rate, burst, policy in limits:
+            if rate <= 0 or burst < 1:
+                self.log.warning("Admission::Invalid limit of %r/s with burst %r for plugin %s, not limiting",
+                                 rate, burst, plugin_id)
+                continue
+
+            if policy not in POLICIES:
+                self.log.warning("Admission::Unknown policy %r for plugin %s, using drop", policy, plugin_id)
+                policy = 'drop'
+
+            limiter = self._limiters.pop(plugin_id, None)
+            if limiter is None or (limiter.bucket.rate, limiter.bucket.burst, limiter.policy) != (float(rate), max(1, burst), policy):
+                if limiter:
+                    limiter.flush()
+                limiter = PluginLimiter(self, rate, burst, policy)
+
+            limiters[plugin_id] = limiter
+
+        # Limits that have been removed
+        for limiter in self._limiters.itervalues():
+            limiter.flush()
+
+        self._limiters = limiters
+
+    def admit(self, plugin, type, payload):
+        '''
+        Check whether a value update message of a plugin can be handled now.
+        @param plugin: the Plugin that sent the message
+        @param type: the message type
+        @param payload: the payload of the message
+
+        @return: True when the message has to be handled now, False when it has been dropped or held back
+        '''
+        limiter = self._limiters.get(plugin.id)
+        if limiter is None:
+            return True
+
+        return limiter.admit(plugin, type, payload)
+
+    def policy(self, plugin):
+        '''
+        Returns the policy of a plugin, or None when the plugin is not limited.
+        @param plugin: the Plugin
+        '''
+        limiter = self._limiters.get(plugin.id)
+        return limiter.policy if limiter else None
+
+    def stats(self):
+        '''
+        Returns a dictionary with the counters of all limited plugins.
+        '''
+        return dict((plugin_id, limiter.stats()) for plugin_id, limiter in self._limiters.iteritems())
@@ -0,0 +1,100 @@
+'''
+Latest-wins coalescing of outgoing commands.
+
+A dim slider or a setpoint control easily fires a burst of commands at the
+same device, while a slow RF bus handles them one by one. The
+CommandCoalescer keeps at most one command per key in flight and only the
+newest of the commands that arrive in the meantime: when the in-flight
+command is done that one is sent, the ones it replaced are never sent.
+Callers of replaced commands get the result of the command that replaced them.
+'''
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+class _Slot(object):
+    '''
+    The in-flight command and the queued command of a key.
+    '''
+
+    def __init__(self):
+        self.waiting = []
+        self.queued = None
+        self.queued_waiting = []
+
+class CommandCoalescer(object):
+    '''
+    This class sends commands, coalescing commands with the same key.
+    '''
+
+    def __init__(self, send):
+        '''
+        Initialize a new CommandCoalescer instance.
+        @param send: function called as send(plugin_guid, content) to send a command, returns a deferred
+        '''
+        self.send = send
+        self._slots = {}
+
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+
+    def submit(self, key, plugin_guid, content):
+        '''
+        Send a command, or queue it when a command with the same key is in flight.
+        A queued command replaces the command queued before it.
+        @param key: the key of the command, for example (plugin guid, address, value id)
+        @param plugin_guid: the guid of the plugin
+        @param content: the content of the command
+
+        @return: a Twisted deferred which will callback with the result of the command,
+                 or with the result of the command that replaced it
+        '''
+        self.submitted += 1
+        d = defer.Deferred()
+
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot()
+            slot.waiting.append(d)
+            self._send(key, slot, plugin_guid, content)
+        else:
+            if slot.queued is not None:
+                self.coalesced += 1
+
+            slot.queued = (plugin_guid, content)
+            slot.queued_waiting.append(d)
+
+        return d
+
+    def _send(self, key, slot, plugin_guid, content):
+        self.sent += 1
+        d = self.send(plugin_guid, content)
+        d.addBoth(self._done, key, slot)
+
+    def _done(self, result, key, slot):
+        '''
+        Called when the in-flight command of a key is done, sends the queued command if any.
+        '''
+        waiting, slot.waiting = slot.waiting, []
+
+        if slot.queued is None:
+            del self._slots[key]
+        else:
+            plugin_guid, content = slot.queued
+            slot.waiting, slot.queued, slot.queued_waiting = slot.queued_waiting, None, []
+            self._send(key, slot, plugin_guid, content)
+
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def stats(self):
+        '''
+        Returns a dictionary with command statistics.
+        '''
+        return {'submitted': self.submitted,
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._slots)}
@@ -1,10 +1,22 @@
 import json
 import time
+from collections import deque
 from txzmq import ZmqFactory, ZmqEndpoint, ZmqEndpointType, ZmqConnection
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import deferLater
 from twisted.internet import reactor, defer
 from zmq.core import constants
+from houseagent.core.ingestion import ValueIngester
+from houseagent.core.stats import BrokerStats, percentile
+from houseagent.core.liveness import LivenessMonitor
+from houseagent.core.trace import Tracer
+from houseagent.core.workers import WorkerPool
+from houseagent.core.admission import AdmissionControl
+from houseagent.core.filters import ValueFilter
+from houseagent.core.commands import CommandCoalescer
+from houseagent.utils.error import RPCTimeoutError, PluginOfflineError, UnsupportedCommandError, PluginNotFoundError
+from houseagent.utils.transport import crud_endpoint
+from houseagent.utils.encoding import select_encoding, decode_value_update, decode_value_updates, encode_value_updates
 
 class Broker(ZmqConnection):
     '''
@@ -25,6 +37,17 @@ class Broker(ZmqConnection):
         self.coordinator = coordinator
         self.message_id = 0
         self.requests = {}
+        self.rpc_timeout = 30
+        
+        # RPC statistics
+        self.rpc_sent = 0
+        self.rpc_replies = 0
+        self.rpc_timeouts = 0
+        self.rpc_cancelled = 0
+        self.rpc_latencies = deque(maxlen=1000)
+        
+        # Message statistics
+        self.stats = BrokerStats()
     
     def messageReceived(self, msg):
         '''
@@ -33,37 +56,73 @@ class Broker(ZmqConnection):
         
         @return: Nothing
         '''
-        self.coordinator.log.debug("Coordinator::Raw ZMQ message received: %r" % (msg))
+        tracer = self.coordinator.tracer
+        cid = tracer.begin()
         
-        routing_info = msg[0]
-        type = msg[2]
-        payload = msg[3:]
-
-        if type == '\x05':
-            # Handle RPC replies within this broker class.
-            self.handle_rpc_reply(payload)
-        else:
-            try:
-                fnc = self.coordinator.plugin_cmds[type]
+        # Whatever happens, traces of the next message must not end up with this one
+        try:
+            tracer.trace(cid, "Coordinator::Raw ZMQ message received: %r", msg)
+            
+            routing_info = msg[0]
+            type = msg[2]
+            payload = msg[3:]
+            
+            plugin = self.coordinator.plugins.by_routing(routing_info)
+            self.stats.message_in(type, plugin and plugin.guid, sum(len(part) for part in msg))
+            start = time.time()
+            
+            # Every message is a sign of life, plugins only send heartbeats when they have nothing else to say
+            if plugin and plugin.online:
+                self.coordinator.plugin_seen(plugin, start)
+    
+            if type == '\x05':
+                # Handle RPC replies within this broker class.
+                self.handle_rpc_reply(payload)
+            else:
+                fnc = self.coordinator.plugin_cmds.get(type)
+                if not fnc:
+                    self.stats.unhandled += 1
+                    self.coordinator.log.error("Coordinator::Unhandled network response received: %r", msg)
+                    return
+                
                 fnc(routing_info, payload)
-            except KeyError:
-                self.coordinator.log.error("Coordinator::Unhandled network response received: %r" % (msg))
+            
+            self.stats.handled(type, time.time() - start)
+        finally:
+            tracer.current = None
+    
+    def send(self, message):
+        '''
+        Send a message to a plugin, the first part of the message is the routing information of the plugin.
+        @param message: a list of message parts
+        '''
+        plugin = self.coordinator.plugins.by_routing(message[0])
+        self.stats.message_out(plugin and plugin.guid, sum(len(part) for part in message))
+        ZmqConnection.send(self, message)
     
-    def send_rpc(self, routing_info, message):       
+    def send_rpc(self, routing_info, message, timeout=None):       
         '''
         This function sends a RPC message to a specified plugin.
         @param routing_info: the routing information of the plugin
         @param message: the message to send
+        @param timeout: seconds to wait for a reply, defaults to the broker rpc_timeout
         
-        @return a Twisted deferred.
+        @return a Twisted deferred. It errbacks with RPCTimeoutError when the plugin doesn't reply in time,
+                and with PluginOfflineError when the plugin goes offline before replying.
         '''
-        d = defer.Deferred()
         message_id = self.get_next_id()
-        self.requests[message_id] = d
+        d = defer.Deferred(lambda d: self._cancel_rpc(message_id))
+        
+        if timeout is None:
+            timeout = self.rpc_timeout
+        timeout_call = reactor.callLater(timeout, self._rpc_timed_out, message_id)
+        
+        self.requests[message_id] = RPCRequest(d, routing_info, time.time(), timeout_call)
         message = [routing_info, b'', chr(4), message_id, json.dumps(message)]
 
-        self.coordinator.log.debug("Coordinator::Sending RPC message:%r" % (message))
+        self.coordinator.log.debug("Coordinator::Sending RPC message: %r", message)
         self.send(message)
+        self.rpc_sent += 1
         
         return d
     
@@ -74,12 +133,57 @@ class Broker(ZmqConnection):
         
         @return: nothing
         '''
-        self.coordinator.log.debug("Coordinator::Received RPC reply: %r" % (payload))
+        self.coordinator.tracer.trace(self.coordinator.tracer.current, "Coordinator::Received RPC reply: %r", payload)
         message_id = payload[0]
         payload = payload[1]
         
-        d = self.requests.pop(message_id)
-        d.callback(json.loads(payload))
+        request = self.requests.pop(message_id, None)
+        if not request:
+            self.coordinator.log.warning("Coordinator::Received reply for unknown or expired RPC request %s", message_id)
+            return
+        
+        request.timeout_call.cancel()
+        self.rpc_replies += 1
+        self.rpc_latencies.append(time.time() - request.sent)
+        request.deferred.callback(json.loads(payload))
+    
+    def _rpc_timed_out(self, message_id):
+        '''
+        Called when a plugin did not reply to a RPC request in time.
+        @param message_id: the id of the RPC request
+        '''
+        request = self.requests.pop(message_id, None)
+        if request:
+            self.coordinator.log.warning("Coordinator::RPC request %s timed out", message_id)
+            self.rpc_timeouts += 1
+            request.deferred.errback(RPCTimeoutError(message_id))
+    
+    def _cancel_rpc(self, message_id):
+        '''
+        Canceller of the RPC deferred, forgets about the request.
+        @param message_id: the id of the RPC request
+        '''
+        request = self.requests.pop(message_id, None)
+        if request:
+            request.timeout_call.cancel()
+            self.rpc_cancelled += 1
+    
+    def cancel_rpcs(self, routing_info):
+        '''
+        Fail all outstanding RPC requests sent to a plugin, for example because the plugin went offline.
+        @param routing_info: the routing information of the plugin
+        
+        @return: the number of requests failed
+        '''
+        cancelled = [message_id for message_id, request in self.requests.iteritems() if request.routing_info == routing_info]
+        
+        for message_id in cancelled:
+            request = self.requests.pop(message_id)
+            request.timeout_call.cancel()
+            self.rpc_cancelled += 1
+            request.deferred.errback(PluginOfflineError(message_id))
+        
+        return len(cancelled)
     
     def get_next_id(self):
         '''
@@ -87,71 +191,220 @@ class Broker(ZmqConnection):
         
         @return: a unique message ID
         '''
-        return 'msg_id_%d' % (self.message_id + 1,)
+        self.message_id += 1
+        return 'msg_id_%d' % (self.message_id,)
+    
+    def rpc_stats(self):
+        '''
+        Returns a dictionary with RPC statistics, reply latencies are in seconds.
+        '''
+        latencies = sorted(self.rpc_latencies)
+        
+        return {'in_flight': len(self.requests),
+                'sent': self.rpc_sent,
+                'replies': self.rpc_replies,
+                'timeouts': self.rpc_timeouts,
+                'cancelled': self.rpc_cancelled,
+                'latency_p50': percentile(latencies, 50),
+                'latency_p90': percentile(latencies, 90),
+                'latency_p99': percentile(latencies, 99)}
+
+class CrudPublisher(ZmqConnection):
+    '''
+    Publishes CRUD notifications to all plugins that subscribed to them.
+    Every notification is a two part message, the CRUD type is the first part so that
+    plugins can subscribe to the types they are interested in.
+    '''
+    socketType = constants.PUB
+
+    def publish(self, type, content):
+        '''
+        Publish a CRUD notification.
+        @param type: the CRUD type, used as topic
+        @param content: the encoded notification
+        '''
+        self.send([str(type), content])
+
+class RPCRequest(object):
+    '''
+    Skeleton class for an outstanding RPC request.
+    '''
+    
+    def __init__(self, deferred, routing_info, sent, timeout_call):
+        '''
+        @param deferred: the deferred handed to the caller
+        @param routing_info: the routing information of the plugin the request was sent to
+        @param sent: the time at which the request was sent
+        @param timeout_call: the delayed call that fires on timeout
+        '''
+        self.deferred = deferred
+        self.routing_info = routing_info
+        self.sent = sent
+        self.timeout_call = timeout_call
 
 class Coordinator(object):
     '''
     This class represents the network coordinator for HouseAgent.
     '''
     
-    def __init__(self, log, database):
+    def __init__(self, log, database, ingest_interval=0.5, ingest_batch_size=500, 
+                 heartbeat_interval=30, heartbeat_misses=3, trace_sample=1, value_filter=None, journal=None):
         '''
         Initialize the Coordinator
         @param log: a reference to the HouseAgent logger
         @param database: an instance of the HouseAgent database
+        @param ingest_interval: the maximum time in seconds a value update is queued before it is written to the database
+        @param ingest_batch_size: the number of queued values that triggers an immediate database write
+        @param heartbeat_interval: the interval in seconds at which silent plugins send heartbeats, 
+                                   plugins can negotiate a longer interval
+        @param heartbeat_misses: the number of missed heartbeats after which a plugin is considered offline
+        @param trace_sample: with debug logging enabled, trace 1 in trace_sample received messages
+        @param value_filter: a ValueFilter to drop redundant value updates, by default only values with 
+                             their own filter settings are filtered
+        @param journal: a Journal to write value updates to before they are queued for the database
         
         @return: nothing
         '''
         self.factory = ZmqFactory()
         self.log = log
         self.db = database
-        self.plugins = []
+        self.plugins = PluginRegistry()
         self.crud_callbacks = []
         self.eventengine = None
+        self.crud_publisher = None
+        self.crud_port = None
+        self.workers = None
+        self.journal = journal
+        self.tracer = Tracer(log, trace_sample)
+        self.ingester = ValueIngester(log, database, self.value_committed, 
+                                      ingest_interval, ingest_batch_size, self.tracer, journal, self.send_acks)
+        self.value_filter = value_filter or ValueFilter(log)
+        self.commands = CommandCoalescer(self.send_command)
+        self.admission = AdmissionControl(log, self.release_value_update, self.release_value_updates)
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.liveness = LivenessMonitor(heartbeat_interval * heartbeat_misses, self.plugin_expired)
+        self.acks_sent = 0
+        self.duplicates = 0
         
         self.plugin_cmds = { '\x01': self.handle_plugin_ready,
                              '\x02': self.handle_plugin_heartbeat,
-                             '\x03': self.handle_plugin_value_update}
+                             '\x03': self.handle_plugin_value_update,
+                             '\x08': self.handle_plugin_value_update_many}
         
         # Startup actions
         self.load_plugins()
         self.db.coordinator = self
+        
+        # Updates that didn't make it to the database before HouseAgent stopped
+        if self.journal:
+            self.journal.recover(self._recover_updates)
     
-    def init_broker(self, host='*', port=13001):
+    def init_broker(self, host='*', port=13001, rpc_timeout=30, crud_port=None, endpoints=None):
         '''
         Initialize a new broker instance
         @param host: the hostname to listen on
         @param port: the port to listen on
+        @param rpc_timeout: seconds to wait for a plugin to reply to a command
+        @param crud_port: the port to publish CRUD notifications on, defaults to port + 1
+        @param endpoints: extra endpoints to listen on, for example ipc:///tmp/houseagent for plugins on this machine,
+                          or inproc://houseagent for plugins in this process that use our factory
         
         @return: nothing
         '''
-        self.broker = Broker(self.factory, self, ZmqEndpoint(ZmqEndpointType.bind, 'tcp://%s:%s' % (host, port)))
+        self.crud_port = crud_port or int(port) + 1
+        endpoints = ['tcp://%s:%s' % (host, port)] + list(endpoints or [])
+        
+        self.broker = Broker(self.factory, self, *[ZmqEndpoint(ZmqEndpointType.bind, endpoint) 
+                                                   for endpoint in endpoints])
+        self.broker.rpc_timeout = rpc_timeout
+        
+        self.crud_publisher = CrudPublisher(self.factory, *[ZmqEndpoint(ZmqEndpointType.bind, 
+                                                                        crud_endpoint(endpoint, self.crud_port))
+                                                            for endpoint in endpoints])
+
+    def init_workers(self, count, db_location, port=13010, interval=0.5, batch_size=500):
+        '''
+        Hand value updates to worker processes instead of handling them on the reactor.
+        @param count: the number of worker processes
+        @param db_location: the location of the HouseAgent database
+        @param port: the first of count + 1 local ports used to talk to the workers
+        @param interval: the maximum time in seconds a value update is queued in a worker
+        @param batch_size: the number of queued values that triggers an immediate write in a worker
+        
+        @return: nothing
+        '''
+        self.workers = WorkerPool(self.log, self.value_committed, count, db_location, port, 
+                                  interval, batch_size, self.factory)
 
     def handle_plugin_ready(self, routing_info, payload):
         '''
         This function handles ready messages received on the broker.
         
         @param routing_info: the routing information associated with the plugin
-        @param payload: the payload, such as the plugin guid and possible callbacks
+        @param payload: the payload, such as the plugin guid, possible callbacks and 
+                        optionally the plugin options such as the supported encodings
         
         @return: nothing
         '''
-        self.log.debug("Coordinator::Received plugin ready message from: %r" % (payload[0]) )
+        self.tracer.trace(self.tracer.current, "Coordinator::Received plugin ready message from: %r", payload[0])
 
-        found = False
+        plugin = self.plugins.by_guid(payload[0])
 
-        for plugin in self.plugins:
-            if plugin.guid == payload[0]:
-                self.log.debug("Coordinator::Plugin found in database, setting status to online...")
-                found = True
-                plugin.online = True
-                plugin.type = payload[1]
-                plugin.routing_info = routing_info
-                
-                # Register callbacks
-                plugin.callbacks = json.loads(payload[2])                    
-        
-        if not found:
+        if plugin:
+            self.tracer.trace(self.tracer.current, "Coordinator::Plugin found in database, setting status to online...")
+            
+            if plugin.routing_info is not None and plugin.routing_info != routing_info:
+                # The plugin reconnected, replies to requests sent to the old connection will never arrive
+                self.broker.cancel_rpcs(plugin.routing_info)
+            
+            self.plugins.update_type(plugin, payload[1])
+            self.plugins.update_routing(plugin, routing_info)
+            
+            # Register callbacks
+            plugin.callbacks = json.loads(payload[2])
+            
+            # Plugin options, older plugins don't send them
+            if len(payload) > 3:
+                options = json.loads(payload[3])
+            else:
+                options = {}
+            
+            # Plugins can ask for a longer heartbeat interval than ours, not for a shorter one
+            plugin.heartbeat_interval = max(self.heartbeat_interval, options.get('heartbeat', 0))
+            plugin.time = time.time()
+            self.liveness.alive(plugin.guid, plugin.heartbeat_interval * self.heartbeat_misses)
+            self.set_plugin_status(plugin, True)
+            
+            # The commands the plugin handles, older plugins don't tell
+            plugin.commands = options.get('commands')
+            
+            # Negotiate value update encoding, and let the plugin know about it
+            plugin.encoding = select_encoding(options.get('encodings', ['json']))
+            
+            settings = {'encoding': plugin.encoding,
+                        'batch': True,
+                        'heartbeat_ack': True,
+                        'heartbeat': plugin.heartbeat_interval}
+            
+            # Plugins that subscribe to the CRUD publisher no longer need CRUD messages on the broker socket
+            plugin.crud_pubsub = bool(options.get('crud_pubsub')) and self.crud_publisher is not None
+            if plugin.crud_pubsub:
+                settings['crud_port'] = self.crud_port
+            
+            # Acknowledged delivery, sequence numbers restart with every new session of the plugin.
+            # Worker processes don't report commits per plugin, acks are not available in worker mode.
+            session = options.get('acks')
+            plugin.acks = bool(session) and self.workers is None
+            if plugin.acks:
+                if session != plugin.session:
+                    plugin.session = session
+                    plugin.last_seq = 0
+                    plugin.acked_seq = 0
+                settings['acks'] = True
+            
+            self.broker.send([routing_info, b'', chr(7), json.dumps(settings)])
+        else:
             self.log.warning("Coordinator::Plugin not found in database! Check your plugin GUID...")
                 
     def handle_plugin_heartbeat(self, routing_info, payload):
@@ -163,43 +416,289 @@ class Coordinator(object):
         
         @return: nothing
         '''
-        self.log.debug("Coordinator::Received plugin heartbeat...")
-        found = False
-        
-        for plugin in self.plugins:
-            if plugin.routing_info == routing_info and plugin.online:
-                found = True
-                self.log.debug("Coordinator::Found plugin routing information and plugin is ready, heartbeat accepted...")
-                plugin.time = time.time()
+        self.tracer.trace(self.tracer.current, "Coordinator::Received plugin heartbeat...")
+        plugin = self.plugins.by_routing(routing_info)
         
-        if not found:
-            self.log.debug("Coordinator::Plugin is not ready, asking plugin about ready status...")
+        if plugin and plugin.online:
+            # The broker already registered the sign of life
+            self.tracer.trace(self.tracer.current, "Coordinator::Found plugin routing information and plugin is ready, heartbeat accepted...")
+            
+            # Answer the heartbeat, plugins use this to find out whether the broker is still there
+            self.broker.send([routing_info, b'', chr(2)])
+        else:
+            self.tracer.trace(self.tracer.current, "Coordinator::Plugin is not ready, asking plugin about ready status...")
             message = [routing_info, b'', chr(1)]
             self.broker.send(message)
                 
-    @inlineCallbacks
+    def plugin_seen(self, plugin, now):
+        '''
+        Register a sign of life of an online plugin, any message it sent.
+        The deadline of the plugin only moves once per liveness tick, busy plugins don't pay for it on every message.
+        
+        @param plugin: the Plugin object
+        @param now: the time the message has been received
+        '''
+        if now - plugin.time >= self.liveness.wheel.tick:
+            plugin.time = now
+            self.liveness.alive(plugin.guid, plugin.heartbeat_interval * self.heartbeat_misses)
+
+    def plugin_expired(self, guid):
+        '''
+        This function is called by the liveness monitor when a plugin missed too many heartbeats.
+        @param guid: the guid of the plugin
+        '''
+        plugin = self.plugins.by_guid(guid)
+        
+        if plugin and plugin.online:
+            self.log.warning("Coordinator::Plugin %s missed its heartbeats, setting status to offline...", guid)
+            self.set_plugin_status(plugin, False)
+
+    def set_plugin_status(self, plugin, online):
+        '''
+        Change the online status of a plugin and let the event engine know about it.
+        Outstanding commands to a plugin that goes offline fail immediately.
+        
+        @param plugin: the Plugin object
+        @param online: the new status
+        '''
+        if plugin.online == online:
+            return
+        
+        plugin.online = online
+        
+        if not online:
+            self.broker.cancel_rpcs(plugin.routing_info)
+        
+        if self.eventengine:
+            self.eventengine.plugin_status_changed(plugin.guid, online)
+
     def handle_plugin_value_update(self, routing_info, payload):
         '''
         This function handles plugin value updates. 
+        The update is queued, the ingester writes it to the database in the background.
         
         @param routing_info: the routing information associated with the plugin
-        @param payload: the payload, such as the device values and value labels
+        @param payload: the payload, the encoded update optionally followed by the name of the encoding
         '''
-        self.log.debug("Coordinator::Received plugin value update...")
+        cid = self.tracer.current
+        self.tracer.trace(cid, "Coordinator::Received plugin value update...")
+        plugin = self.plugins.by_routing(routing_info)
         
-        for plugin in self.plugins:
-            if plugin.routing_info == routing_info:
-                message = json.loads(payload[0])
-                self.log.debug("Coordinator::Decoded update, sending to database: %r " % (message))
-                
-                for key in message["values"]:
-                    value_id = yield self.db.update_or_add_value(key, message["values"][key], 
-                                                plugin.id, 
-                                                message["address"], message["time"])
-
-                    # Notify the eventengine
-                    if self.eventengine:
-                        self.eventengine.device_value_changed(value_id, message["values"][key])
+        if not plugin:
+            # We don't know this plugin, probably because the broker restarted, ask it to announce itself
+            self.broker.send([routing_info, b'', chr(1)])
+            return
+        
+        seq = 0
+        try:
+            seq = self._sequence(plugin, payload)
+            if seq is None:
+                return
+            
+            if self.admission.admit(plugin, '\x03', payload):
+                self._value_update(plugin, '\x03', payload, cid)
+            elif seq and self.admission.policy(plugin) in ('delay', 'coalesce'):
+                # Acknowledged when admission control releases it
+                return
+        except ValueError as e:
+            self._invalid_value_update(plugin, e)
+        
+        if seq:
+            self.ingester.ack(plugin.guid, seq)
+
+    def handle_plugin_value_update_many(self, routing_info, payload):
+        '''
+        This function handles a batch of value updates for multiple devices.
+        The whole batch is written to the database in one transaction.
+        
+        @param routing_info: the routing information associated with the plugin
+        @param payload: the payload, the encoded batch followed by the name of the encoding
+        '''
+        cid = self.tracer.current
+        self.tracer.trace(cid, "Coordinator::Received plugin value update batch...")
+        plugin = self.plugins.by_routing(routing_info)
+        
+        if not plugin:
+            # We don't know this plugin, probably because the broker restarted, ask it to announce itself
+            self.broker.send([routing_info, b'', chr(1)])
+            return
+        
+        seq = 0
+        try:
+            seq = self._sequence(plugin, payload)
+            if seq is None:
+                return
+            
+            if self.admission.admit(plugin, '\x08', payload):
+                self._value_update(plugin, '\x08', payload, cid)
+            elif seq and self.admission.policy(plugin) in ('delay', 'coalesce'):
+                # Acknowledged when admission control releases it
+                return
+        except ValueError as e:
+            self._invalid_value_update(plugin, e)
+        
+        if seq:
+            self.ingester.ack(plugin.guid, seq)
+
+    def _invalid_value_update(self, plugin, error):
+        '''
+        Drop a value update message that could not be decoded.
+        Plugins that use acknowledged delivery get it acknowledged, sending it again won't help.
+        '''
+        self.broker.stats.invalid_message(plugin.guid)
+        self.log.error("Coordinator::Dropped invalid value update from plugin %s: %s", plugin.guid, error)
+
+    def _sequence(self, plugin, payload):
+        '''
+        Check the sequence number of a value update message of a plugin that uses acknowledged delivery.
+        Retransmitted messages that have been received before are acknowledged again and dropped.
+        
+        @return: the sequence number, 0 when the message has none, None for a duplicate
+        '''
+        if not plugin.acks or len(payload) < 3:
+            return 0
+        
+        seq = int(payload[2])
+        if seq <= plugin.last_seq:
+            # Repeat the last ack only, the original may not have been committed yet
+            self.duplicates += 1
+            if plugin.acked_seq:
+                self.broker.send([plugin.routing_info, b'', chr(9), str(plugin.acked_seq)])
+                self.acks_sent += 1
+            return None
+        
+        plugin.last_seq = seq
+        return seq
+
+    def send_acks(self, acks):
+        '''
+        This function is called by the ingester when value updates have been committed to the database.
+        Acknowledges the updates to plugins that use acknowledged delivery.
+        
+        @param acks: a dictionary with plugin guids as keys and the highest committed sequence number as values
+        '''
+        for guid, seq in acks.iteritems():
+            plugin = self.plugins.by_guid(guid)
+            
+            if plugin and plugin.online and plugin.acks:
+                plugin.acked_seq = seq
+                self.broker.send([plugin.routing_info, b'', chr(9), str(seq)])
+                self.acks_sent += 1
+
+    def _value_update(self, plugin, type, payload, cid=None):
+        '''
+        Hand an admitted value update message to a worker or to the ingester.
+        '''
+        if self.workers:
+            worker = self.workers.dispatch(plugin, type, payload)
+            self.tracer.trace(cid, "Coordinator::Handed update to worker %d", worker)
+            return
+        
+        # The encoding is sent along with the update, older plugins only send JSON
+        if len(payload) > 1:
+            encoding = payload[1]
+        else:
+            encoding = 'json'
+        
+        if type == '\x08':
+            updates = decode_value_updates(encoding, payload[0])
+            self.tracer.trace(cid, "Coordinator::Decoded %d updates", len(updates))
+        else:
+            updates = [decode_value_update(encoding, payload[0])]
+            self.tracer.trace(cid, "Coordinator::Decoded update: %r %r", updates[0][0], updates[0][1])
+        
+        self.store_updates(plugin.id, updates, cid)
+
+    def store_updates(self, plugin_id, updates, cid=None):
+        '''
+        Journal decoded value updates, filter redundant values out and queue the rest for the database.
+        This is also used to feed recorded updates through the coordinator (see tools/replay.py).
+        
+        @param plugin_id: the id of the plugin that sent the updates
+        @param updates: a list of (address, values, time) tuples
+        @param cid: the correlation id of the message that carried the updates, when traced
+        '''
+        seq = None
+        if self.journal:
+            seq = self.journal.append(plugin_id, updates)
+        
+        changed = []
+        for address, values, timestamp in updates:
+            values = self.value_filter.filter(plugin_id, address, values)
+            if values:
+                changed.append((address, values, timestamp))
+        
+        if changed:
+            self.tracer.trace(cid, "Coordinator::Queueing %d updates for database", len(changed))
+            self.ingester.put_many(plugin_id, changed, cid, seq)
+        else:
+            self.tracer.trace(cid, "Coordinator::Nothing changed, update suppressed")
+
+    def _recover_updates(self, seq, received, plugin_id, updates):
+        '''
+        Queue the updates of a journal entry that has not been committed to the database.
+        '''
+        self.ingester.put_many(plugin_id, updates, None, seq)
+
+    def release_value_update(self, plugin, type, payload):
+        '''
+        This function is called by admission control to handle a delayed value update message.
+        '''
+        try:
+            self._value_update(plugin, type, payload)
+        except ValueError as e:
+            self._invalid_value_update(plugin, e)
+        
+        if plugin.acks and len(payload) > 2:
+            self.ingester.ack(plugin.guid, int(payload[2]))
+
+    def release_value_updates(self, plugin, updates, seq=None):
+        '''
+        This function is called by admission control to handle coalesced value updates.
+        @param updates: a list of (address, values, time) tuples
+        @param seq: the highest sequence number of the plugin that has been released completely, or None
+        '''
+        if self.workers:
+            self.workers.dispatch(plugin, '\x08', [encode_value_updates('json', updates), 'json'])
+        else:
+            self.store_updates(plugin.id, updates)
+        
+        if plugin.acks and seq:
+            self.ingester.ack(plugin.guid, seq)
+
+    def stats(self):
+        '''
+        Returns a snapshot of the statistics of the broker and the other coordinator components.
+        This allows to find out which plugin is keeping the coordinator busy.
+        '''
+        stats = {'broker': self.broker.stats.snapshot(),
+                 'rpc': self.broker.rpc_stats(),
+                 'ingestion': self.ingester.stats(),
+                 'admission': self.admission.stats(),
+                 'filter': self.value_filter.stats(),
+                 'commands': self.commands.stats(),
+                 'acks': {'sent': self.acks_sent, 'duplicates': self.duplicates},
+                 'logging': self.log.stats()}
+        
+        if self.journal:
+            stats['journal'] = self.journal.stats()
+        
+        if self.workers:
+            stats['workers'] = self.workers.stats()
+        
+        return stats
+
+    def value_committed(self, value_id, value, cid=None):
+        '''
+        This function is called by the ingester or a worker process when a value has been written to the database.
+        
+        @param value_id: the id of the value
+        @param value: the new value
+        @param cid: the correlation id of the message that carried the value, when traced
+        '''
+        # Notify the eventengine
+        if self.eventengine:
+            self.eventengine.device_value_changed(value_id, value, cid)
                         
     def send_custom(self, plugin_guid, action, parameters):
         '''
@@ -256,14 +755,15 @@ class Coordinator(object):
         @param level: the dim level
         @param value_id: optional id of particular value to change
         
-        @return: a Twisted deferred which will callback with the result
+        @return: a Twisted deferred which will callback with the result, or with the result of a newer request that replaced it
         '''
         content = {'address': address,
                    'type': 'dim',
                    'level': level,
                    'value_id': value_id}
         
-        return self.send_command(plugin_guid, content)
+        # Only the latest level matters, intermediate levels are skipped while the device is busy
+        return self.commands.submit((plugin_guid, address, value_id), plugin_guid, content)
         
     def send_thermostat_setpoint(self, plugin_guid, address, temperature, value_id = None):
         '''
@@ -273,14 +773,122 @@ class Coordinator(object):
         @param temperature: the temperature to set
         @param value_id: optional id of particular value to change
         
-        @return: a Twisted deferred which will callback with the result
+        @return: a Twisted deferred which will callback with the result, or with the result of a newer request that replaced it
         '''
         content = {'address': address,
                    'type': 'thermostat_setpoint', 
                    'temperature': temperature,
                    'value_id': value_id}
         
-        return self.send_command(plugin_guid, content)
+        return self.commands.submit((plugin_guid, address, value_id), plugin_guid, content)
+
+    def send_bulk(self, items, concurrency=4):
+        '''
+        Send a batch of commands, for example all commands of a scene.
+        Commands are grouped per plugin, the groups are sent in parallel with at most
+        concurrency commands in flight per plugin.
+        
+        @param items: a list of (plugin_guid, address, command) tuples, command is a dictionary with the
+                      command type (poweron, poweroff, dim or thermostat_setpoint) as 'type', optionally a 
+                      'value_id' and the 'level' or 'temperature' for dim and thermostat_setpoint commands.
+                      Other command types are sent as they are to plugins that registered them.
+        @param concurrency: the maximum number of commands in flight per plugin
+        
+        @return: a Twisted deferred which will callback with a list of results in the order of the items. 
+                 Each result is a dictionary with 'success', the 'result' or 'error', the time the command 
+                 waited for its turn as 'queued' and the time the plugin took as 'duration'.
+        '''
+        semaphores = {}
+        deferreds = []
+        
+        for plugin_guid, address, command in items:
+            if plugin_guid not in semaphores:
+                semaphores[plugin_guid] = defer.DeferredSemaphore(concurrency)
+            
+            deferreds.append(self._send_bulk_item(semaphores[plugin_guid], plugin_guid, address, command))
+        
+        return defer.gatherResults(deferreds)
+    
+    def _send_bulk_item(self, semaphore, plugin_guid, address, command):
+        '''
+        Send one command of a batch when the semaphore of its plugin allows, the deferred never fails.
+        '''
+        submitted = time.time()
+        timing = {}
+        
+        def send():
+            timing['started'] = time.time()
+            return self._send_typed_command(plugin_guid, address, command)
+        
+        def done(result):
+            now = time.time()
+            started = timing.get('started', now)
+            return {'success': True, 'result': result, 
+                    'queued': started - submitted, 'duration': now - started}
+        
+        def failed(failure):
+            now = time.time()
+            started = timing.get('started', now)
+            return {'success': False, 'error': failure.getErrorMessage(), 
+                    'queued': started - submitted, 'duration': now - started}
+        
+        d = semaphore.run(send)
+        d.addCallbacks(done, failed)
+        return d
+    
+    def _send_typed_command(self, plugin_guid, address, command):
+        '''
+        Send a command described by a dictionary, see send_bulk.
+        '''
+        type = command.get('type')
+        value_id = command.get('value_id')
+        
+        plugin = self.plugins.by_guid(plugin_guid)
+        if plugin is None:
+            return defer.fail(PluginNotFoundError(plugin_guid))
+        
+        if type == 'poweron':
+            return self.send_poweron(plugin_guid, address, value_id)
+        elif type == 'poweroff':
+            return self.send_poweroff(plugin_guid, address, value_id)
+        elif type == 'dim':
+            return self.send_dim(plugin_guid, address, command['level'], value_id)
+        elif type == 'thermostat_setpoint':
+            return self.send_thermostat_setpoint(plugin_guid, address, command['temperature'], value_id)
+        
+        # Commands registered by the plugin itself
+        if type and plugin.commands is not None:
+            content = dict(command)
+            content['address'] = address
+            return self.send_command(plugin_guid, content)
+        
+        return defer.fail(ValueError("Unknown command type %r" % type))
+    
+    def query_profile(self, plugin_guid):
+        '''
+        Query the timings of the command callbacks of a plugin that has been started with profiling.
+        
+        @param plugin_guid: the guid of the plugin
+        
+        @return: a Twisted deferred which will callback with the calls, errors and timings per command type
+        '''
+        return self.send_command(plugin_guid, {'type': 'profile'})
+
+    def query_profiles(self):
+        '''
+        Query the timings of the command callbacks of all online plugins that keep them.
+        
+        @return: a Twisted deferred which will callback with a dictionary with plugin guids as keys,
+                 and the timings, or the error when the query failed, as values
+        '''
+        guids = [p.guid for p in self.plugins if p.online and p.commands and 'profile' in p.commands]
+        
+        def failed(failure):
+            return {'error': failure.getErrorMessage()}
+        
+        d = defer.gatherResults([self.query_profile(guid).addErrback(failed) for guid in guids])
+        d.addCallback(lambda results: dict(zip(guids, results)))
+        return d
 
     def send_command(self, plugin_guid, content):
         '''
@@ -288,11 +896,19 @@ class Coordinator(object):
         
         @param plugin_guid: the guid of the plugin
         @param content: the content to send
+        
+        @return: a Twisted deferred which will callback with the result. It errbacks with 
+                 PluginOfflineError when the plugin is offline, and with UnsupportedCommandError 
+                 when the plugin told us it doesn't handle the command.
         '''
-        self.log.debug("Sending command {0}".format(content))
+        self.log.debug("Sending command %s", content)
         p = self.plugin_by_guid(plugin_guid)
-        if p:
+        if p and p.commands is not None and content['type'] not in p.commands:
+            return defer.fail(UnsupportedCommandError(content['type']))
+        elif p and p.online:
             return self.broker.send_rpc(p.routing_info, content)
+        elif p:
+            return defer.fail(PluginOfflineError(plugin_guid))
         else:
             d = defer.Deferred()
             d.callback(0)
@@ -306,28 +922,87 @@ class Coordinator(object):
         @param action: the CRUD action, for example update, delete, creation
         @param parameters: the parameters specified with the CRUD action, for example a device ID
         '''
-        content = {"type": type,
-                   "action": action, 
-                   "parameters": parameters}
+        content = json.dumps({"type": type,
+                              "action": action, 
+                              "parameters": parameters})
+        
+        if self.crud_publisher:
+            self.crud_publisher.publish(type, content)
         
+        # Older plugins only receive CRUD updates on the broker socket
         for p in self.plugins:
-            if 'crud' in p.callbacks and p.online:
-                message = [p.routing_info, b'', chr(6), json.dumps(content)]
+            if 'crud' in p.callbacks and p.online and not p.crud_pubsub:
+                message = [p.routing_info, b'', chr(6), content]
                 self.broker.send(message)
                            
     @inlineCallbacks
     def load_plugins(self):
         '''
         This function loads plugin information from the HouseAgent database.
-        '''
-        # Empty in case of a reload
-        self.plugins = []
+        On a reload only the plugins that have been added, removed or changed are touched, 
+        connected plugins keep their routing information, callbacks and liveness state.
         
+        @return: a Twisted deferred which will callback with the number of added, removed and changed plugins
+        '''
         plugins = yield self.db.query_plugins()
-        for plugin in plugins:
-            p = Plugin(plugin[1], plugin[2], time.time(), plugin[4])
-            self.plugins.append(p)
-            self.log.debug("Loading plugin %s" % (plugin[0]))
+        
+        added = removed = changed = 0
+        guids = set()
+        
+        for name, guid, id, location, location_id in plugins:
+            guids.add(guid)
+            p = self.plugins.by_guid(guid)
+            
+            if p is None:
+                self.plugins.add(Plugin(guid, id, time.time(), location_id))
+                self.log.debug("Loading plugin %s", name)
+                added += 1
+            
+            elif p.id != id or p.location_id != location_id:
+                # Re-add to update the id index, the session state stays with the plugin object
+                self.plugins.remove(p)
+                p.id = id
+                p.location_id = location_id
+                self.plugins.add(p)
+                self.log.debug("Updating plugin %s", name)
+                changed += 1
+        
+        for p in list(self.plugins):
+            if p.guid not in guids:
+                self.remove_plugin(p)
+                removed += 1
+        
+        yield self.load_plugin_limits()
+        yield self.load_value_filters()
+        
+        returnValue((added, removed, changed))
+    
+    def remove_plugin(self, plugin):
+        '''
+        Forget a plugin that has been removed from the database.
+        Outstanding commands are cancelled, messages of the plugin are ignored from now on.
+        @param plugin: the Plugin object
+        '''
+        self.log.debug("Removing plugin %s", plugin.guid)
+        self.set_plugin_status(plugin, False)
+        self.liveness.forget(plugin.guid)
+        self.plugins.remove(plugin)
+    
+    @inlineCallbacks
+    def load_plugin_limits(self):
+        '''
+        This function loads the value update rate limits of the plugins from the HouseAgent database.
+        '''
+        limits = yield self.db.query_plugin_limits()
+        self.admission.set_limits(limits)
+    
+    @inlineCallbacks
+    def load_value_filters(self):
+        '''
+        This function loads the filter settings of individual values from the HouseAgent database.
+        '''
+        settings = yield self.db.query_value_filters()
+        self.value_filter.set_settings(settings)
            
     def plugin_id_by_guid(self, guid):
         '''
@@ -336,9 +1011,9 @@ class Coordinator(object):
         
         @return: returns a Plugin ID 
         '''
-        for p in self.plugins:
-            if p.guid == guid:
-                return p.id
+        p = self.plugins.by_guid(guid)
+        if p:
+            return p.id
     
     def plugin_guid_by_id(self, id):
         '''
@@ -347,9 +1022,9 @@ class Coordinator(object):
         
         @return: returns a Plugin ID 
         '''
-        for p in self.plugins:
-            if p.id == id:
-                return p.guid
+        p = self.plugins.by_id(id)
+        if p:
+            return p.guid
             
     def plugin_by_id(self, id):
         '''
@@ -358,11 +1033,7 @@ class Coordinator(object):
         
         @return: None if nothing is found, otherwise Plugin()
         '''
-        for p in self.plugins:
-            if p.id == id:
-                return p
-            
-        return None
+        return self.plugins.by_id(id)
     
     def plugin_by_guid(self, guid):
         '''
@@ -371,11 +1042,7 @@ class Coordinator(object):
         
         @return: None if nothing is found, otherwise Plugin()
         '''
-        for p in self.plugins:
-            if p.guid == guid:
-                return p
-            
-        return None
+        return self.plugins.by_guid(guid)
     
     def get_plugins_by_type(self, type):
         '''
@@ -384,14 +1051,110 @@ class Coordinator(object):
         
         @return: a list of plugins
         '''
-        output = []
-        for p in self.plugins:
+        return self.plugins.by_type(type)
 
-            if p.type == type:
-                output.append(p)
+class PluginRegistry(object):
+    '''
+    This class holds the plugins known to the coordinator.
+    Plugins are indexed by guid, id, routing information and type, so a lookup on
+    the broker hot path doesn't depend on the number of plugins installed.
+    Routing information and type are only known once a plugin is ready, use 
+    update_routing() and update_type() to change them so the indexes stay in sync.
+    '''
+    
+    def __init__(self):
+        self._by_guid = {}
+        self._by_id = {}
+        self._by_routing = {}
+        self._by_type = {}
         
-        return output
-                
+    def __iter__(self):
+        return iter(self._by_guid.values())
+    
+    def __len__(self):
+        return len(self._by_guid)
+        
+    def add(self, plugin):
+        '''
+        Add a plugin to the registry.
+        @param plugin: the Plugin object to add
+        '''
+        self._by_guid[plugin.guid] = plugin
+        self._by_id[plugin.id] = plugin
+        
+        if plugin.routing_info is not None:
+            self._by_routing[plugin.routing_info] = plugin
+        
+        self._by_type.setdefault(plugin.type, {})[plugin.guid] = plugin
+
+    def remove(self, plugin):
+        '''
+        Remove a plugin from the registry.
+        @param plugin: the Plugin object to remove
+        '''
+        self._by_guid.pop(plugin.guid, None)
+        self._by_id.pop(plugin.id, None)
+        
+        if self._by_routing.get(plugin.routing_info) is plugin:
+            del self._by_routing[plugin.routing_info]
+        
+        self._by_type.get(plugin.type, {}).pop(plugin.guid, None)
+
+    def clear(self):
+        '''
+        Remove all plugins from the registry.
+        '''
+        self._by_guid.clear()
+        self._by_id.clear()
+        self._by_routing.clear()
+        self._by_type.clear()
+
+    def update_routing(self, plugin, routing_info):
+        '''
+        Change the routing information of a plugin, for example when it (re)connects.
+        @param plugin: the Plugin object
+        @param routing_info: the new routing information
+        '''
+        if self._by_routing.get(plugin.routing_info) is plugin:
+            del self._by_routing[plugin.routing_info]
+        
+        plugin.routing_info = routing_info
+        self._by_routing[routing_info] = plugin
+
+    def update_type(self, plugin, type):
+        '''
+        Change the type of a plugin.
+        @param plugin: the Plugin object
+        @param type: the new plugin type
+        '''
+        self._by_type.get(plugin.type, {}).pop(plugin.guid, None)
+        plugin.type = type
+        self._by_type.setdefault(type, {})[plugin.guid] = plugin
+
+    def by_guid(self, guid):
+        '''
+        Return a plugin identified by GUID, or None.
+        '''
+        return self._by_guid.get(guid)
+    
+    def by_id(self, id):
+        '''
+        Return a plugin identified by ID, or None.
+        '''
+        return self._by_id.get(id)
+    
+    def by_routing(self, routing_info):
+        '''
+        Return a plugin identified by its broker routing information, or None.
+        '''
+        return self._by_routing.get(routing_info)
+    
+    def by_type(self, type):
+        '''
+        Return a list of plugins of a certain type.
+        '''
+        return self._by_type.get(type, {}).values()
+
 class Plugin(object):
     '''
     This is a skeleton class for a network plugin.
@@ -414,6 +1177,14 @@ class Plugin(object):
         self.routing_info = None
         self.callbacks = []
         self.location_id = location_id
+        self.encoding = 'json'
+        self.crud_pubsub = False
+        self.acks = False
+        self.session = None
+        self.last_seq = 0
+        self.acked_seq = 0
+        self.commands = None
+        self.heartbeat_interval = 30
         
     def __str__(self):
         ''' A string representation of the Plugin object '''
@@ -7,6 +7,47 @@ import os.path, sys
 import shutil
 import sqlite3 # Fix needed for PyInstaller.
 
+def write_values(txn, updates):
+    '''
+    Update or add a batch of values within a transaction.
+    This is shared by the database layer and the worker processes (see houseagent.core.workers).
+    @param txn: a DB-API cursor, or the transaction of a runInteraction call
+    @param updates: a list of (name, value, pluginid, address, time) tuples
+
+    @return: a list of value ids, in the order of the updates. The value id is '' when the device does not exist.
+    '''
+    devices = {}
+    value_ids = []
+    
+    for name, value, pluginid, address, time in updates:
+        if not time:
+            updatetime = datetime.datetime.now().isoformat(' ').split('.')[0]
+        else:
+            updatetime = datetime.datetime.fromtimestamp(time).isoformat(' ').split('.')[0]
+        
+        # Query device first, devices are looked up once per batch
+        if (pluginid, address) not in devices:
+            device = txn.execute('select id from devices WHERE plugin_id = ? and address = ? LIMIT 1', (pluginid, address)).fetchall()
+            devices[(pluginid, address)] = device[0][0] if device else None
+        
+        device_id = devices[(pluginid, address)]
+        if not device_id:
+            value_ids.append('') # device does not exist
+            continue
+
+        current_value = txn.execute("SELECT id FROM current_values WHERE name=? AND device_id=? LIMIT 1", (name, device_id)).fetchall()
+
+        if current_value:
+            value_id = current_value[0][0]
+            txn.execute("UPDATE current_values SET value=?, lastupdate=? WHERE id=?", (value, updatetime, value_id))
+        else:
+            txn.execute("INSERT INTO current_values (name, value, device_id, lastupdate) VALUES (?, ?, ?, ?)", (name, value, device_id, updatetime))
+            value_id = txn.lastrowid
+        
+        value_ids.append(value_id)
+    
+    return value_ids
+
 class Database():
     """
     HouseAgent database interaction.
@@ -26,7 +67,7 @@ class Database():
             self.dbpool = ConnectionPool("sqlite3", db_location, check_same_thread=False, cp_max=1)
        
         # Check database schema version and upgrade when required
-        self.updatedb('0.3')
+        self.updatedb('0.6')
              
     def updatedb(self, dbversion):
         '''
@@ -53,7 +94,7 @@ class Database():
             version = '0.0'
 
         if float(version) > float(dbversion):
-            self.log.error("ERROR: The current database schema (%s) is not supported by this version of HouseAgent" % version)
+            self.log.error("ERROR: The current database schema (%s) is not supported by this version of HouseAgent", version)
             # Exit HouseAgent
             sys.exit(1)
         
@@ -62,7 +103,7 @@ class Database():
             return
         
         else:
-            self.log.info("Database schema will be updated from %s to %s:" % (version, dbversion))
+            self.log.info("Database schema will be updated from %s to %s:", version, dbversion)
 
             # Before we start manipulating the database schema, first make a backup copy of the database
             try:
@@ -71,127 +112,188 @@ class Database():
                 self.log.error("Cannot make a backup copy of the database (%s)", sys.exc_info()[1])
                 return
 
-            if version == '0.0':
-                try:
-                    # Create common table
-                    txn.execute("CREATE TABLE IF NOT EXISTS common (parm VARCHAR(16) PRIMARY KEY, parm_value VARCHAR(24) NOT NULL)")
+            while float(version) < float(dbversion):
+                if version == '0.0':
+                    try:
+                        # Create common table
+                        txn.execute("CREATE TABLE IF NOT EXISTS common (parm VARCHAR(16) PRIMARY KEY, parm_value VARCHAR(24) NOT NULL)")
             
-                    # Add schema version to database
-                    txn.execute("INSERT INTO common (parm, parm_value) VALUES ('schema_version', ?)", [dbversion])
-
-                    # Set primary key of the devices table on address + plugin_id to prevent adding duplicate devices
-                    txn.execute("CREATE TEMPORARY TABLE devices_backup(id INTEGER PRIMARY KEY, name VARCHAR(45), address VARCHAR(45) NOT NULL, plugin_id INTEGER NOT NULL, location_id INTEGER)")
-                    txn.execute("INSERT INTO devices_backup SELECT id, name, address, plugin_id, location_id FROM devices")
-                    txn.execute("DROP TABLE devices")
-                    txn.execute("CREATE TABLE devices(id INTEGER PRIMARY KEY, name VARCHAR(45), address VARCHAR(45) NOT NULL, plugin_id INTEGER, location_id INTEGER)")
-                    txn.execute("CREATE UNIQUE INDEX device_address ON devices (address, plugin_id)")
-                    txn.execute("INSERT INTO devices SELECT id, name, address, plugin_id, location_id FROM devices_backup")
-                    txn.execute("DROP TABLE devices_backup")
-
-                    self.log.info("Successfully upgraded database schema to schema version 0.1")
-                except:
-                    self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
-
-            elif version == '0.1':
-                # update DB schema version to '0.2'
-                try:
-                    # update common table
-                    txn.execute("UPDATE common SET parm_value=0.2 WHERE parm='schema_version';")
-
-                    # history_periods table
-                    txn.execute("CREATE TABLE history_periods(id integer PRIMARY KEY AUTOINCREMENT NOT NULL,\
-                                name varchar(20), secs integer NOT NULL, sysflag CHAR(1) NOT NULL DEFAULT '0');")
+                        # Add schema version to database
+                        txn.execute("INSERT INTO common (parm, parm_value) VALUES ('schema_version', '0.1')")
+
+                        # Set primary key of the devices table on address + plugin_id to prevent adding duplicate devices
+                        txn.execute("CREATE TEMPORARY TABLE devices_backup(id INTEGER PRIMARY KEY, name VARCHAR(45), address VARCHAR(45) NOT NULL, plugin_id INTEGER NOT NULL, location_id INTEGER)")
+                        txn.execute("INSERT INTO devices_backup SELECT id, name, address, plugin_id, location_id FROM devices")
+                        txn.execute("DROP TABLE devices")
+                        txn.execute("CREATE TABLE devices(id INTEGER PRIMARY KEY, name VARCHAR(45), address VARCHAR(45) NOT NULL, plugin_id INTEGER, location_id INTEGER)")
+                        txn.execute("CREATE UNIQUE INDEX device_address ON devices (address, plugin_id)")
+                        txn.execute("INSERT INTO devices SELECT id, name, address, plugin_id, location_id FROM devices_backup")
+                        txn.execute("DROP TABLE devices_backup")
+
+                        self.log.info("Successfully upgraded database schema to schema version 0.1")
+                    except:
+                        self.log.error("Database schema upgrade failed (%s)", sys.exc_info()[1])
+                        return
+
+                elif version == '0.1':
+                    # update DB schema version to '0.2'
+                    try:
+                        # update common table
+                        txn.execute("UPDATE common SET parm_value=0.2 WHERE parm='schema_version';")
+
+                        # history_periods table
+                        txn.execute("CREATE TABLE history_periods(id integer PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                    name varchar(20), secs integer NOT NULL, sysflag CHAR(1) NOT NULL DEFAULT '0');")
                     
-                    # default values for history_periods table
-                    txn.execute("INSERT INTO history_periods VALUES(1,'Disabled',0,'1');")
-                    txn.execute("INSERT INTO history_periods VALUES(2,'5 min',300,'1');")
-                    txn.execute("INSERT INTO history_periods VALUES(3,'15 min',900,'1');")
-                    txn.execute("INSERT INTO history_periods VALUES(4,'30 min',1800,'1');")
-                    txn.execute("INSERT INTO history_periods VALUES(5,'1 hour',3600,'1');")
-                    txn.execute("INSERT INTO history_periods VALUES(6,'2 hours',7200,'1');")
-                    txn.execute("INSERT INTO history_periods VALUES(7,'8 hours',28800,'1');")
-                    txn.execute("INSERT INTO history_periods VALUES(8,'12 hours',43200,'1');")
-                    txn.execute("INSERT INTO history_periods VALUES(9,'1 day',86400,'1');")
-
-                    # history_types table
-                    txn.execute("CREATE TABLE history_types (id integer PRIMARY KEY AUTOINCREMENT NOT NULL, \
-                                name  varchar(50));")
+                        # default values for history_periods table
+                        txn.execute("INSERT INTO history_periods VALUES(1,'Disabled',0,'1');")
+                        txn.execute("INSERT INTO history_periods VALUES(2,'5 min',300,'1');")
+                        txn.execute("INSERT INTO history_periods VALUES(3,'15 min',900,'1');")
+                        txn.execute("INSERT INTO history_periods VALUES(4,'30 min',1800,'1');")
+                        txn.execute("INSERT INTO history_periods VALUES(5,'1 hour',3600,'1');")
+                        txn.execute("INSERT INTO history_periods VALUES(6,'2 hours',7200,'1');")
+                        txn.execute("INSERT INTO history_periods VALUES(7,'8 hours',28800,'1');")
+                        txn.execute("INSERT INTO history_periods VALUES(8,'12 hours',43200,'1');")
+                        txn.execute("INSERT INTO history_periods VALUES(9,'1 day',86400,'1');")
+
+                        # history_types table
+                        txn.execute("CREATE TABLE history_types (id integer PRIMARY KEY AUTOINCREMENT NOT NULL, \
+                                    name  varchar(50));")
                     
-                    # default values for history_types table
-                    txn.execute("INSERT INTO history_types VALUES (NULL, 'GAUGE');")
-                    txn.execute("INSERT INTO history_types VALUES (NULL, 'COUNTER');")
-
-                    txn.execute("CREATE TEMPORARY TABLE current_values_tmp( \
-                                id integer PRIMARY KEY AUTOINCREMENT NOT NULL, \
-                                name varchar(45), value varchar(45), device_id integer NOT NULL, \
-                                lastupdate datetime, history bool DEFAULT 0, \
-                                history_type_id integer, control_type_id integer DEFAULT 0);")
-                    txn.execute("INSERT INTO current_values_tmp \
-                                SELECT id, name, value, device_id, lastupdate, history, \
-                                history_type_id, control_type_id FROM current_values;")
+                        # default values for history_types table
+                        txn.execute("INSERT INTO history_types VALUES (NULL, 'GAUGE');")
+                        txn.execute("INSERT INTO history_types VALUES (NULL, 'COUNTER');")
+
+                        txn.execute("CREATE TEMPORARY TABLE current_values_tmp( \
+                                    id integer PRIMARY KEY AUTOINCREMENT NOT NULL, \
+                                    name varchar(45), value varchar(45), device_id integer NOT NULL, \
+                                    lastupdate datetime, history bool DEFAULT 0, \
+                                    history_type_id integer, control_type_id integer DEFAULT 0);")
+                        txn.execute("INSERT INTO current_values_tmp \
+                                    SELECT id, name, value, device_id, lastupdate, history, \
+                                    history_type_id, control_type_id FROM current_values;")
                     
-                    # create new current_values scheme (old data are purged)
-                    txn.execute("DROP TABLE current_values;")
-                    txn.execute("CREATE TABLE current_values(id integer PRIMARY KEY AUTOINCREMENT NOT NULL, \
-                                name varchar(45), value varchar(45), device_id integer NOT NULL, \
-                                lastupdate datetime, history_period_id  int DEFAULT 1, \
-                                history_type_id int DEFAULT 1, control_type_id  integer DEFAULT 0, \
-                                FOREIGN KEY (history_period_id) REFERENCES history_periods(id), \
-                                FOREIGN KEY (history_type_id) REFERENCES history_types(id), \
-                                FOREIGN KEY (device_id) REFERENCES devices(id));")
+                        # create new current_values scheme (old data are purged)
+                        txn.execute("DROP TABLE current_values;")
+                        txn.execute("CREATE TABLE current_values(id integer PRIMARY KEY AUTOINCREMENT NOT NULL, \
+                                    name varchar(45), value varchar(45), device_id integer NOT NULL, \
+                                    lastupdate datetime, history_period_id  int DEFAULT 1, \
+                                    history_type_id int DEFAULT 1, control_type_id  integer DEFAULT 0, \
+                                    FOREIGN KEY (history_period_id) REFERENCES history_periods(id), \
+                                    FOREIGN KEY (history_type_id) REFERENCES history_types(id), \
+                                    FOREIGN KEY (device_id) REFERENCES devices(id));")
                     
-                    # current_values indexes
-                    txn.execute("CREATE INDEX 'current_values.fk_current_values_control_types1' \
-                                    ON current_values (control_type_id);")
-                    txn.execute("CREATE INDEX 'current_values.fk_current_values_history_periods1' \
-                                    ON current_values (history_period_id);")
-                    txn.execute("CREATE INDEX 'current_values.fk_current_values_history_types1' \
-                                    ON current_values (history_type_id);")
-                    txn.execute("CREATE INDEX 'current_values.fk_values_devices1' \
-                                    ON current_values (device_id);")
+                        # current_values indexes
+                        txn.execute("CREATE INDEX 'current_values.fk_current_values_control_types1' \
+                                        ON current_values (control_type_id);")
+                        txn.execute("CREATE INDEX 'current_values.fk_current_values_history_periods1' \
+                                        ON current_values (history_period_id);")
+                        txn.execute("CREATE INDEX 'current_values.fk_current_values_history_types1' \
+                                        ON current_values (history_type_id);")
+                        txn.execute("CREATE INDEX 'current_values.fk_values_devices1' \
+                                        ON current_values (device_id);")
                     
-                    # fill new current_values table
-                    txn.execute("INSERT INTO current_values \
-                                SELECT id, name, value, device_id, lastupdate, 1, 1, control_type_id \
-                                FROM current_values_tmp;")
-                    txn.execute("DROP TABLE current_values_tmp;")
-
-                    # history_values table
-                    txn.execute("CREATE TABLE history_values (value_id integer,\
-                                value real, created_at datetime, \
-                                FOREIGN KEY (value_id) REFERENCES current_values(id));")
-
-                    txn.execute("CREATE INDEX 'history_values.idx_history_values_created_at1' \
-                                    ON history_values (created_at);")
-                    txn.execute("CREATE INDEX 'history_values.idx_history_values_value_id1' \
-                                    ON history_values (value_id);")
+                        # fill new current_values table
+                        txn.execute("INSERT INTO current_values \
+                                    SELECT id, name, value, device_id, lastupdate, 1, 1, control_type_id \
+                                    FROM current_values_tmp;")
+                        txn.execute("DROP TABLE current_values_tmp;")
+
+                        # history_values table
+                        txn.execute("CREATE TABLE history_values (value_id integer,\
+                                    value real, created_at datetime, \
+                                    FOREIGN KEY (value_id) REFERENCES current_values(id));")
+
+                        txn.execute("CREATE INDEX 'history_values.idx_history_values_created_at1' \
+                                        ON history_values (created_at);")
+                        txn.execute("CREATE INDEX 'history_values.idx_history_values_value_id1' \
+                                        ON history_values (value_id);")
                     
-                    # Control types fix
-                    txn.execute("INSERT into control_types VALUES(0, 'Not controllable');")
-                    txn.execute("UPDATE control_types SET name='Switch (On/off)' WHERE id=1;")
-                    txn.execute("UPDATE control_types SET name='Thermostat (Setpoint)' WHERE id=2;")
-
-                    self.log.info("Successfully upgraded database schema to schema version 0.2")
-                except:
-                    self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                        # Control types fix
+                        txn.execute("INSERT into control_types VALUES(0, 'Not controllable');")
+                        txn.execute("UPDATE control_types SET name='Switch (On/off)' WHERE id=1;")
+                        txn.execute("UPDATE control_types SET name='Thermostat (Setpoint)' WHERE id=2;")
+
+                        self.log.info("Successfully upgraded database schema to schema version 0.2")
+                    except:
+                        self.log.error("Database schema upgrade failed (%s)", sys.exc_info()[1])
+                        return
  
-            elif version == '0.2':
-                # update DB schema version to '0.3'
-                try:
-                    # update common table
-                    txn.execute("UPDATE common SET parm_value=0.3 WHERE parm='schema_version';")
-
-                    # current_values table
-                    txn.execute("ALTER TABLE current_values ADD COLUMN label varchar(50);")
-
-                    # Control types fix
-                    txn.execute("UPDATE control_types SET name='CONTROL_TYPE_ON_OFF' WHERE id=1;")
-                    txn.execute("UPDATE control_types SET name='CONTROL_TYPE_THERMOSTAT' WHERE id=2;")
-                    txn.execute("INSERT into control_types VALUES(3, 'CONTROL_TYPE_DIMMER');")
+                elif version == '0.2':
+                    # update DB schema version to '0.3'
+                    try:
+                        # update common table
+                        txn.execute("UPDATE common SET parm_value=0.3 WHERE parm='schema_version';")
+
+                        # current_values table
+                        txn.execute("ALTER TABLE current_values ADD COLUMN label varchar(50);")
+
+                        # Control types fix
+                        txn.execute("UPDATE control_types SET name='CONTROL_TYPE_ON_OFF' WHERE id=1;")
+                        txn.execute("UPDATE control_types SET name='CONTROL_TYPE_THERMOSTAT' WHERE id=2;")
+                        txn.execute("INSERT into control_types VALUES(3, 'CONTROL_TYPE_DIMMER');")
                     
-                    self.log.info("Successfully upgraded database schema to schema version 0.3")
-                except: 
-                    self.log.error("Database schema upgrade failed (%s)" % sys.exc_info()[1])
+                        self.log.info("Successfully upgraded database schema to schema version 0.3")
+                    except: 
+                        self.log.error("Database schema upgrade failed (%s)", sys.exc_info()[1])
+                        return
+
+                elif version == '0.3':
+                    # update DB schema version to '0.4'
+                    try:
+                        # update common table
+                        txn.execute("UPDATE common SET parm_value=0.4 WHERE parm='schema_version';")
+
+                        # plugin_limits table, rate limits for value updates sent by plugins
+                        txn.execute("CREATE TABLE plugin_limits(plugin_id integer PRIMARY KEY NOT NULL, \
+                                    rate real NOT NULL, burst integer NOT NULL, \
+                                    policy varchar(16) NOT NULL DEFAULT 'drop', \
+                                    FOREIGN KEY (plugin_id) REFERENCES plugins(id));")
+
+                        self.log.info("Successfully upgraded database schema to schema version 0.4")
+                    except:
+                        self.log.error("Database schema upgrade failed (%s)", sys.exc_info()[1])
+                        return
+
+                elif version == '0.4':
+                    # update DB schema version to '0.5'
+                    try:
+                        # update common table
+                        txn.execute("UPDATE common SET parm_value=0.5 WHERE parm='schema_version';")
+
+                        # value_filters table, change-only filter settings of values
+                        txn.execute("CREATE TABLE value_filters(value_id integer PRIMARY KEY NOT NULL, \
+                                    deadband real NOT NULL DEFAULT 0, \
+                                    deadband_type varchar(16) NOT NULL DEFAULT 'absolute', \
+                                    max_silence integer NOT NULL DEFAULT 0, \
+                                    FOREIGN KEY (value_id) REFERENCES current_values(id));")
+
+                        self.log.info("Successfully upgraded database schema to schema version 0.5")
+                    except:
+                        self.log.error("Database schema upgrade failed (%s)", sys.exc_info()[1])
+                        return
+
+                elif version == '0.5':
+                    # update DB schema version to '0.6'
+                    try:
+                        # update common table
+                        txn.execute("UPDATE common SET parm_value=0.6 WHERE parm='schema_version';")
+
+                        # trigger type for events that run when a plugin goes online or offline
+                        if not txn.execute("SELECT id FROM trigger_types WHERE name = 'Plugin status change'").fetchall():
+                            txn.execute("INSERT INTO trigger_types (name) VALUES ('Plugin status change')")
+
+                        self.log.info("Successfully upgraded database schema to schema version 0.6")
+                    except:
+                        self.log.error("Database schema upgrade failed (%s)", sys.exc_info()[1])
+                        return
+
+                else:
+                    self.log.error("Don't know how to upgrade database schema %s", version)
+                    return
+
+                # Upgrade one version at a time until the schema is up to date
+                version = txn.execute("SELECT parm_value FROM common WHERE parm = 'schema_version'").fetchall()[0][0]
 
     def query_plugin_auth(self, authcode):
         return self.dbpool.runQuery("SELECT authcode, id from plugins WHERE authcode = '%s'" % authcode)
@@ -442,6 +544,23 @@ class Database():
                         
         returnValue(value_id)
 
+    def update_or_add_values(self, updates):
+        '''
+        This function updates or adds a batch of values to the HouseAgent database in one transaction.
+        @param updates: a list of (name, value, pluginid, address, time) tuples
+        
+        @return: a Twisted deferred which will callback with a list of value ids, in the order of the updates.
+                 The value id is '' when the device of an update does not exist.
+        '''
+        self.log.debug("Database::Writing %d value updates", len(updates))
+        return self.dbpool.runInteraction(self._update_or_add_values, updates)
+
+    def _update_or_add_values(self, txn, updates):
+        '''
+        Update or add a batch of values, this method has to be run within a runInteraction call.
+        '''
+        return write_values(txn, updates)
+
     def register_plugin(self, name, uuid, location):
         return self.dbpool.runQuery("INSERT INTO plugins (name, authcode, location_id) VALUES (?, ?, ?)", [str(name), str(uuid), location])
 
@@ -449,6 +568,31 @@ class Database():
         return self.dbpool.runQuery("SELECT plugins.name, plugins.authcode, plugins.id, locations.name, plugins.location_id from plugins " +
                                     "LEFT OUTER JOIN locations ON (plugins.location_id = locations.id)")
     
+    def query_plugin_limits(self):
+        return self.dbpool.runQuery("SELECT plugin_id, rate, burst, policy FROM plugin_limits")
+
+    def set_plugin_limit(self, plugin_id, rate, burst, policy):
+        '''
+        Set the value update rate limit of a plugin, a rate of 0 removes the limit.
+        @param plugin_id: the id of the plugin
+        @param rate: the number of value update messages per second
+        @param burst: the number of messages that may be sent at once
+        @param policy: what to do with messages over the limit, drop, coalesce or delay
+        '''
+        if not rate:
+            d = self.dbpool.runQuery("DELETE FROM plugin_limits WHERE plugin_id=?", [plugin_id])
+        else:
+            d = self.dbpool.runQuery("INSERT OR REPLACE INTO plugin_limits (plugin_id, rate, burst, policy) VALUES (?, ?, ?, ?)", 
+                                     [plugin_id, rate, burst, policy])
+        
+        # The coordinator applies the new limit right away
+        def limits_refresh(result):
+            if self.coordinator:
+                return self.coordinator.load_plugin_limits()
+        
+        d.addCallback(limits_refresh)
+        return d
+    
     def query_plugin_by_type_name(self, type_name):
         return self.dbpool.runQuery("SELECT plugins.id, plugins.authcode from plugins " +
                                     "INNER JOIN plugin_types ON (plugins.plugin_type_id = plugin_types.id)" +
@@ -543,6 +687,7 @@ class Database():
         yield self.dbpool.runQuery("DELETE FROM events where id=?", [id])
 
     def del_plugin(self, id):
+        self.dbpool.runQuery("DELETE FROM plugin_limits WHERE plugin_id=?", [id])
         return self.dbpool.runQuery("DELETE FROM plugins WHERE id=?", [id])
 
     def query_locations(self):
@@ -664,6 +809,37 @@ class Database():
         d.addCallback(histcollector_refresh, id, history_period)
         return d
     
+    def query_value_filters(self):
+        return self.dbpool.runQuery("SELECT devices.plugin_id, devices.address, current_values.name, value_filters.deadband, " +
+                                    "value_filters.deadband_type, value_filters.max_silence FROM value_filters " +
+                                    "INNER JOIN current_values ON (value_filters.value_id = current_values.id) " +
+                                    "INNER JOIN devices ON (current_values.device_id = devices.id)")
+
+    def query_value_filter_settings(self):
+        return self.dbpool.runQuery("SELECT value_id, deadband, deadband_type, max_silence FROM value_filters")
+
+    def set_value_filter(self, id, deadband, deadband_type, max_silence):
+        '''
+        Set the change-only filter settings of a value.
+        @param id: the id of the value
+        @param deadband: the deadband for numeric values, None removes the settings of the value
+        @param deadband_type: absolute or percent
+        @param max_silence: the maximum number of seconds between two stored updates, 0 for no maximum
+        '''
+        if deadband is None:
+            d = self.dbpool.runQuery("DELETE FROM value_filters WHERE value_id=?", [id])
+        else:
+            d = self.dbpool.runQuery("INSERT OR REPLACE INTO value_filters (value_id, deadband, deadband_type, max_silence) VALUES (?, ?, ?, ?)",
+                                     [id, deadband, deadband_type, max_silence])
+
+        # The coordinator filters with the new settings right away
+        def filters_refresh(result):
+            if self.coordinator:
+                return self.coordinator.load_value_filters()
+
+        d.addCallback(filters_refresh)
+        return d
+    
     def set_controltype(self, id, control_type):
         return self.dbpool.runQuery("UPDATE current_values SET control_type_id=? WHERE id=?", [control_type, id])
 
@@ -95,6 +95,21 @@ class DatabaseFlash(Database):
             self.curr_values.add_value(curr_val)
                         
         returnValue(value_id)
+
+    @inlineCallbacks
+    def update_or_add_values(self, updates):
+        '''
+        Overriden method
+        Values are kept in memory, so the batch is handled one value at a time.
+        
+        @param updates: a list of (name, value, pluginid, address, time) tuples
+        '''
+        value_ids = []
+        for name, value, pluginid, address, time in updates:
+            value_id = yield self.update_or_add_value(name, value, pluginid, address, time)
+            value_ids.append(value_id)
+        
+        returnValue(value_ids)
                
 
     def query_values(self):
@@ -15,6 +15,7 @@ class EventHandler(object):
         self.log = log
         self.db = database
         self._coordinator = coordinator
+        self._tracer = coordinator.tracer
         
         self._absolute_time_schedule_calls = []
         self._triggers = []
@@ -58,6 +59,8 @@ class EventHandler(object):
                     t.condition = param[1]
                 elif param[0] == "condition_value":
                     t.condition_value = param[1]
+                elif param[0] == "plugin":
+                    t.plugin = param[1]
             
             # Handle absolute time directly, and schedule. No need to keep track of this.
             if trigger[1] == "Absolute time":         
@@ -143,10 +146,10 @@ class EventHandler(object):
         self._load_triggers()
         self._load_actions()
         
-    @inlineCallbacks
-    def device_value_changed(self, value_id, value):
+    def device_value_changed(self, value_id, value, cid=None):
         '''
         Callback from the coordinator when a device value has been changed.
+        @param cid: the correlation id of the message that carried the value, when traced
         '''
         if not value_id:
             return
@@ -154,7 +157,7 @@ class EventHandler(object):
         for t in self._triggers:
 
             if t.type == "Device value change" and int(t.current_value_id) == int(value_id):
-                self.log.debug("Found trigger for this value {0}".format(t))
+                self._tracer.trace(cid, "Found trigger for this value %s", t)
                 
                 matching = True
                 
@@ -172,19 +175,44 @@ class EventHandler(object):
                         matching = False       
                         
                 if matching:
-                    # check conditions
-                    if t.conditions:           
-                        condition_check = yield self._check_conditions(t.event_id)
-                        
-                        if condition_check:
-                            self._run_actions(t.event_id)
-                        else:
-                            self.log.debug("Conditions do not match")
-                    else:
-                        # no conditions, just run the actions
-                        self._run_actions(t.event_id)
+                    self._trigger_matched(t, cid)
                 else:
-                    self.log.debug("Trigger does not match")      
+                    self._tracer.trace(cid, "Trigger does not match")      
+
+    def plugin_status_changed(self, plugin_guid, online):
+        '''
+        Callback from the coordinator when a plugin went online or offline.
+        Triggers of the "Plugin status change" type have a plugin parameter holding the plugin guid, 
+        and optionally a condition_value of "online" or "offline".
+        '''
+        if online:
+            status = "online"
+        else:
+            status = "offline"
+        
+        self.log.info("Plugin %s is %s", plugin_guid, status)
+        
+        for t in self._triggers:
+            if t.type == "Plugin status change" and t.plugin == plugin_guid and t.condition_value in (None, status):
+                self.log.debug("Found trigger for this plugin %s", t)
+                self._trigger_matched(t)
+
+    @inlineCallbacks
+    def _trigger_matched(self, t, cid=None):
+        '''
+        This function checks the conditions of a matching trigger, and runs the 
+        actions of the event when they match.
+        '''
+        if t.conditions:           
+            condition_check = yield self._check_conditions(t.event_id)
+            
+            if condition_check:
+                self._run_actions(t.event_id, cid)
+            else:
+                self._tracer.trace(cid, "Conditions do not match")
+        else:
+            # no conditions, just run the actions
+            self._run_actions(t.event_id, cid)
 
     @inlineCallbacks
     def _absolute_time_triggered(self, eventid, conditions):
@@ -205,22 +233,38 @@ class EventHandler(object):
             # no conditions, just run the actions
             self._run_actions(eventid)
             
-    def _run_actions(self, eventid):
+    def _run_actions(self, eventid, cid=None):
         '''
         This runs all the actions associated with a certain eventid.
+        @param cid: the correlation id of the message that caused the actions, when traced
         '''
-        self.log.debug("Running actions for eventid {0}".format(eventid))
+        self.log.debug("Running actions for eventid %s", eventid)
         for a in self._actions:
             if a.event_id == eventid:
-                self.log.debug("Executing action {0}".format(a))
+                if cid is not None:
+                    self._tracer.trace(cid, "Executing action %s", a)
+                else:
+                    self.log.debug("Executing action %s", a)
+                d = None
                 if a.type == "Device action" and a.control_type == "CONTROL_TYPE_ON_OFF" and int(a.command) == 1:
-                    self._coordinator.send_poweron(a.plugin_id, a.address, a.control_value_id)
+                    d = self._coordinator.send_poweron(a.plugin_id, a.address, a.control_value_id)
                 elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_ON_OFF" and int(a.command) == 0:
-                    self._coordinator.send_poweroff(a.plugin_id, a.address, a.control_value_id)
+                    d = self._coordinator.send_poweroff(a.plugin_id, a.address, a.control_value_id)
                 elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_THERMOSTAT":
-                    self._coordinator.send_thermostat_setpoint(a.plugin_id, a.address, a.command, a.control_value_id)
+                    d = self._coordinator.send_thermostat_setpoint(a.plugin_id, a.address, a.command, a.control_value_id)
                 elif a.type == "Device action" and a.control_type == "CONTROL_TYPE_DIMMER":
-                    self._coordinator.send_dim(a.plugin_id, a.address, a.command, a.control_value_id)
+                    d = self._coordinator.send_dim(a.plugin_id, a.address, a.command, a.control_value_id)
+                
+                if d is not None:
+                    d.addErrback(self._action_failed, a, cid)
+
+    def _action_failed(self, failure, action, cid=None):
+        '''
+        Called when an action could not be executed, for example because the plugin is offline or did not reply.
+        '''
+        self.log.error("Action %s failed: %s", action, failure.getErrorMessage())
+        if cid is not None:
+            self._tracer.trace(cid, "Action %s failed: %s", action, failure.getErrorMessage())
 
     @inlineCallbacks            
     def _check_conditions(self, eventid):
@@ -285,6 +329,7 @@ class Trigger(object):
         self.current_value_id = None
         self.condition = None
         self.condition_value = None
+        self.plugin = None
         
         # Only used for web page output
         self.device = None
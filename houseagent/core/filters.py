@@ -0,0 +1,123 @@
+'''
+Change-only filtering of value updates.
+
+Sensors tend to report the same value over and over again. The ValueFilter
+drops updates that don't change a value enough to matter before they cost a
+database write and a trigger scan in the event engine:
+
+- numeric values pass when they differ more than a deadband from the value
+  that passed last, either an absolute difference or a percentage of it
+- other values pass when they differ from the value that passed last
+- every value passes at least once per max silence interval, so the last
+  update time in the database doesn't go stale
+'''
+import time
+
+DEADBAND_TYPES = ('absolute', 'percent')
+
+class ValueFilter(object):
+    '''
+    This class filters redundant updates out of value updates.
+    '''
+
+    def __init__(self, log, enabled=False, deadband=0.0, deadband_type='absolute', max_silence=0):
+        '''
+        Initialize a new ValueFilter instance.
+        @param log: a reference to the HouseAgent logger
+        @param enabled: filter all values with the defaults below, when False only values with their own settings are filtered
+        @param deadband: the default deadband for numeric values
+        @param deadband_type: the default deadband type, absolute or percent
+        @param max_silence: the default maximum number of seconds between two updates that pass, 0 for no maximum
+        '''
+        self.log = log
+        self.enabled = enabled
+        self.default = (deadband, self._deadband_type(deadband_type, 'default'), max_silence)
+
+        # (plugin_id, address, name) -> (deadband, deadband type, max silence)
+        self._settings = {}
+
+        # (plugin_id, address, name) -> (value, time) of the last update that passed
+        self._last = {}
+
+        self.received = 0
+        self.suppressed = 0
+
+    def set_settings(self, settings):
+        '''
+        Set the filter settings of individual values.
+        @param settings: a list of (plugin_id, address, name, deadband, deadband_type, max_silence) tuples
+        '''
+        self._settings = dict(((plugin_id, address, name), 
+                               (deadband or 0.0, self._deadband_type(deadband_type, (plugin_id, address, name)), 
+                                max_silence or 0))
+                              for plugin_id, address, name, deadband, deadband_type, max_silence in settings)
+
+    def _deadband_type(self, deadband_type, key):
+        '''
+        Returns the deadband type when it is known, absolute otherwise.
+        '''
+        if deadband_type not in DEADBAND_TYPES:
+            self.log.warning("Filter::Unknown deadband type %r for %s, using absolute", deadband_type, key)
+            return 'absolute'
+
+        return deadband_type
+
+    def filter(self, plugin_id, address, values, now=None):
+        '''
+        Returns the values of an update that have to be stored.
+        @param plugin_id: the id of the plugin that sent the update
+        @param address: the address of the device
+        @param values: a dictionary of value names and values
+        @param now: the current time, defaults to time.time()
+
+        @return: a dictionary with the values that passed the filter, empty when nothing changed
+        '''
+        if now is None:
+            now = time.time()
+
+        passed = {}
+
+        for name, value in values.iteritems():
+            self.received += 1
+            key = (plugin_id, address, name)
+
+            settings = self._settings.get(key)
+            if settings is None:
+                if not self.enabled:
+                    passed[name] = value
+                    continue
+                settings = self.default
+
+            deadband, deadband_type, max_silence = settings
+            last = self._last.get(key)
+
+            if last is None or (max_silence and now - last[1] >= max_silence) or \
+               self._changed(last[0], value, deadband, deadband_type):
+                self._last[key] = (value, now)
+                passed[name] = value
+            else:
+                self.suppressed += 1
+
+        return passed
+
+    def _changed(self, old, new, deadband, deadband_type):
+        try:
+            old_number = float(old)
+            new_number = float(new)
+        except (TypeError, ValueError):
+            return old != new
+
+        if deadband_type == 'percent':
+            limit = abs(old_number) * deadband / 100.0
+        else:
+            limit = deadband
+
+        return abs(new_number - old_number) > limit
+
+    def stats(self):
+        '''
+        Returns a dictionary with filter statistics.
+        '''
+        return {'received': self.received,
+                'suppressed': self.suppressed,
+                'suppression_ratio': float(self.suppressed) / self.received if self.received else 0.0}
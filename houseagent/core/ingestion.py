@@ -0,0 +1,266 @@
+import time
+from twisted.internet import reactor, task, defer
+from houseagent.core.stats import Histogram
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+class ValueIngester(object):
+    '''
+    This class implements a write-behind stage between the coordinator and the database.
+    Decoded value updates are queued and coalesced per value, the latest update
+    for a value wins. Queued updates are committed to the database in a single
+    transaction every interval, or as soon as the batch size has been reached.
+    '''
+
+    def __init__(self, log, database, callback, interval=0.5, batch_size=500, tracer=None, journal=None, acked=None):
+        '''
+        Initialize a new ValueIngester instance.
+        @param log: a reference to the HouseAgent logger
+        @param database: an instance of the HouseAgent database
+        @param callback: function called as callback(value_id, value, cid) for every value after it has been committed
+        @param interval: the maximum time in seconds an update stays queued
+        @param batch_size: the number of queued values that triggers an immediate commit
+        @param tracer: a Tracer to trace updates with a correlation id through the commit
+        @param journal: a Journal to report committed journal entries to
+        @param acked: function called as acked(acks) after a commit, with the acks registered
+                      with ack() that the commit covers
+        '''
+        self.log = log
+        self.db = database
+        self.callback = callback
+        self.batch_size = batch_size
+        self.tracer = tracer
+        self.journal = journal
+        self.acked = acked
+
+        # (plugin_id, address, name) -> (value, time, time received, correlation id, journal sequence number)
+        self._pending = OrderedDict()
+        self._flushing = False
+        self._drained = []
+        self._drain_failed = False
+
+        # key -> highest ack, for the queued updates and for the commit in progress
+        self._acks = {}
+        self._flushing_acks = {}
+
+        # Statistics
+        self.received = 0
+        self.coalesced = 0
+        self.committed = 0
+        self.commits = 0
+        self.failed = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+        
+        # Time from receiving an update to its commit
+        self.update_latency = Histogram()
+
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(interval, False)
+
+        # Make sure queued updates reach the database when HouseAgent stops
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def put(self, plugin_id, address, values, timestamp, cid=None, seq=None):
+        '''
+        Queue a value update.
+        @param plugin_id: the id of the plugin that sent the update
+        @param address: the address of the device
+        @param values: a dictionary of value names and values
+        @param timestamp: the time at which the update has been received
+        @param cid: the correlation id of the message that carried the update, when traced
+        @param seq: the sequence number of the update in the journal, when journaled
+        '''
+        self._queue(plugin_id, address, values, timestamp, cid, seq)
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def put_many(self, plugin_id, updates, cid=None, seq=None):
+        '''
+        Queue a batch of value updates, the batch is committed in one transaction.
+        @param plugin_id: the id of the plugin that sent the updates
+        @param updates: a list of (address, values, time) tuples
+        @param cid: the correlation id of the message that carried the updates, when traced
+        @param seq: the sequence number of the updates in the journal, when journaled
+        '''
+        for address, values, timestamp in updates:
+            self._queue(plugin_id, address, values, timestamp, cid, seq)
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _queue(self, plugin_id, address, values, timestamp, cid, seq):
+        '''
+        Add the values of an update to the queue, replacing queued updates of the same values.
+        '''
+        received = time.time()
+        
+        for name in values:
+            key = (plugin_id, address, name)
+            if key in self._pending:
+                self.coalesced += 1
+
+            self._pending[key] = (values[name], timestamp, received, cid, seq)
+            self.received += 1
+
+    def ack(self, key, seq):
+        '''
+        Report an ack once everything queued so far has been committed.
+        Acks are cumulative, only the highest ack of a key per commit is reported.
+        @param key: the key of the ack, for example a plugin guid
+        @param seq: the sequence number to acknowledge
+        '''
+        if self._pending:
+            acks = self._acks
+        elif self._flushing:
+            acks = self._flushing_acks
+        else:
+            # Nothing waits for a commit
+            self.acked({key: seq})
+            return
+
+        if seq > acks.get(key, 0):
+            acks[key] = seq
+
+    def flush(self):
+        '''
+        Commit all queued updates to the database in one transaction.
+        Only one commit is in progress at any time, updates queued in the meantime
+        are picked up by the next flush.
+
+        @return: a Twisted deferred which fires when the commit is done, or None when there was nothing to do.
+        '''
+        if self._flushing or not self._pending:
+            return None
+
+        batch = self._pending
+        self._pending = OrderedDict()
+        self._flushing = True
+        acks, self._acks = self._acks, {}
+        self._flushing_acks = acks
+
+        updates = [(name, value, plugin_id, address, timestamp)
+                   for (plugin_id, address, name), (value, timestamp, received, cid, seq) in batch.iteritems()]
+        received = [entry[2] for entry in batch.itervalues()]
+        cids = [entry[3] for entry in batch.itervalues()]
+
+        # Everything journaled up to the newest entry in the batch is in the batch, or has been replaced by it
+        seq = max(entry[4] for entry in batch.itervalues())
+
+        d = self.db.update_or_add_values(updates)
+        d.addCallback(self._committed, updates, received, cids, seq, time.time(), acks)
+        d.addErrback(self._failed, batch)
+        d.addBoth(self._flushed)
+        return d
+
+    def _committed(self, value_ids, updates, received, cids, seq, started, acks):
+        '''
+        Called when a batch has been committed to the database.
+        '''
+        now = time.time()
+        latency = now - started
+        self.commits += 1
+        self.committed += len(updates)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self._total_latency += latency
+
+        for timestamp in received:
+            self.update_latency.record(now - timestamp)
+
+        if self.journal and seq is not None:
+            self.journal.commit(seq)
+
+        if acks:
+            self.acked(acks)
+
+        for value_id, update, cid in zip(value_ids, updates, cids):
+            if cid is not None:
+                self.tracer.trace(cid, "Ingestion::Committed %s=%r as value %s", update[0], update[1], value_id)
+            
+            self.callback(value_id, update[1], cid)
+
+    def _failed(self, failure, batch):
+        '''
+        Called when a batch could not be committed to the database.
+        The batch is queued again in front of the updates queued in the meantime, so no later
+        commit gets past it. Values with a newer update queued keep the newer update.
+        Acks waiting for the batch wait for the retry.
+        '''
+        self.failed += len(batch)
+        self.log.error("Ingestion::Failed to commit %d value updates, retrying: %s", len(batch), failure.getErrorMessage())
+
+        pending = OrderedDict((key, entry) for key, entry in batch.iteritems() if key not in self._pending)
+        pending.update(self._pending)
+        self._pending = pending
+
+        for key, seq in self._flushing_acks.iteritems():
+            if seq > self._acks.get(key, 0):
+                self._acks[key] = seq
+
+        # Don't keep retrying while stopping, the journal replays what is left on the next start
+        if self._drained:
+            self._drain_failed = True
+
+    def _flushed(self, result):
+        '''
+        Called when a flush has finished, successful or not.
+        '''
+        self._flushing = False
+        self._flushing_acks = {}
+
+        if self._drained:
+            self._drain()
+        elif len(self._pending) >= self.batch_size:
+            # Updates piled up during the commit
+            reactor.callLater(0, self.flush)
+
+    def _drain(self):
+        '''
+        Keep flushing until the queue is empty, then fire the deferreds waiting for it.
+        '''
+        if self._flushing:
+            return
+
+        if self._pending and not self._drain_failed:
+            self.flush()
+            return
+
+        self._drain_failed = False
+        waiting, self._drained = self._drained, []
+        for d in waiting:
+            d.callback(None)
+
+    def stop(self):
+        '''
+        Stop the periodic commits and commit whatever is still queued.
+        
+        @return: a Twisted deferred which fires when all queued updates have been handled.
+        '''
+        if self._loop.running:
+            self._loop.stop()
+
+        d = defer.Deferred()
+        self._drained.append(d)
+        self._drain()
+        return d
+
+    def stats(self):
+        '''
+        Returns a dictionary with ingestion statistics.
+        '''
+        return {'queue_depth': len(self._pending),
+                'received': self.received,
+                'coalesced': self.coalesced,
+                'committed': self.committed,
+                'commits': self.commits,
+                'failed': self.failed,
+                'commit_latency_last': self.last_latency,
+                'commit_latency_max': self.max_latency,
+                'commit_latency_avg': self._total_latency / self.commits if self.commits else 0.0,
+                'update_to_commit_latency': self.update_latency.snapshot()}
@@ -0,0 +1,249 @@
+'''
+Append-only journal of decoded value updates.
+
+Value updates wait in the ingester for a while before they are written to the
+database, a crash loses them. With the journal enabled every decoded update
+is appended to a journal first, the ingester reports which entries made it to
+the database. On startup the entries that never made it are replayed.
+
+The journal is a directory of segment files, one JSON entry per line:
+
+    [sequence number, time received, plugin id, [[address, values, time], ...]]
+
+A segment is named after the sequence number of its first entry. Writes are
+buffered and flushed every second, a new segment is started when the current
+one reaches the segment size. A checkpoint file holds the sequence number up
+to which everything has been committed, segments before the checkpoint are
+removed unless the journal is retained, for example to replay a day of
+traffic with tools/replay.py.
+'''
+import os
+import json
+import time
+from twisted.internet import reactor, task
+
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.log'
+CHECKPOINT = 'checkpoint'
+
+def segments(directory):
+    '''
+    Returns the segment files of a journal, in order.
+    @param directory: the journal directory
+    '''
+    names = [name for name in os.listdir(directory)
+             if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)]
+    names.sort()
+    return [os.path.join(directory, name) for name in names]
+
+def _first_seq(segment):
+    return int(os.path.basename(segment)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+def read_segment(segment):
+    '''
+    Read the entries of a segment file.
+    A partly written last entry, left behind by a crash, is skipped.
+    @param segment: the path of the segment file
+    '''
+    f = open(segment, 'rb')
+    try:
+        for line in f:
+            try:
+                seq, received, plugin_id, updates = json.loads(line)
+            except ValueError:
+                break
+            yield seq, received, plugin_id, updates
+    finally:
+        f.close()
+
+def read_journal(directory, after=0):
+    '''
+    Read the entries of a journal.
+    @param directory: the journal directory
+    @param after: only return entries with a sequence number above this one
+
+    @return: a generator of (seq, received, plugin_id, updates) tuples
+    '''
+    files = segments(directory)
+    for index, segment in enumerate(files):
+        # Skip segments that end before the requested entries
+        if index + 1 < len(files) and _first_seq(files[index + 1]) <= after + 1:
+            continue
+
+        for entry in read_segment(segment):
+            if entry[0] > after:
+                yield entry
+
+class Journal(object):
+    '''
+    This class writes the journal and keeps track of the checkpoint.
+    '''
+
+    def __init__(self, log, directory, segment_size=16 * 1024 * 1024, flush_interval=1.0, retain=False, sync=False):
+        '''
+        Initialize a new Journal instance.
+        @param log: a reference to the HouseAgent logger
+        @param directory: the journal directory, created when it doesn't exist
+        @param segment_size: the size in bytes at which a new segment is started
+        @param flush_interval: the interval in seconds at which writes are flushed
+        @param retain: keep segments after they have been committed
+        @param sync: also sync flushed writes to disk, slower but survives a power failure
+        '''
+        self.log = log
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retain = retain
+        self.sync = sync
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.checkpointed = self._read_checkpoint()
+        self._written_checkpoint = self.checkpointed
+        self.seq = max(self.checkpointed, self._last_seq())
+
+        self._file = None
+        self._size = 0
+
+        self.appended = 0
+        self.replayed = 0
+
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(flush_interval, False)
+
+        # The ingester commits what it has queued before shutdown, close after that
+        reactor.addSystemEventTrigger('after', 'shutdown', self.close)
+
+    def _read_checkpoint(self):
+        try:
+            f = open(os.path.join(self.directory, CHECKPOINT), 'rb')
+            try:
+                return int(f.read().strip() or 0)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return 0
+
+    def _write_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT)
+        f = open(path + '.tmp', 'wb')
+        f.write(str(self.checkpointed))
+        f.close()
+
+        # Replace the checkpoint in one go, rename doesn't replace an existing file on Windows
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+        self._written_checkpoint = self.checkpointed
+
+    def _last_seq(self):
+        files = segments(self.directory)
+        if not files:
+            return 0
+
+        seq = _first_seq(files[-1]) - 1
+        for entry in read_segment(files[-1]):
+            seq = entry[0]
+        return seq
+
+    def append(self, plugin_id, updates, received=None):
+        '''
+        Append decoded value updates to the journal.
+        @param plugin_id: the id of the plugin that sent the updates
+        @param updates: a list of (address, values, time) tuples
+        @param received: the time the updates have been received, defaults to now
+
+        @return: the sequence number of the entry
+        '''
+        self.seq += 1
+        line = json.dumps([self.seq, received or time.time(), plugin_id, updates]) + '\n'
+
+        if self._file is None or self._size >= self.segment_size:
+            self._rotate()
+
+        self._file.write(line)
+        self._size += len(line)
+        self.appended += 1
+        return self.seq
+
+    def _rotate(self):
+        '''
+        Close the current segment and start a new one.
+        '''
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+
+        name = '%s%012d%s' % (SEGMENT_PREFIX, self.seq, SEGMENT_SUFFIX)
+        self._file = open(os.path.join(self.directory, name), 'ab', 65536)
+        self._size = 0
+
+    def commit(self, seq):
+        '''
+        Mark all entries up to a sequence number as committed to the database.
+        @param seq: the sequence number
+        '''
+        if seq > self.checkpointed:
+            self.checkpointed = seq
+
+    def flush(self):
+        '''
+        Flush buffered writes, write the checkpoint and remove committed segments.
+        '''
+        if self._file is not None:
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+
+        if self.checkpointed != self._written_checkpoint:
+            self._write_checkpoint()
+
+            if not self.retain:
+                self._remove_committed()
+
+    def _remove_committed(self):
+        files = segments(self.directory)
+
+        # A segment is done when the next one starts at or before the checkpoint, the last one is never done
+        for segment, next_segment in zip(files, files[1:]):
+            if _first_seq(next_segment) - 1 <= self.checkpointed:
+                os.remove(segment)
+
+    def recover(self, callback):
+        '''
+        Replay the entries that have not been committed to the database.
+        @param callback: function called as callback(seq, received, plugin_id, updates) for every entry
+
+        @return: the number of replayed entries
+        '''
+        count = 0
+        for seq, received, plugin_id, updates in read_journal(self.directory, self.checkpointed):
+            callback(seq, received, plugin_id, updates)
+            count += 1
+
+        self.replayed += count
+        if count:
+            self.log.info("Journal::Replayed %d uncommitted entries", count)
+        return count
+
+    def close(self):
+        '''
+        Flush and close the journal.
+        '''
+        if self._loop.running:
+            self._loop.stop()
+
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        '''
+        Returns a dictionary with journal statistics.
+        '''
+        return {'seq': self.seq,
+                'checkpoint': self.checkpointed,
+                'appended': self.appended,
+                'replayed': self.replayed,
+                'segments': len(segments(self.directory))}
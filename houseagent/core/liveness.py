@@ -0,0 +1,128 @@
+import math
+import time
+from twisted.internet import task
+
+class TimerWheel(object):
+    '''
+    A hashed timer wheel.
+    Scheduling, rescheduling and cancelling a deadline are O(1), which matters
+    because every heartbeat of every plugin reschedules its deadline. Expiring
+    only looks at the slots of the ticks that passed since the last call.
+    Deadlines further away than one rotation of the wheel simply stay in their
+    slot until a later rotation.
+    '''
+
+    def __init__(self, tick=1.0, slots=512, now=None):
+        '''
+        Initialize a new TimerWheel instance.
+        @param tick: the resolution of the wheel in seconds
+        @param slots: the number of slots of the wheel
+        @param now: the current time, defaults to time.time()
+        '''
+        self.tick = tick
+        self._slots = [{} for i in range(slots)]
+        self._where = {}
+        self._last_tick = int((now or time.time()) // tick)
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, deadline):
+        '''
+        Schedule a deadline for key, replacing any deadline scheduled before.
+        @param key: the key
+        @param deadline: the time at which the key expires
+        '''
+        self.cancel(key)
+
+        # The first tick at or after the deadline, but never a tick that has been processed already
+        tick = max(int(math.ceil(deadline / self.tick)), self._last_tick + 1)
+        slot = tick % len(self._slots)
+
+        self._slots[slot][key] = deadline
+        self._where[key] = slot
+
+    def cancel(self, key):
+        '''
+        Cancel the deadline of key, if any.
+        @param key: the key
+        '''
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def expire(self, now=None):
+        '''
+        Remove and return the keys whose deadline has passed.
+        @param now: the current time, defaults to time.time()
+
+        @return: a list of expired keys
+        '''
+        if now is None:
+            now = time.time()
+
+        current = int(now // self.tick)
+
+        # After a full rotation every slot has been visited
+        ticks = min(current - self._last_tick, len(self._slots))
+
+        expired = []
+        for tick in range(current - ticks + 1, current + 1):
+            slot = self._slots[tick % len(self._slots)]
+            for key, deadline in slot.items():
+                if deadline <= now:
+                    del slot[key]
+                    del self._where[key]
+                    expired.append(key)
+
+        self._last_tick = max(current, self._last_tick)
+        return expired
+
+class LivenessMonitor(object):
+    '''
+    This class keeps track of the plugins that are alive.
+    Each time a plugin shows a sign of life its deadline is pushed forward,
+    plugins that miss their deadline are reported as expired.
+    '''
+
+    def __init__(self, timeout, callback, tick=1.0):
+        '''
+        Initialize a new LivenessMonitor instance.
+        @param timeout: the default number of seconds a plugin stays alive without a sign of life
+        @param callback: function called as callback(guid) when a plugin expires
+        @param tick: how often to check for expired plugins, in seconds
+        '''
+        self.timeout = timeout
+        self.callback = callback
+        self.wheel = TimerWheel(tick)
+
+        self._loop = task.LoopingCall(self.sweep)
+        self._loop.start(tick, False)
+
+    def alive(self, guid, timeout=None):
+        '''
+        Register a sign of life of a plugin.
+        @param guid: the guid of the plugin
+        @param timeout: seconds until the plugin expires, defaults to the monitor timeout
+        '''
+        if timeout is None:
+            timeout = self.timeout
+
+        self.wheel.schedule(guid, time.time() + timeout)
+
+    def forget(self, guid):
+        '''
+        Stop monitoring a plugin.
+        @param guid: the guid of the plugin
+        '''
+        self.wheel.cancel(guid)
+
+    def sweep(self):
+        '''
+        Report the plugins that missed their deadline.
+        '''
+        for guid in self.wheel.expire():
+            self.callback(guid)
@@ -0,0 +1,144 @@
+'''
+Cheap in-process counters and histograms for the broker and coordinator.
+Nothing in here does I/O, a snapshot is taken on request (see Coordinator.stats()).
+'''
+import time
+from bisect import bisect_left
+
+def percentile(values, pct):
+    '''
+    Returns the nearest-rank percentile of a sorted list of values, None for an empty list.
+    @param values: a sorted list of values
+    @param pct: the percentile, between 0 and 100
+    '''
+    if not values:
+        return None
+
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+class Histogram(object):
+    '''
+    A histogram of durations in seconds with fixed bucket boundaries.
+    '''
+    bounds = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        '''
+        Add a duration to the histogram.
+        @param value: the duration in seconds
+        '''
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        '''
+        Returns a dictionary representation of the histogram.
+        '''
+        buckets = {}
+        for bound, count in zip(self.bounds, self.buckets):
+            buckets['<=%g' % bound] = count
+        buckets['>%g' % self.bounds[-1]] = self.buckets[-1]
+
+        return {'count': self.count,
+                'avg': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'buckets': buckets}
+
+class BrokerStats(object):
+    '''
+    Message counters for the broker, per message type and per plugin.
+    '''
+    names = {'\x01': 'ready',
+             '\x02': 'heartbeat',
+             '\x03': 'value_update',
+             '\x05': 'rpc_reply',
+             '\x08': 'value_update_many'}
+
+    def __init__(self):
+        self.started = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.unhandled = 0
+        self.invalid = 0
+        self.messages = {}
+        self.plugins = {}
+        self.handlers = {}
+
+    def _plugin(self, guid):
+        try:
+            return self.plugins[guid]
+        except KeyError:
+            counters = self.plugins[guid] = {'messages': 0, 'bytes_in': 0, 'bytes_out': 0, 'value_updates': 0, 'invalid': 0}
+            return counters
+
+    def message_in(self, type, guid, size):
+        '''
+        Count a received message.
+        @param type: the message type byte
+        @param guid: the guid of the sending plugin, None when unknown
+        @param size: the size of the message in bytes
+        '''
+        self.messages[type] = self.messages.get(type, 0) + 1
+        self.bytes_in += size
+
+        counters = self._plugin(guid)
+        counters['messages'] += 1
+        counters['bytes_in'] += size
+        if type == '\x03' or type == '\x08':
+            counters['value_updates'] += 1
+
+    def message_out(self, guid, size):
+        '''
+        Count a sent message.
+        @param guid: the guid of the receiving plugin, None when unknown
+        @param size: the size of the message in bytes
+        '''
+        self.bytes_out += size
+        self._plugin(guid)['bytes_out'] += size
+
+    def invalid_message(self, guid):
+        '''
+        Count a received message that could not be decoded and has been dropped.
+        @param guid: the guid of the sending plugin
+        '''
+        self.invalid += 1
+        self._plugin(guid)['invalid'] += 1
+
+    def handled(self, type, duration):
+        '''
+        Record the time it took to handle a message.
+        @param type: the message type byte
+        @param duration: the handling time in seconds
+        '''
+        try:
+            histogram = self.handlers[type]
+        except KeyError:
+            histogram = self.handlers[type] = Histogram()
+
+        histogram.record(duration)
+
+    def _name(self, type):
+        return self.names.get(type, repr(type))
+
+    def snapshot(self):
+        '''
+        Returns a dictionary with all counters.
+        '''
+        return {'uptime': time.time() - self.started,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'unhandled': self.unhandled,
+                'invalid': self.invalid,
+                'messages': dict((self._name(type), count) for type, count in self.messages.iteritems()),
+                'plugins': dict((guid or 'unknown', dict(counters)) for guid, counters in self.plugins.iteritems()),
+                'handlers': dict((self._name(type), histogram.snapshot()) for type, histogram in self.handlers.iteritems())}
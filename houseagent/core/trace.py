@@ -0,0 +1,52 @@
+'''
+Tracing of messages on the broker hot path.
+
+Every frame received by the broker can be given a correlation id, which is 
+carried along through the database write up to the actions dispatched by the
+event engine, so the trace lines of one message can be picked out of the log.
+Tracing costs next to nothing when debug logging is off: no correlation id is
+handed out and trace messages are never formatted.
+'''
+
+class Tracer(object):
+    '''
+    Hands out correlation ids and writes trace lines for sampled messages.
+    '''
+
+    def __init__(self, log, sample=1):
+        '''
+        Initialize a new Tracer instance.
+        @param log: a reference to the HouseAgent logger
+        @param sample: trace 1 in sample messages
+        '''
+        self.log = log
+        self.sample = max(1, sample)
+        self.current = None
+        self._count = 0
+
+    def begin(self):
+        '''
+        Start tracing a new message, the correlation id is also available as Tracer.current 
+        while the message is being dispatched.
+        
+        @return: a correlation id, or None when the message is not traced.
+        '''
+        self._count += 1
+
+        if self._count % self.sample or not self.log.debug_enabled():
+            self.current = None
+        else:
+            self.current = self._count
+
+        return self.current
+
+    def trace(self, cid, message, *args):
+        '''
+        Write a trace line for a message. Formatting is deferred to the logging system,
+        nothing happens for messages that are not traced.
+        @param cid: the correlation id of the message, None when not traced
+        @param message: the log message, a format string for args
+        @param args: the arguments of the format string
+        '''
+        if cid is not None:
+            self.log.debug("[%s] " + message, cid, *args)
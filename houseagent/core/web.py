@@ -17,6 +17,8 @@ from twisted.web.server import NOT_DONE_YET
 from uuid import uuid4
 from twisted.web import http, resource
 from houseagent.core.history import HistoryViewer
+from houseagent.core.admission import POLICIES
+from houseagent.core.filters import DEADBAND_TYPES
             
 class Web(object):
     '''
@@ -84,6 +86,15 @@ class Web(object):
         root.putChild("graph_latest", GraphLatest(self.db))
         root.putChild("graph_daily", GraphDaily(self.db))
 
+        # Broker statistics
+        root.putChild("stats", Stats(self.coordinator))
+        
+        # Bulk commands
+        root.putChild("scene", Scene(self.coordinator))
+        
+        # Plugin callback timings
+        root.putChild("profile", Profile(self.coordinator))
+
         # Static files
         root.putChild("css", File(os.path.join(houseagent.template_dir, 'css')))
         root.putChild("js", File(os.path.join(houseagent.template_dir, 'js')))
@@ -268,9 +279,14 @@ class Plugin(Resource):
         self.location = location
         self.parent = parent
         self.status = False
+        self.last_seen = None
+        self.rate = None
+        self.burst = None
+        self.policy = None
         
     def json(self):
-        return {'id': self.id, 'name': self.name, 'authcode': self.authcode, 'location': self.location, 'status': self.status}
+        return {'id': self.id, 'name': self.name, 'authcode': self.authcode, 'location': self.location, 'status': self.status,
+                'last_seen': self.last_seen, 'rate': self.rate, 'burst': self.burst, 'policy': self.policy}
     
     def render_GET(self, request):
         return json.dumps(self.json())
@@ -292,9 +308,10 @@ class Plugins(HouseAgentREST):
         '''
         output = []
         for obj in self._objects:
-            for p in self.coordinator.plugins:
-                if p.guid == obj.authcode:
-                    obj.status = p.online            
+            p = self.coordinator.plugin_by_guid(obj.authcode)
+            if p:
+                obj.status = p.online
+                obj.last_seen = p.time
             
             output.append(obj.json())
 
@@ -307,9 +324,13 @@ class Plugins(HouseAgentREST):
         '''
         self._objects = []
         plugin_query = yield self.db.query_plugins()
+        limit_query = yield self.db.query_plugin_limits()
+        limits = dict((limit[0], limit[1:]) for limit in limit_query)
         
         for plugin in plugin_query:
             plug = Plugin(plugin[2], plugin[0], plugin[1], plugin[3], self)
+            if plugin[2] in limits:
+                plug.rate, plug.burst, plug.policy = limits[plugin[2]]
             self._objects.append(plug)
     
     @inlineCallbacks
@@ -321,6 +342,7 @@ class Plugins(HouseAgentREST):
             
         uuid = uuid4()    
         yield self.db.register_plugin(parameters['name'][0], uuid, location)
+        yield self.coordinator.load_plugins()
         self._reload()
         self._done()
     
@@ -331,13 +353,33 @@ class Plugins(HouseAgentREST):
         except KeyError:
             location = None
         
+        # An empty rate removes the value update rate limit of the plugin
+        limit = None
+        if 'rate' in parameters:
+            try:
+                rate = float(parameters['rate'][0] or 0)
+                burst = int(parameters.get('burst', [''])[0] or 1)
+                policy = parameters.get('policy', ['drop'])[0]
+                if rate < 0 or burst < 1 or policy not in POLICIES:
+                    raise ValueError("rate must be positive, burst at least 1 and policy one of %s" % ', '.join(POLICIES))
+            except ValueError as e:
+                self.request.setResponseCode(http.BAD_REQUEST)
+                self.request.write("Invalid limit: %s" % e)
+                self._done()
+                return
+            limit = (rate, burst, policy)
+        
         yield self.db.update_plugin(parameters['id'][0], parameters['name'][0], location)
+        if limit:
+            yield self.db.set_plugin_limit(int(parameters['id'][0]), *limit)
+        yield self.coordinator.load_plugins()
         self._reload()
         self._done()
     
     @inlineCallbacks
     def delete(self, obj):
         yield self.db.del_plugin(int(obj.id))
+        yield self.coordinator.load_plugins()
         self._objects.remove(obj)
         obj.request.finish()
         
@@ -431,11 +473,15 @@ class Value(Resource):
         self.plugin_id = plugin_id
         self.label = label
         self.parent = parent
+        self.deadband = None
+        self.deadband_type = None
+        self.max_silence = None
         
     def json(self):
         return {'id': self.id, 'name': self.name, 'value': self.value, 'device': self.device, 'device_address': self.device_address,
                 'location': self.location, 'plugin': self.plugin, 'lastupdate': self.lastupdate, 'history_type': self.history_type,
-                'control_type': self.control_type, 'history_period': self.history_period, 'plugin_id': self.plugin_id, 'label': self.label}
+                'control_type': self.control_type, 'history_period': self.history_period, 'plugin_id': self.plugin_id, 'label': self.label,
+                'deadband': self.deadband, 'deadband_type': self.deadband_type, 'max_silence': self.max_silence}
     
     def render_GET(self, request):
         return json.dumps(self.json())
@@ -462,16 +508,29 @@ class ValueActionResult(Resource):
             request.write(str(result))
             request.finish()
         
+        def control_failed(failure):
+            if failure.check(defer.CancelledError):
+                return # client went away
+            
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            request.write(failure.getErrorMessage())
+            request.finish()
+        
         plugin_guid = self.coordinator.plugin_guid_by_id(self.plugin_id)
         
         if self.action == 'poweron':
-            self.coordinator.send_poweron(plugin_guid, self.device_address, self.value_id).addCallback(control_result)
+            d = self.coordinator.send_poweron(plugin_guid, self.device_address, self.value_id)
         elif self.action == 'poweroff':
-            self.coordinator.send_poweroff(plugin_guid, self.device_address, self.value_id).addCallback(control_result)
+            d = self.coordinator.send_poweroff(plugin_guid, self.device_address, self.value_id)
         elif self.action == 'dim':
-            self.coordinator.send_dim(plugin_guid, self.device_address, self.params["level"], self.value_id).addCallback(control_result)
+            d = self.coordinator.send_dim(plugin_guid, self.device_address, self.params["level"], self.value_id)
         elif self.action == 'thermostat_setpoint':
-            self.coordinator.send_thermostat_setpoint(plugin_guid, self.device_address, self.params["temp"], self.value_id).addCallback(control_result)
+            d = self.coordinator.send_thermostat_setpoint(plugin_guid, self.device_address, self.params["temp"], self.value_id)
+        
+        d.addCallbacks(control_result, control_failed)
+        
+        # Stop waiting for the plugin when the client disconnects
+        request.notifyFinish().addErrback(lambda _: d.cancel())
         return NOT_DONE_YET
     
 class Values(HouseAgentREST):
@@ -504,15 +563,39 @@ class Values(HouseAgentREST):
         '''
         self._objects = []
         value_query = yield self.db.query_values()
+        filter_query = yield self.db.query_value_filter_settings()
+        filters = dict((setting[0], setting[1:]) for setting in filter_query)
         
         for value in value_query:
             val = Value(value[7], value[0], value[1], value[2], value[5], value[6], value[4], value[3], value[10], value[11], value[8], value[12], value[13], self)
+            if val.id in filters:
+                val.deadband, val.deadband_type, val.max_silence = filters[val.id]
             self._objects.append(val)
     
     @inlineCallbacks
-    def _edit(self, parameters):       
+    def _edit(self, parameters):
+        # An empty deadband removes the filter settings of the value
+        value_filter = None
+        if 'deadband' in parameters:
+            try:
+                deadband = parameters['deadband'][0]
+                deadband = float(deadband) if deadband else None
+                deadband_type = parameters.get('deadband_type', ['absolute'])[0]
+                max_silence = int(parameters.get('max_silence', [''])[0] or 0)
+                if (deadband is not None and deadband < 0) or max_silence < 0 or deadband_type not in DEADBAND_TYPES:
+                    raise ValueError("deadband and max silence can't be negative, deadband type is one of %s" % 
+                                     ', '.join(DEADBAND_TYPES))
+            except ValueError as e:
+                self.request.setResponseCode(http.BAD_REQUEST)
+                self.request.write("Invalid filter: %s" % e)
+                self._done()
+                return
+            value_filter = (deadband, deadband_type, max_silence)
+        
         yield self.db.save_value(parameters['label'][0], parameters['history_type'][0], parameters['history_period'][0], 
                                   parameters['control_type'][0], parameters['id'][0])
+        if value_filter:
+            yield self.db.set_value_filter(int(parameters['id'][0]), *value_filter)
 
         self._reload()
         self._done()
@@ -667,9 +750,10 @@ class Event_create(Resource):
         triggertypes = yield self.db.query_triggertypes()
         devs = yield self.db.query_devices_simple()
         conditiontypes = yield self.db.query_conditiontypes()
+        plugins = yield self.db.query_plugins()
         
         self.request.write(str(template.render(trigger_types=triggertypes, devices=devs, action_types=result,
-                                               condition_types=conditiontypes))) 
+                                               condition_types=conditiontypes, plugins=plugins))) 
         self.request.finish()            
     
     def render_GET(self, request):
@@ -1054,6 +1138,10 @@ class Events(Resource):
             events.append(e)
         
         trigger_query = yield self.db.query_triggers()
+        
+        # Plugin status change triggers refer to the plugin by guid
+        plugins = yield self.db.query_plugins()
+        plugin_names = dict((plugin[1], plugin[0]) for plugin in plugins)
 
         for trigger in trigger_query:   
             t = Trigger(trigger[1], trigger[2], trigger[3])
@@ -1082,6 +1170,8 @@ class Events(Resource):
                     t.condition = conditions[param[1]]
                 elif param[0] == "condition_value":
                     t.condition_value = param[1]
+                elif param[0] == "plugin":
+                    t.plugin = plugin_names.get(param[1], param[1])
                     
             if t.type == "Device value change":
                 extra = yield self.db.query_extra_valueinfo(t.current_value_id)
@@ -1159,6 +1249,94 @@ class Events(Resource):
         self.db.query_events().addCallback(self.result)
         return NOT_DONE_YET
     
+class Stats(Resource):
+    '''
+    Returns a JSON snapshot of the coordinator statistics.
+    '''
+    def __init__(self, coordinator):
+        Resource.__init__(self)
+        self.coordinator = coordinator
+    
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.coordinator.stats())
+
+class Profile(Resource):
+    '''
+    Returns the timings of the command callbacks of the plugins that keep them, as JSON.
+    With a plugin_id argument only the timings of that plugin are returned.
+    '''
+    def __init__(self, coordinator):
+        Resource.__init__(self)
+        self.coordinator = coordinator
+    
+    def render_GET(self, request):
+        if 'plugin_id' in request.args:
+            try:
+                plugin_id = int(request.args['plugin_id'][0])
+            except ValueError:
+                request.setResponseCode(http.BAD_REQUEST)
+                return "Invalid plugin_id"
+            
+            plugin_guid = self.coordinator.plugin_guid_by_id(plugin_id)
+            if not plugin_guid:
+                request.setResponseCode(http.NOT_FOUND)
+                return "Unknown plugin"
+            d = self.coordinator.query_profile(plugin_guid)
+        else:
+            d = self.coordinator.query_profiles()
+        
+        def profile_done(result):
+            request.setHeader('Content-Type', 'application/json')
+            request.write(json.dumps(result))
+            request.finish()
+        
+        def profile_failed(failure):
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            request.write(failure.getErrorMessage())
+            request.finish()
+        
+        d.addCallbacks(profile_done, profile_failed)
+        return NOT_DONE_YET
+
+class Scene(Resource):
+    '''
+    Sends a batch of commands in one request, for example to switch off a whole floor.
+    Expects a JSON body: {"items": [{"plugin_id": .., "address": .., "command": .., "value_id": .., 
+    "level": .., "temperature": ..}, ..], "concurrency": ..}, returns the result of each command.
+    '''
+    def __init__(self, coordinator):
+        Resource.__init__(self)
+        self.coordinator = coordinator
+    
+    def render_POST(self, request):
+        try:
+            scene = json.loads(request.content.read())
+            items = []
+            for item in scene['items']:
+                command = dict((key, item[key]) for key in ('value_id', 'level', 'temperature') if key in item)
+                command['type'] = item['command']
+                plugin_guid = item.get('plugin_guid') or self.coordinator.plugin_guid_by_id(item['plugin_id'])
+                items.append((plugin_guid, item['address'], command))
+            
+            concurrency = scene.get('concurrency', 4)
+            if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+                raise ValueError("concurrency must be a positive integer")
+        except (ValueError, KeyError, TypeError) as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return "Invalid scene: %s" % e
+        
+        started = datetime.datetime.now()
+        
+        def scene_done(results):
+            request.setHeader('Content-Type', 'application/json')
+            request.write(json.dumps({'results': results, 
+                                      'duration': (datetime.datetime.now() - started).total_seconds()}))
+            request.finish()
+        
+        self.coordinator.send_bulk(items, concurrency).addCallback(scene_done)
+        return NOT_DONE_YET
+
 class Event_del(Resource):
     '''
     Class that handles deletion of events from the database.
@@ -0,0 +1,320 @@
+'''
+Worker processes that take value updates off the coordinator's reactor.
+
+In worker mode the broker only routes frames, value updates are handed to
+one of N worker processes which decode, coalesce and write them to the
+database in batches. The worker is picked by a consistent hash of the plugin
+GUID, all updates of a plugin go to the same worker so they are applied in
+order. Workers report the values they committed back to the coordinator,
+which feeds them to the event engine as usual.
+'''
+import json
+import time
+import sqlite3
+import multiprocessing
+import zmq
+from bisect import bisect
+from hashlib import md5
+from txzmq import ZmqFactory, ZmqEndpoint, ZmqEndpointType, ZmqConnection
+from twisted.internet import reactor, defer
+from zmq.core import constants
+from houseagent.core.database import write_values
+from houseagent.utils.encoding import decode_value_update, decode_value_updates
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+STOP = '\x00'
+
+class HashRing(object):
+    '''
+    A consistent hash ring.
+    Each node is placed on the ring a number of times (replicas) to spread the keys evenly,
+    adding or removing a node only moves the keys of that node.
+    '''
+
+    def __init__(self, nodes, replicas=64):
+        '''
+        Initialize a new HashRing instance.
+        @param nodes: the nodes on the ring
+        @param replicas: the number of points per node on the ring
+        '''
+        ring = []
+        for node in nodes:
+            for replica in range(replicas):
+                ring.append((self._hash('%s-%d' % (node, replica)), node))
+        ring.sort()
+
+        self._points = [point for point, node in ring]
+        self._nodes = [node for point, node in ring]
+        self._cache = {}
+
+    def _hash(self, key):
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def node(self, key):
+        '''
+        Returns the node a key belongs to.
+        @param key: the key, for example a plugin guid
+        '''
+        try:
+            return self._cache[key]
+        except KeyError:
+            index = bisect(self._points, self._hash(key)) % len(self._points)
+            node = self._cache[key] = self._nodes[index]
+            return node
+
+class ShardWorker(object):
+    '''
+    The work done by a worker process, without the sockets.
+    Updates are coalesced per value like the ValueIngester does, the latest update for a value wins.
+    '''
+
+    def __init__(self, connection):
+        '''
+        Initialize a new ShardWorker instance.
+        @param connection: a DB-API connection to the HouseAgent database
+        '''
+        self.connection = connection
+        self.pending = OrderedDict()
+        self.received = 0
+        self.coalesced = 0
+        self.committed = 0
+        self.errors = 0
+
+    def handle(self, frames):
+        '''
+        Decode and queue a value update.
+        @param frames: the frames sent by the WorkerPool, [type, plugin id, encoding, data]
+        '''
+        type, plugin_id, encoding, data = frames
+        try:
+            if type == '\x08':
+                updates = decode_value_updates(encoding, data)
+            else:
+                updates = [decode_value_update(encoding, data)]
+        except Exception:
+            self.errors += 1
+            return
+
+        for address, values, timestamp in updates:
+            for name in values:
+                key = (int(plugin_id), address, name)
+                if key in self.pending:
+                    self.coalesced += 1
+
+                self.pending[key] = (values[name], timestamp)
+                self.received += 1
+
+    def flush(self):
+        '''
+        Write all queued updates to the database in one transaction.
+
+        @return: a list of (value_id, value) tuples of the committed values
+        '''
+        if not self.pending:
+            return []
+
+        batch, self.pending = self.pending, OrderedDict()
+        updates = [(name, value, plugin_id, address, timestamp)
+                   for (plugin_id, address, name), (value, timestamp) in batch.iteritems()]
+
+        try:
+            value_ids = write_values(self.connection.cursor(), updates)
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+            self.errors += len(updates)
+            return []
+
+        self.committed += len(updates)
+        return [(value_id, update[1]) for value_id, update in zip(value_ids, updates)]
+
+    def stats(self):
+        return {'received': self.received,
+                'coalesced': self.coalesced,
+                'committed': self.committed,
+                'errors': self.errors}
+
+def run_worker(index, jobs_endpoint, results_endpoint, db_location, interval=0.5, batch_size=500):
+    '''
+    The main loop of a worker process.
+    @param index: the number of the worker
+    @param jobs_endpoint: the endpoint to receive value updates on
+    @param results_endpoint: the endpoint to report committed values to
+    @param db_location: the location of the HouseAgent database
+    @param interval: the maximum time in seconds an update stays queued
+    @param batch_size: the number of queued values that triggers an immediate commit
+    '''
+    context = zmq.Context()
+    jobs = context.socket(zmq.PULL)
+    jobs.connect(jobs_endpoint)
+    results = context.socket(zmq.PUSH)
+    results.connect(results_endpoint)
+
+    # The coordinator writes to the same database, wait for its locks instead of failing
+    worker = ShardWorker(sqlite3.connect(db_location, timeout=30))
+
+    def report(values):
+        if values:
+            message = worker.stats()
+            message['worker'] = index
+            message['values'] = values
+            results.send_multipart(['\x03', json.dumps(message)])
+
+    poller = zmq.Poller()
+    poller.register(jobs, zmq.POLLIN)
+    next_flush = time.time() + interval
+
+    while True:
+        if poller.poll(max(0, next_flush - time.time()) * 1000):
+            frames = jobs.recv_multipart()
+            if frames[0] == STOP:
+                report(worker.flush())
+                results.send_multipart([STOP, str(index)])
+                break
+
+            worker.handle(frames)
+            if len(worker.pending) >= batch_size:
+                report(worker.flush())
+
+        if time.time() >= next_flush:
+            report(worker.flush())
+            next_flush = time.time() + interval
+
+    jobs.close()
+    results.close(linger=1000)
+    context.term()
+
+class WorkerConnection(ZmqConnection):
+    '''
+    Sends value updates to one worker process.
+    '''
+    socketType = constants.PUSH
+
+class ResultConnection(ZmqConnection):
+    '''
+    Receives the committed values of all worker processes.
+    '''
+    socketType = constants.PULL
+
+    def __init__(self, factory, pool, *endpoints):
+        ZmqConnection.__init__(self, factory, *endpoints)
+        self.pool = pool
+
+    def messageReceived(self, msg):
+        self.pool.handle_result(msg)
+
+class WorkerPool(object):
+    '''
+    This class starts the worker processes and hands them value updates.
+    '''
+
+    def __init__(self, log, callback, count, db_location, port=13010, interval=0.5, batch_size=500, factory=None):
+        '''
+        Initialize a new WorkerPool instance.
+        @param log: a reference to the HouseAgent logger
+        @param callback: function called as callback(value_id, value) for every value committed by a worker
+        @param count: the number of worker processes
+        @param db_location: the location of the HouseAgent database
+        @param port: the first of count + 1 local ports used to talk to the workers
+        @param interval: the maximum time in seconds an update stays queued in a worker
+        @param batch_size: the number of queued values that triggers an immediate commit in a worker
+        @param factory: a ZmqFactory, a new one is created when not specified
+        '''
+        self.log = log
+        self.callback = callback
+        self.ring = HashRing(range(count))
+        self.dispatched = [0] * count
+        self.worker_stats = [{} for i in range(count)]
+        self._running = set(range(count))
+        self._stopped = []
+
+        results_endpoint = 'tcp://127.0.0.1:%d' % port
+        jobs_endpoints = ['tcp://127.0.0.1:%d' % (port + 1 + index) for index in range(count)]
+
+        # The workers only use their own zmq context, nothing of the reactor is used in the child processes
+        self.processes = []
+        for index in range(count):
+            process = multiprocessing.Process(target=run_worker, name='houseagent-worker-%d' % index,
+                                              args=(index, jobs_endpoints[index], results_endpoint,
+                                                    db_location, interval, batch_size))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        factory = factory or ZmqFactory()
+        self.results = ResultConnection(factory, self, ZmqEndpoint(ZmqEndpointType.bind, results_endpoint))
+        self.connections = [WorkerConnection(factory, ZmqEndpoint(ZmqEndpointType.bind, endpoint))
+                            for endpoint in jobs_endpoints]
+
+        self.log.info("Started %d worker processes", count)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def dispatch(self, plugin, type, payload):
+        '''
+        Hand a value update to the worker of a plugin.
+        @param plugin: the Plugin that sent the update
+        @param type: the message type, \\x03 for a single update or \\x08 for a batch
+        @param payload: the payload, the encoded update optionally followed by the name of the encoding
+
+        @return: the number of the worker the update was sent to
+        '''
+        if len(payload) > 1:
+            encoding = payload[1]
+        else:
+            encoding = 'json'
+
+        index = self.ring.node(plugin.guid)
+        self.connections[index].send([type, str(plugin.id), encoding, payload[0]])
+        self.dispatched[index] += 1
+        return index
+
+    def handle_result(self, msg):
+        '''
+        Handle a report of a worker process.
+        @param msg: the report
+        '''
+        if msg[0] == STOP:
+            self._running.discard(int(msg[1]))
+            if not self._running:
+                self._fire_stopped()
+            return
+
+        result = json.loads(msg[1])
+        values = result.pop('values')
+        self.worker_stats[result.pop('worker')] = result
+
+        for value_id, value in values:
+            self.callback(value_id, value)
+
+    def stop(self):
+        '''
+        Let the workers commit what they have queued and stop.
+
+        @return: a Twisted deferred which fires when all workers stopped, or after 10 seconds.
+        '''
+        d = defer.Deferred()
+        self._stopped.append(d)
+
+        for connection in self.connections:
+            connection.send([STOP])
+
+        reactor.callLater(10, self._fire_stopped)
+        return d
+
+    def _fire_stopped(self):
+        waiting, self._stopped = self._stopped, []
+        for d in waiting:
+            d.callback(None)
+
+    def stats(self):
+        '''
+        Returns a dictionary with per worker statistics.
+        '''
+        return {'workers': len(self.connections),
+                'alive': sum(1 for process in self.processes if process.is_alive()),
+                'dispatched': list(self.dispatched),
+                'reported': list(self.worker_stats)}
@@ -0,0 +1,144 @@
+'''
+Buffering of value updates while the broker is unavailable.
+'''
+import os
+import json
+from collections import deque
+
+class OfflineBuffer(object):
+    '''
+    Bounded buffer for value updates that can't be sent while the broker is unavailable.
+    
+    Updates are kept in memory up to a maximum, further updates go to an optional 
+    append-only file, one JSON update per line. Updates left in the file by a previous
+    run are replayed as well. Without a file the oldest updates are dropped when the 
+    memory is full, with a file the newest updates are dropped when the file is full.
+    '''
+    
+    def __init__(self, size, path=None, max_file_size=64 * 1024 * 1024):
+        '''
+        Initialize a new OfflineBuffer instance.
+        
+        @param size: the maximum number of updates kept in memory
+        @param path: the path of the file used when the memory is full, None to only use memory
+        @param max_file_size: the maximum size of the file in bytes
+        '''
+        self.size = size
+        self.path = path
+        self.max_file_size = max_file_size
+        
+        self._memory = deque()
+        self._file = None
+        self._offset = 0
+        self._spilled = 0
+        
+        self.buffered = 0
+        self.replayed = 0
+        self.dropped = 0
+        
+        # Pick up updates left behind by a previous run, without a partly written last update
+        if path and os.path.exists(path):
+            updates, offset = self._read(0, None)
+            self._spilled = len(updates)
+            if offset < os.path.getsize(path):
+                f = open(path, 'r+b')
+                f.truncate(offset)
+                f.close()
+    
+    def __len__(self):
+        return len(self._memory) + self._spilled
+    
+    def append(self, update):
+        '''
+        Buffer a value update.
+        @param update: an (address, values, time) tuple
+        '''
+        self.buffered += 1
+        
+        # Once updates went to the file everything goes there, until it has been replayed
+        if not self._spilled and len(self._memory) < self.size:
+            self._memory.append(update)
+        elif self.path:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+                # Append mode only moves to the end of the file on the first write
+                self._file.seek(0, os.SEEK_END)
+            
+            if self._file.tell() < self.max_file_size:
+                self._file.write(json.dumps(update) + '\n')
+                self._file.flush()
+                self._spilled += 1
+            else:
+                self.dropped += 1
+        else:
+            self._memory.popleft()
+            self._memory.append(update)
+            self.dropped += 1
+    
+    def take(self, count):
+        '''
+        Remove the oldest buffered value updates from the buffer.
+        @param count: the maximum number of updates to return
+        
+        @return: a list of (address, values, time) tuples, in the order they were buffered
+        '''
+        updates = []
+        while self._memory and len(updates) < count:
+            updates.append(self._memory.popleft())
+        
+        if self._spilled and len(updates) < count:
+            if self._file is not None:
+                self._file.flush()
+            
+            spilled, self._offset = self._read(self._offset, count - len(updates))
+            updates.extend(spilled)
+            self._spilled -= len(spilled)
+            
+            # Start over with an empty file when everything has been read, or the rest is unreadable
+            if not self._spilled or not spilled:
+                self._remove_file()
+        
+        self.replayed += len(updates)
+        return updates
+    
+    def _read(self, offset, count):
+        '''
+        Read updates from the file, stops at a partly written last update.
+        @return: a tuple (updates, offset after the last update read)
+        '''
+        updates = []
+        f = open(self.path, 'rb')
+        try:
+            f.seek(offset)
+            while count is None or len(updates) < count:
+                line = f.readline()
+                try:
+                    address, values, timestamp = json.loads(line)
+                except ValueError:
+                    break
+                updates.append((address, values, timestamp))
+                offset = f.tell()
+        finally:
+            f.close()
+        
+        return updates, offset
+    
+    def _remove_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._offset = 0
+        self._spilled = 0
+    
+    def stats(self):
+        '''
+        Returns a dictionary with offline buffer statistics.
+        '''
+        return {'memory': len(self._memory),
+                'file': self._spilled,
+                'buffered': self.buffered,
+                'replayed': self.replayed,
+                'dropped': self.dropped}
@@ -2,8 +2,13 @@ import os
 import logging 
 import logging.handlers
 import sys
+import atexit
+import threading
+import Queue
 import json
 import time
+import uuid
+from collections import deque
 from houseagent.utils.config import Config
 if os.name == "nt":
     import win32serviceutil
@@ -17,9 +22,28 @@ if os.name == "nt":
         pass        
 #from twisted.python import log as twisted_log
 from twisted.internet import reactor, task, defer
+from twisted.python.failure import Failure
 from txzmq import ZmqFactory, ZmqEndpoint, ZmqConnection, ZmqEndpointType
 from zmq.core import constants
 from houseagent import config_file
+from houseagent.utils.transport import crud_endpoint
+from houseagent.utils.encoding import supported_encodings, encode_value_update, encode_value_updates
+from houseagent.plugins.offline import OfflineBuffer
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+# Built-in commands, type -> (message fields passed to the callback, optional fields passed when present)
+COMMANDS = {'custom': (('action', 'parameters'), ()),
+            'poweron': (('address',), ('value_id',)),
+            'poweroff': (('address',), ('value_id',)),
+            'dim': (('address', 'level'), ('value_id',)),
+            'thermostat_setpoint': (('address', 'temperature'), ('value_id',))}
+
+# Buffered value updates sent per reactor iteration when replaying the offline buffer
+REPLAY_CHUNK = 100
 
 class PluginConnection(ZmqConnection):        
     '''
@@ -44,26 +68,40 @@ class PluginConnection(ZmqConnection):
         Send a message to the broker.
         
         @param message_parts: the message parts to send. 
+        
+        @return: a Twisted deferred which fires once the message has been handed to ZeroMQ
         '''
-        d = defer.Deferred()
         message = ['']
         message.extend(message_parts)
         self.send(message)
-        return d
+        self.pluginapi.last_sent = time.time()
+        return defer.succeed(None)
     
     def messageReceived(self, msg):
         '''
         Function called when a message has been received.
         @param msg: the message that has been received
         '''     
+        # Any message shows the broker is still there
+        self.pluginapi.broker_seen()
+        
         if msg[1] == '\x01':
-            # Handle ready request
+            # Handle ready request, the broker doesn't know about us (anymore)
+            self.pluginapi.broker_lost()
             if self.pluginapi.isready:
                 self.pluginapi.ready()
         
         elif msg[1] == '\x04':
             # Handle RPC reply
             self.pluginapi.handle_rpc_message(msg[2], msg[3])
+
+        elif msg[1] == '\x09':
+            # Handle acknowledgement of value updates
+            self.pluginapi.handle_ack(int(msg[2]))
+
+        elif msg[1] == '\x07':
+            # Handle ready acknowledgement, contains the settings negotiated with the broker
+            self.pluginapi.handle_ready_ack(json.loads(msg[2]))
             
         elif msg[1] == '\x06':
 
@@ -72,12 +110,111 @@ class PluginConnection(ZmqConnection):
                 message = json.loads(msg[2])
                 self.pluginapi.crud_callback(message['type'], message['action'], message['parameters'])
 
+class CrudSubscriber(ZmqConnection):
+    '''
+    Class that receives the CRUD notifications published by the broker.
+    '''
+    socketType = constants.SUB
+
+    def __init__(self, factory, pluginapi, *endpoints):
+        '''
+        Initialize a new CrudSubscriber instance.
+        
+        @param factory: an instance of ZmqFactory
+        @param pluginapi: an instance of PluginAPI
+        '''
+        ZmqConnection.__init__(self, factory, *endpoints)
+        self.pluginapi = pluginapi
+
+    def subscribe(self, type):
+        '''
+        Subscribe to CRUD notifications of a type, an empty type subscribes to everything.
+        @param type: the CRUD type, for example device or location
+        '''
+        self.socket.setsockopt(constants.SUBSCRIBE, type)
+
+    def messageReceived(self, msg):
+        '''
+        Function called when a CRUD notification has been received.
+        @param msg: the topic and the notification
+        '''
+        message = json.loads(msg[1])
+        self.pluginapi.crud_callback(message['type'], message['action'], message['parameters'])
+
+class CallbackProfiler(object):
+    '''
+    Keeps timings of the command callbacks of a plugin, per command type.
+    The synchronous time is the time a callback blocks the reactor before it returns
+    its deferred, the wall time runs until the deferred fires.
+    '''
+    
+    def __init__(self):
+        # type -> counters, see summary()
+        self._stats = {}
+        self.started = time.time()
+    
+    def wrap(self, type, callback):
+        '''
+        Returns a callback that profiles the calls to a callback.
+        @param type: the command type the callback handles
+        @param callback: the callback, it returns a Twisted deferred
+        '''
+        stats = self._stats.setdefault(type, {'calls': 0, 'errors': 0, 'pending': 0, 
+                                              'sync_total': 0.0, 'sync_max': 0.0, 
+                                              'wall_total': 0.0, 'wall_max': 0.0})
+        
+        def profiled(*args, **kwargs):
+            stats['calls'] += 1
+            started = time.time()
+            
+            # Exceptions raised right away fail the deferred, so every call is settled in done()
+            d = defer.maybeDeferred(callback, *args, **kwargs)
+            
+            elapsed = time.time() - started
+            stats['sync_total'] += elapsed
+            stats['sync_max'] = max(stats['sync_max'], elapsed)
+            stats['pending'] += 1
+            
+            def done(result):
+                elapsed = time.time() - started
+                stats['pending'] -= 1
+                stats['wall_total'] += elapsed
+                stats['wall_max'] = max(stats['wall_max'], elapsed)
+                if isinstance(result, Failure):
+                    stats['errors'] += 1
+                return result
+            
+            return d.addBoth(done)
+        
+        return profiled
+    
+    def summary(self):
+        '''
+        Returns a dictionary with the counters and timings in seconds of every command type.
+        '''
+        summary = {}
+        for type, stats in self._stats.iteritems():
+            calls = stats['calls']
+            done = calls - stats['pending']
+            summary[type] = {'calls': calls,
+                             'errors': stats['errors'],
+                             'pending': stats['pending'],
+                             'sync': {'avg': stats['sync_total'] / calls if calls else 0.0, 
+                                      'max': stats['sync_max']},
+                             'wall': {'avg': stats['wall_total'] / done if done else 0.0, 
+                                      'max': stats['wall_max']}}
+        
+        return {'since': self.started, 'commands': summary}
+
 class PluginAPI(object):
     '''
     This is the PluginAPI for HouseAgent.
     ''' 
     
-    def __init__(self, guid, plugintype=None, broker_host='127.0.0.1', broker_port='13001', **callbacks):
+    def __init__(self, guid, plugintype=None, broker_host='127.0.0.1', broker_port='13001', encodings=None, 
+                 crud_types=None, batch_size=0, batch_delay=0.5, offline_buffer=0, offline_path=None, 
+                 offline_misses=2, acks=False, ack_window=1000, endpoint=None, factory=None, heartbeat_interval=30,
+                 profile=False, log=None, **callbacks):
         '''
         Initialize a new PluginAPI instance.
         
@@ -85,48 +222,132 @@ class PluginAPI(object):
         @param plugintype: the type of the plugin
         @param broker_host: the broker host
         @param broker_port: the broker port
+        @param encodings: value update encodings offered to the broker, defaults to all supported encodings
+        @param crud_types: the CRUD types to receive with the crud callback, defaults to all types
+        @param batch_size: buffer value updates until this many devices have updates, 0 sends every update right away
+        @param batch_delay: the maximum time in seconds a value update is buffered
+        @param offline_buffer: keep this many value updates in memory while the broker is unavailable,
+                               0 sends value updates regardless. Requires a broker that acknowledges ready messages.
+        @param offline_path: a file for the value updates that don't fit in memory, None to only use memory
+        @param offline_misses: the number of unanswered heartbeats after which the broker is unavailable
+        @param acks: acknowledged delivery, value updates are retransmitted until the broker acknowledges
+                     it committed them. Implies an offline buffer, of 10000 updates when offline_buffer is 0.
+        @param ack_window: the maximum number of unacknowledged messages, further updates wait in the offline buffer
+        @param endpoint: the broker endpoint, for example ipc:///tmp/houseagent, instead of broker_host and broker_port
+        @param factory: the ZmqFactory to use, plugins inside the HouseAgent process pass the one of the 
+                        coordinator to connect to an inproc:// endpoint
+        @param heartbeat_interval: send a heartbeat after this many seconds without traffic, the broker may 
+                                   ask for a longer interval
+        @param profile: time the command callbacks, the broker can query the timings with the profile command
+        @param log: the Logging instance of the plugin, by default messages go to the houseagent.pluginapi logger
         '''
         
-        self.factory = ZmqFactory()
+        self.log = log or logging.getLogger('houseagent.pluginapi')
+        self.factory = factory or ZmqFactory()
         self.guid = guid
         self.plugintype = plugintype
         self.isready = False
         
+        # Value updates are sent as JSON until the broker agreed on something else
+        self.encodings = encodings or supported_encodings()
+        self.encoding = 'json'
+        self.broker_batch = False
+        
+        # CRUD notifications are received on a separate subscription once the broker told us where
+        self.endpoint = endpoint or 'tcp://%s:%s' % (broker_host, broker_port)
+        self.crud_types = crud_types or ['']
+        self.crud_subscriber = None
+        
+        # Buffered value updates, address -> (values, time), the latest value of a key wins
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._batch = OrderedDict()
+        self._batch_call = None
+        self.merged = 0
+        if batch_size:
+            reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+        
+        # Acknowledged delivery, messages are numbered per session and kept until acknowledged
+        self.acks = acks
+        self.ack_window = ack_window
+        self.session = uuid.uuid4().hex if acks else None
+        self.broker_acks = False
+        self._seq = 0
+        self._unacked = OrderedDict()
+        if acks and not offline_buffer:
+            offline_buffer = 10000
+        
+        # Deferreds returned by value_update, fired once the number of delivered updates reaches theirs
+        self._accepted = 0
+        self._delivered = 0
+        self._waiting = deque()
+        
+        # Value updates are held back until the broker acknowledged our ready message, 
+        # and again when it stops answering heartbeats or asks us to announce ourselves again
+        self.offline = OfflineBuffer(offline_buffer, offline_path) if offline_buffer else None
+        if self.offline is not None:
+            # Updates left behind by a previous run are delivered before ours
+            self._accepted = len(self.offline)
+        self.offline_misses = offline_misses
+        self.broker_online = False
+        self.broker_heartbeats = False
+        self._unanswered = 0
+        self._replay_call = None
+        
         # Set-up connection
-        self.connection = PluginConnection(self.factory, self, ZmqEndpoint(ZmqEndpointType.connect, 
-                                                                     'tcp://%s:%s' % (broker_host, broker_port)))
+        self.connection = PluginConnection(self.factory, self, ZmqEndpoint(ZmqEndpointType.connect, self.endpoint))
                 
-        # Handle callbacks
-        self.custom_callback = None
-        self.poweron_callback = None
-        self.poweroff_callback = None
-        self.poweron_v2_callback = None
-        self.poweroff_v2_callback = None
-        self.dim_callback = None
-        self.thermostat_setpoint_callback = None
-        self.crud_callback = None
-        
-        self.callbacks = []
-        
-        for callback in callbacks:
-            if callback == "crud":
-                self.callbacks.append('crud')
-                self.crud_callback = callbacks[callback]
-            elif callback == 'poweron':
-                self.poweron_callback = callbacks[callback]
-            elif callback == 'poweroff':
-                self.poweroff_callback = callbacks[callback]
-            elif callback == 'custom':
-                self.custom_callback = callbacks[callback]
-            elif callback == 'thermostat_setpoint':
-                self.thermostat_setpoint_callback = callbacks[callback]
-            elif callback == 'dim':
-                self.dim_callback = callbacks[callback]
+        # Handle callbacks, every callback other than crud handles the command of the same name
+        self.crud_callback = callbacks.pop('crud', None)
+        self.callbacks = ['crud'] if self.crud_callback else []
+        
+        # Command type -> (callback, fields, optional fields)
+        self.commands = {}
+        self.profiler = None
+        if profile:
+            self.profiler = CallbackProfiler()
+            self.commands['profile'] = (self.profile, (), ())
+        
+        for type, callback in callbacks.iteritems():
+            self.register_command(type, callback)
                 
-        # Start keep alive
-        l = task.LoopingCall(self.heartbeat)
-        l.start(30.0)
+        # Start keep alive, brokers that take any message as a sign of life only get heartbeats when we're silent
+        self.heartbeat_interval = heartbeat_interval
+        self.broker_liveness = False
+        self.last_sent = 0
+        self.last_received = 0
+        self._last_heartbeat = 0
+        self._heartbeat_loop = None
+        self._start_heartbeat()
         
+    def register_command(self, type, callback, fields=None, optional=None):
+        '''
+        Register the callback that handles a command type.
+        The broker learns about the commands from the ready message, which is sent again when needed.
+        
+        @param type: the command type, for example dim, or a type of your own
+        @param callback: the function to call, it returns a Twisted deferred with the result
+        @param fields: the message fields passed to the callback as positional arguments, defaults to
+                       the fields of a built-in command. Other commands get all message fields as keyword arguments.
+        @param optional: message fields passed after the others when the message has them
+        '''
+        if fields is None and type in COMMANDS:
+            fields, optional = COMMANDS[type]
+        
+        if self.profiler:
+            callback = self.profiler.wrap(type, callback)
+        
+        self.commands[type] = (callback, fields, optional or ())
+        
+        if self.isready:
+            self.ready()
+
+    def profile(self):
+        '''
+        Handles the profile command, returns the timings of the command callbacks.
+        '''
+        return defer.succeed(self.profiler.summary())
+
     def handle_rpc_message(self, message_id, message):
         '''
         This handles a RPC message.
@@ -134,55 +355,39 @@ class PluginAPI(object):
         '''
 
         message = json.loads(message)  
+        command = self.commands.get(message['type'])
+        
+        if command is None:
+            self.log.warning("PluginAPI::Received unsupported command: %r", message['type'])
+            self.connection.send_msg(chr(5), message_id, json.dumps({'processed': False, 
+                                                                     'error': "Unsupported command %r" % message['type']}))
+            return
+        
+        callback, fields, optional = command
+        
+        if fields is None:
+            del message['type']
+            self.call_callback(callback, message_id, **message)
+        else:
+            args = [message[field] for field in fields]
+            args.extend(message[field] for field in optional if field in message)
+            self.call_callback(callback, message_id, *args)
 
-        if message['type'] == 'custom':
-            if self.custom_callback:
-                self.call_callback(self.custom_callback, message_id, message['action'], message['parameters'])
-
-        elif message['type'] == 'poweron':
-            if self.poweron_callback:
-                if message.has_key('value_id'):
-                    self.call_callback(self.poweron_callback, message_id, message['address'], message['value_id'])
-                else:
-                    self.call_callback(self.poweron_callback, message_id, message['address'])     
-
-        elif message['type'] == 'poweroff':
-            if self.poweroff_callback:
-                if message.has_key('value_id'):
-                    self.call_callback(self.poweroff_callback, message_id, message['address'], message['value_id'])
-                else:
-                    self.call_callback(self.poweroff_callback, message_id, message['address'])
-                
-        elif message['type'] == 'dim':
-            if self.dim_callback:
-                if message.has_key('value_id'):
-                    self.call_callback(self.dim_callback, message_id, message['address'], message['level'], message['value_id'])
-                else:
-                    self.call_callback(self.dim_callback, message_id, message['address'], message['level'])
-
-        elif message['type'] == 'thermostat_setpoint':
-            if self.thermostat_setpoint_callback:
-                if message.has_key('value_id'):
-                    self.call_callback(self.thermostat_setpoint_callback, message_id, message['address'], message['temperature'], message['value_id'])
-                else:
-                    self.call_callback(self.thermostat_setpoint_callback, message_id, message['address'], message['temperature'])
-
-    def call_callback(self, function, message_id, *args):
+    def call_callback(self, function, message_id, *args, **kwargs):
         '''
         This function calls a callback function in the plugin.
         @param function: the function to call
         @param message_id: the message id associated with the RPC request
         '''
         def cb_reply(result):
-            message = [b'', chr(5), message_id, json.dumps(result)]
-            print "Sending: %r" % (message)
-            self.connection.send(message)
+            self.connection.send_msg(chr(5), message_id, json.dumps(result))
+        
+        def cb_failed(failure):
+            self.log.error("PluginAPI::Failed to do callback, fix the plugin function: %s", failure.getErrorMessage())
+            cb_reply({'processed': False, 'error': failure.getErrorMessage()})
         
         # Do the actual callback in the plugin
-        try:
-            function(*args).addCallbacks(cb_reply, cb_reply)
-        except Exception as e:
-            print "Failed to do callback, fix the plugin function: %s" % (e)
+        defer.maybeDeferred(function, *args, **kwargs).addCallbacks(cb_reply, cb_failed)
 
     def value_update(self, address, values):
         '''
@@ -190,20 +395,253 @@ class PluginAPI(object):
         The message is published to the collector.
         @param address: the address of the device
         @param values: one or multiple values to be updated
+        
+        @return: a Twisted deferred, with acknowledged delivery it fires once the broker committed the update,
+                 otherwise right away
+        '''
+        if self.batch_size:
+            added = self._buffer(address, values, time.time())
+        else:
+            self._send_updates([(address, values, time.time())])
+            added = 1
+        
+        return self._delivery(added)
+
+    def value_update_many(self, updates):
         '''
-        content = {"address": address,
-                   "values": values, 
-                   "time": time.time(),
-                   'plugin_id': self.guid}
-    
-        self.connection.send_msg(chr(3), json.dumps(content))
+        This function is called by a plugin when values of multiple devices have been updated.
+        All updates are sent in one message, and are stored by the coordinator in one go.
+        Brokers that don't support batches get one message per device.
+        @param updates: a dictionary with device addresses as keys and dictionaries of values as values
+        
+        @return: a Twisted deferred, with acknowledged delivery it fires once the broker committed the updates,
+                 otherwise right away
+        '''
+        now = time.time()
+        
+        if self.batch_size:
+            added = sum(self._buffer(address, updates[address], now) for address in updates)
+        else:
+            self._send_updates([(address, updates[address], now) for address in updates])
+            added = len(updates)
+        
+        return self._delivery(added)
+
+    def _delivery(self, added):
+        '''
+        Returns the deferred for a value update call that added a number of updates to be sent.
+        Updates are delivered in order, the call is done once everything accepted so far has been delivered.
+        '''
+        self._accepted += added
+        
+        if not self.acks:
+            return defer.succeed(None)
+        
+        d = defer.Deferred()
+        self._waiting.append((self._accepted, d))
+        self._fire_delivered()
+        return d
+
+    def _fire_delivered(self):
+        while self._waiting and self._waiting[0][0] <= self._delivered:
+            self._waiting.popleft()[1].callback(None)
+
+    def _buffer(self, address, values, timestamp):
+        '''
+        Add a value update to the batch, merged with the buffered update of the same device.
+        
+        @return: 1 when the update has been added, 0 when it has been merged
+        '''
+        if address in self._batch:
+            merged = self._batch[address][0]
+            self.merged += len(set(merged) & set(values))
+            merged.update(values)
+            self._batch[address] = (merged, timestamp)
+            added = 0
+        else:
+            self._batch[address] = (dict(values), timestamp)
+            added = 1
+        
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._batch_call is None:
+            self._batch_call = reactor.callLater(self.batch_delay, self.flush)
+        
+        return added
+
+    def flush(self):
+        '''
+        Send the buffered value updates right away.
+        '''
+        if self._batch_call is not None:
+            if self._batch_call.active():
+                self._batch_call.cancel()
+            self._batch_call = None
+        
+        if self._batch:
+            batch, self._batch = self._batch, OrderedDict()
+            self._send_updates([(address, values, timestamp) for address, (values, timestamp) in batch.iteritems()])
+
+    def _send_updates(self, updates):
+        '''
+        Send value updates, or buffer them while the broker is unavailable.
+        Buffered updates go out first, so updates are never sent out of order.
+        @param updates: a list of (address, values, time) tuples
+        '''
+        if self.offline is not None and (not self.broker_online or len(self.offline) or self._window_full()):
+            dropped = self.offline.dropped
+            for update in updates:
+                self.offline.append(update)
+            
+            # Dropped updates will never be delivered, don't let calls wait for them
+            if self.offline.dropped != dropped:
+                self._delivered += self.offline.dropped - dropped
+                self._fire_delivered()
+        else:
+            self._transmit(updates)
+
+    def _window_full(self):
+        return self.broker_acks and len(self._unacked) >= self.ack_window
+
+    def _transmit(self, updates):
+        '''
+        Send value updates, in one message when the broker supports batches.
+        @param updates: a list of (address, values, time) tuples
+        '''
+        if self.broker_batch and len(updates) > 1:
+            self._send_message(chr(8), updates)
+        else:
+            for update in updates:
+                self._send_message(chr(3), [update])
+
+    def _send_message(self, type, updates, seq=None):
+        '''
+        Send a value update message, numbered and kept until acknowledged with acknowledged delivery.
+        @param type: the message type, a single or a batch value update
+        @param updates: a list of (address, values, time) tuples, one for a single value update
+        @param seq: the sequence number of a retransmitted message
+        '''
+        if type == chr(8):
+            content = encode_value_updates(self.encoding, updates)
+        else:
+            address, values, timestamp = updates[0]
+            content = encode_value_update(self.encoding, address, values, timestamp, self.guid)
+        
+        if self.broker_acks:
+            if seq is None:
+                self._seq += 1
+                seq = self._seq
+                self._unacked[seq] = (type, updates)
+            self.connection.send_msg(type, content, self.encoding, str(seq))
+        else:
+            self.connection.send_msg(type, content, self.encoding)
+            self._delivered += len(updates)
+            self._fire_delivered()
+
+    def handle_ack(self, seq):
+        '''
+        Handle the acknowledgement of the value update messages up to a sequence number.
+        @param seq: the sequence number, acks are cumulative
+        '''
+        while self._unacked:
+            first = next(iter(self._unacked))
+            if first > seq:
+                break
+            self._delivered += len(self._unacked.pop(first)[1])
+        
+        self._fire_delivered()
+        
+        # Updates that waited for room in the window
+        if self.offline is not None and len(self.offline) and self._replay_call is None and self.broker_online:
+            self._replay()
+
+    def _retransmit(self):
+        '''
+        Send the unacknowledged messages again after reconnecting, the broker drops the ones it already has.
+        '''
+        if self.broker_acks:
+            for seq, (type, updates) in self._unacked.items():
+                self._send_message(type, updates, seq)
+        else:
+            # The broker no longer acknowledges, sending them once more is all we can do
+            unacked, self._unacked = self._unacked, OrderedDict()
+            for type, updates in unacked.itervalues():
+                self._send_message(type, updates)
+
+    def _start_heartbeat(self):
+        '''
+        (Re)start checking for silence, a few times per heartbeat interval.
+        '''
+        if self._heartbeat_loop is not None and self._heartbeat_loop.running:
+            self._heartbeat_loop.stop()
+        
+        self._heartbeat_loop = task.LoopingCall(self.heartbeat)
+        self._heartbeat_loop.start(self.heartbeat_interval / 3.0)
 
     def heartbeat(self):
         '''
-        This function sends a keep alive (heartbeat) message to the coordinator.
+        This function sends a keep alive (heartbeat) message to the coordinator,
+        when we didn't send anything to it for a heartbeat interval.
         '''
-        if self.isready:
-            self.connection.send_msg(chr(2))
+        now = time.time()
+        if self.broker_liveness:
+            quiet = now - self.last_sent >= self.heartbeat_interval
+            
+            # With an offline buffer we also need the answers to find out whether the broker is still there,
+            # but no more than one heartbeat per interval
+            if self.offline is not None:
+                quiet = quiet or now - self.last_received >= self.heartbeat_interval
+            quiet = quiet and now - self._last_heartbeat >= self.heartbeat_interval
+        else:
+            quiet = now - self._last_heartbeat >= self.heartbeat_interval
+        
+        if self.isready and quiet:
+            self._last_heartbeat = now
+
+            if self.broker_online and self.broker_heartbeats:
+                if self._unanswered >= self.offline_misses:
+                    self.broker_lost()
+                self._unanswered += 1
+            
+            if self.broker_online or not self.broker_heartbeats:
+                self.connection.send_msg(chr(2))
+            else:
+                # A broker that only stalled never asks us to announce ourselves again
+                self.ready()
+
+    def broker_seen(self):
+        '''
+        Called for every message received from the broker.
+        '''
+        self._unanswered = 0
+        self.last_received = time.time()
+
+    def broker_lost(self):
+        '''
+        The broker is unavailable or lost track of us, buffer value updates until it acknowledges our ready message.
+        '''
+        self.broker_online = False
+        
+        if self._replay_call is not None and self._replay_call.active():
+            self._replay_call.cancel()
+        self._replay_call = None
+
+    def _replay(self):
+        '''
+        Send buffered value updates in chunks, with their original timestamps.
+        '''
+        self._replay_call = None
+        
+        if self.broker_online:
+            count = REPLAY_CHUNK
+            if self.broker_acks:
+                count = min(count, self.ack_window - len(self._unacked))
+            
+            # Without room in the window the replay continues when acks arrive
+            if count > 0:
+                self._transmit(self.offline.take(count))
+                if len(self.offline):
+                    self._replay_call = reactor.callLater(0, self._replay)
         
     def ready(self):
         '''
@@ -211,8 +649,155 @@ class PluginAPI(object):
         Send a message on the broker about our state.
         '''
         self.isready = True
-        self.connection.send_msg(chr(1), self.guid, self.plugintype, json.dumps(self.callbacks))
+        options = {'heartbeat': self.heartbeat_interval,
+                   'encodings': self.encodings,
+                   'crud_pubsub': self.crud_callback is not None,
+                   'commands': sorted(self.commands)}
+        if self.acks:
+            options['acks'] = self.session
+        self.connection.send_msg(chr(1), self.guid, self.plugintype, json.dumps(self.callbacks), json.dumps(options))
+
+    def handle_ready_ack(self, settings):
+        '''
+        Handle the acknowledgement of our ready message by the broker.
+        @param settings: a dictionary with the settings the broker agreed on
+        '''
+        self.encoding = settings.get('encoding', 'json')
+        self.broker_batch = settings.get('batch', False)
+        self.broker_heartbeats = settings.get('heartbeat_ack', False)
+        
+        self.broker_liveness = 'heartbeat' in settings
+        if settings.get('heartbeat', self.heartbeat_interval) != self.heartbeat_interval:
+            self.heartbeat_interval = settings['heartbeat']
+            self._start_heartbeat()
+        self.broker_acks = self.acks and settings.get('acks', False)
+        self.broker_online = True
+        self._unanswered = 0
+        
+        if self._unacked:
+            self._retransmit()
+        
+        if self.offline is not None and len(self.offline) and self._replay_call is None:
+            self._replay()
+        
+        if 'crud_port' in settings and not self.crud_subscriber:
+            self.crud_subscriber = CrudSubscriber(self.factory, self, ZmqEndpoint(ZmqEndpointType.connect, 
+                                                  crud_endpoint(self.endpoint, settings['crud_port'])))
+            for type in self.crud_types:
+                self.crud_subscriber.subscribe(type)
                          
+class _LogWriter(threading.Thread):
+    '''
+    Background thread that writes queued log records, so that writing and rotating
+    log files doesn't hold up the reactor.
+    '''
+    
+    def __init__(self, size):
+        threading.Thread.__init__(self, name='HouseAgent log writer')
+        self.daemon = True
+        self.queue = Queue.Queue(size)
+        self.written = 0
+        self.dropped = 0
+        
+    def put(self, handlers, record):
+        try:
+            self.queue.put_nowait((handlers, record))
+        except Queue.Full:
+            self.dropped += 1
+    
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            
+            handlers, record = item
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            self.written += 1
+    
+    def stop(self, timeout=5.0):
+        '''
+        Write the queued records and stop.
+        '''
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self.join(timeout)
+
+class _QueueHandler(logging.Handler):
+    '''
+    Handler that hands records to the log writer, which passes them on to the real handlers.
+    '''
+    
+    def __init__(self, writer, handlers):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.handlers = handlers
+        
+    def emit(self, record):
+        try:
+            # Format the message now, the arguments may have changed by the time the writer gets to it
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            
+            self.writer.put(self.handlers, record)
+        except Exception:
+            self.handleError(record)
+
+# Shared by all Logging instances: the configuration, the log writer and the names of the loggers that have handlers
+_config = None
+_writer = None
+_configured = set()
+
+def _get_config():
+    global _config
+    if _config is None:
+        _config = Config(config_file)
+    return _config
+
+def _configure(logger, name):
+    '''
+    Attach the handlers of a logger, once per logger name.
+    '''
+    global _writer
+    config = _get_config()
+    
+    log_handler = logging.handlers.RotatingFileHandler(filename = os.path.join(config.general.logpath, "%s.log" % name), maxBytes = config.general.logsize * 1024, backupCount = config.general.logcount)
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    handlers = [log_handler]
+    
+    if config.general.logconsole:
+        console_handler = logging.StreamHandler(sys.stdout) 
+        console_handler.setFormatter(logging.Formatter('%(asctime)s [%(name)s] %(levelname)s: %(message)s'))
+        handlers.append(console_handler)
+    
+    if config.general.logqueue:
+        if _writer is None:
+            _writer = _LogWriter(config.general.logqueue)
+            _writer.start()
+            atexit.register(_writer.stop)
+        logger.addHandler(_QueueHandler(_writer, handlers))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+
+def log_stats():
+    '''
+    Returns a dictionary with the counters of the log writer.
+    '''
+    if _writer is None:
+        return {'queued': 0, 'written': 0, 'dropped': 0}
+    
+    return {'queued': _writer.queue.qsize(),
+            'written': _writer.written,
+            'dropped': _writer.dropped}
+
 class Logging():
     '''
     This class provides generic logging facilities for HouseAgent plug-ins. 
@@ -222,6 +807,7 @@ class Logging():
         '''
         Using this class you can add logging to your plug-in.
         It provides a generic way of storing logging information.
+        Instances with the same name share their log file, the handlers are set up by the first one.
         
         @param name: the name of the logfile 
         @param maxkbytes: the maximum logfile size in kilobytes 
@@ -229,29 +815,30 @@ class Logging():
         @param console: specifies whether or not to log to the console, this defaults to "True"
         '''
         
-        # Get logpath
-        config = Config(config_file)
-        
         # Regular Python logging module
         self.logger = logging.getLogger(name)
-        log_handler = logging.handlers.RotatingFileHandler(filename = os.path.join(config.general.logpath, "%s.log" % name), maxBytes = config.general.logsize * 1024, backupCount = config.general.logcount)
-
-        file_formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
-        cli_formatter = logging.Formatter('%(asctime)s [%(name)s] %(levelname)s: %(message)s')
-
-        log_handler.setFormatter(file_formatter)
-        
-        if config.general.logconsole:
-            console_handler = logging.StreamHandler(sys.stdout) 
-            console_handler.setFormatter(cli_formatter)
         
-        self.logger.addHandler(log_handler)
-        self.logger.addHandler(console_handler)
-        self.set_level(config.general.loglevel)
+        if name not in _configured:
+            _configured.add(name)
+            _configure(self.logger, name)
+            self.set_level(_get_config().general.loglevel)
+
+    def stats(self):
+        '''
+        Returns a dictionary with the counters of the log writer, shared by all loggers.
+        '''
+        return log_stats()
 
     # reuse of Logging.log function
-    def log(self, message, logLevel):
-        self.logger.log(logLevel, message)
+    def log(self, message, logLevel, *args):
+        self.logger.log(logLevel, message, *args)
+        
+    def debug_enabled(self):
+        '''
+        Returns True when debug messages are logged.
+        Use this to skip work that is only needed for debug messages.
+        '''
+        return self.logger.isEnabledFor(logging.DEBUG)
         
     def set_level(self, level):        
         '''
@@ -272,45 +859,45 @@ class Logging():
         elif level == 'none':
             self.logger.setLevel(logging.NOTSET)
             
-    def error(self, message):
+    def error(self, message, *args):
         '''
         This function allows you to log a plugin error message.
-        @param message: the message to log.
+        @param message: the message to log, formatted with args only when it is actually logged.
         '''
         #twisted_log.msg(message, logLevel=logging.ERROR)
-        self.log(message, logLevel=logging.ERROR)
+        self.log(message, logging.ERROR, *args)
         
-    def warning(self, message):
+    def warning(self, message, *args):
         '''
         This function allows you to log a plugin warning message.
-        @param message: the message to log.
+        @param message: the message to log, formatted with args only when it is actually logged.
         '''
         #twisted_log.msg(message, logLevel=logging.WARNING)
-        self.log(message, logLevel=logging.WARNING)
+        self.log(message, logging.WARNING, *args)
 
-    def info(self, message):
+    def info(self, message, *args):
         '''
         This function allows you to log a plugin info message.
-        @param message: the message to log.
+        @param message: the message to log, formatted with args only when it is actually logged.
         '''
         #twisted_log.msg(message, logLevel=logging.INFO)
-        self.log(message, logLevel=logging.INFO)
+        self.log(message, logging.INFO, *args)
     
-    def debug(self, message):
+    def debug(self, message, *args):
         '''
         This function allows you to log a plugin debug message.
-        @param message: the message to log.
+        @param message: the message to log, formatted with args only when it is actually logged.
         '''        
         #twisted_log.msg(message, logLevel=logging.DEBUG)
-        self.log(message, logLevel=logging.DEBUG)
+        self.log(message, logging.DEBUG, *args)
 
-    def critical(self, message):
+    def critical(self, message, *args):
         '''
         This function allows you to log a plugin critical message.
-        @param message: the message to log.
+        @param message: the message to log, formatted with args only when it is actually logged.
         '''        
         #twisted_log.msg(message, logLevel=logging.CRITICAL)
-        self.log(message, logLevel=logging.CRITICAL)
+        self.log(message, logging.CRITICAL, *args)
 
 if os.name == "nt":        
     class WindowsService(win32serviceutil.ServiceFramework):
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from houseagent.plugins.offline import OfflineBuffer
+
+
+def update(index):
+    return (u'dev%d' % index, {u'Value': unicode(index)}, 1000.0 + index)
+
+
+class OfflineBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'offline')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memoryOnly(self):
+        buffer = OfflineBuffer(3)
+        for index in range(5):
+            buffer.append(update(index))
+
+        # Without a file the oldest updates are dropped
+        self.assertEquals(len(buffer), 3)
+        self.assertEquals(buffer.dropped, 2)
+        self.assertEquals(buffer.take(10), [update(2), update(3), update(4)])
+        self.assertEquals(len(buffer), 0)
+
+    def test_spillToFile(self):
+        buffer = OfflineBuffer(2, self.path)
+        for index in range(5):
+            buffer.append(update(index))
+
+        self.assertEquals(len(buffer), 5)
+        self.assertEquals(buffer.stats()['memory'], 2)
+        self.assertEquals(buffer.stats()['file'], 3)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_takeInOrder(self):
+        buffer = OfflineBuffer(2, self.path)
+        for index in range(6):
+            buffer.append(update(index))
+
+        # Chunks cross from memory into the file
+        self.assertEquals(buffer.take(3), [update(0), update(1), update(2)])
+
+        # Memory has room again, but updates keep going to the file until it has been replayed
+        buffer.append(update(6))
+        self.assertEquals(buffer.stats()['memory'], 0)
+
+        self.assertEquals(buffer.take(2), [update(3), update(4)])
+        self.assertEquals(buffer.take(10), [update(5), update(6)])
+        self.assertEquals(len(buffer), 0)
+        self.assertFalse(os.path.exists(self.path))
+
+        # With the file gone memory is used first again
+        buffer.append(update(7))
+        self.assertEquals(buffer.stats()['memory'], 1)
+        self.assertEquals(buffer.take(10), [update(7)])
+
+    def test_restartTruncatedLine(self):
+        buffer = OfflineBuffer(0, self.path)
+        for index in range(3):
+            buffer.append(update(index))
+        buffer._file.close()
+
+        # A crash while writing leaves a partly written last update
+        f = open(self.path, 'ab')
+        f.write('["dev3", {"Val')
+        f.close()
+        complete = os.path.getsize(self.path) - len('["dev3", {"Val')
+
+        buffer = OfflineBuffer(10, self.path)
+        self.assertEquals(len(buffer), 3)
+        self.assertEquals(os.path.getsize(self.path), complete)
+
+        # New updates are appended behind the ones of the previous run
+        buffer.append(update(4))
+        self.assertEquals(buffer.take(10), [update(0), update(1), update(2), update(4)])
+
+    def test_maxFileSize(self):
+        buffer = OfflineBuffer(0, self.path, max_file_size=1)
+        buffer.append(update(0))
+        buffer.append(update(1))
+
+        # The file is full after the first update, the newest updates are dropped
+        self.assertEquals(len(buffer), 1)
+        self.assertEquals(buffer.dropped, 1)
+        self.assertEquals(buffer.take(10), [update(0)])
+
+    def test_maxFileSizeAfterRestart(self):
+        buffer = OfflineBuffer(0, self.path)
+        buffer.append(update(0))
+        buffer._file.close()
+        size = os.path.getsize(self.path)
+
+        # The size of a file left by a previous run counts from the first append
+        buffer = OfflineBuffer(0, self.path, max_file_size=size)
+        buffer.append(update(1))
+        self.assertEquals(len(buffer), 1)
+        self.assertEquals(buffer.dropped, 1)
@@ -7,7 +7,7 @@ def _getOpt(get, section, option, default = None):
     res = default
     try:
         res = get(section, option)
-    except ConfigParser.NoOptionError:
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
         if res == None:
             raise error.ConfigError, ("[%s]::%s" % (section,option))
 
@@ -44,6 +44,10 @@ class Config:
         self.webserver = _ConfigWebserver(parser)
         self.zmq = _ConfigZMQ(parser)
         self.embedded = _ConfigEmbedded(parser)
+        self.ingestion = _ConfigIngestion(parser)
+        self.workers = _ConfigWorkers(parser)
+        self.filter = _ConfigFilter(parser)
+        self.journal = _ConfigJournal(parser)
 
 class _ConfigGeneral:
 
@@ -83,6 +87,10 @@ class _ConfigGeneral:
                 parser.getint, "general", "logcount", 5)
         self.logconsole = _getOpt(
                 parser.getboolean, "general", "logconsole", True)
+        self.logqueue = _getOpt(
+                parser.getint, "general", "logqueue", 10000)
+        self.tracesample = _getOpt(
+                parser.getint, "general", "tracesample", 1)
         self.runasservice = _getOpt(
                 parser.getboolean, "general", "runasservice", False)
         
@@ -144,6 +152,16 @@ class _ConfigZMQ:
                 parser.get, "zmq", "broker_host", "*")
         self.broker_port = _getOpt(
                 parser.getint, "zmq", "broker_port", 13001)
+        self.rpc_timeout = _getOpt(
+                parser.getint, "zmq", "rpc_timeout", 30)
+        self.heartbeat_interval = _getOpt(
+                parser.getint, "zmq", "heartbeat_interval", 30)
+        self.heartbeat_misses = _getOpt(
+                parser.getint, "zmq", "heartbeat_misses", 3)
+        self.crud_port = _getOpt(
+                parser.getint, "zmq", "crud_port", self.broker_port + 1)
+        self.endpoints = _getListOpt(
+                parser.get, "zmq", "endpoints", ",", "")
         
 class _ConfigEmbedded:
     
@@ -152,3 +170,45 @@ class _ConfigEmbedded:
                 parser.getboolean, "embedded", "enabled", False)
         self.db_save_interval = _getOpt(
                 parser.getint, "embedded", "dbsaveinterval", 0)
+
+class _ConfigIngestion:
+    
+    def __init__(self, parser):
+        self.interval = _getOpt(
+                parser.getfloat, "ingestion", "interval", 0.5)
+        self.batch_size = _getOpt(
+                parser.getint, "ingestion", "batchsize", 500)
+
+class _ConfigWorkers:
+
+    def __init__(self, parser):
+        self.count = _getOpt(
+                parser.getint, "workers", "count", 0)
+        self.port = _getOpt(
+                parser.getint, "workers", "port", 13010)
+
+class _ConfigFilter:
+
+    def __init__(self, parser):
+        self.enabled = _getOpt(
+                parser.getboolean, "filter", "enabled", False)
+        self.deadband = _getOpt(
+                parser.getfloat, "filter", "deadband", 0.0)
+        self.deadband_type = _getOpt(
+                parser.get, "filter", "deadbandtype", "absolute")
+        self.max_silence = _getOpt(
+                parser.getint, "filter", "maxsilence", 300)
+
+class _ConfigJournal:
+
+    def __init__(self, parser):
+        self.enabled = _getOpt(
+                parser.getboolean, "journal", "enabled", False)
+        self.path = _getOpt(
+                parser.get, "journal", "path", "")
+        self.segment_size = _getOpt(
+                parser.getint, "journal", "segmentsize", 16)
+        self.retain = _getOpt(
+                parser.getboolean, "journal", "retain", False)
+        self.sync = _getOpt(
+                parser.getboolean, "journal", "sync", False)
@@ -0,0 +1,121 @@
+'''
+Encodings for value updates sent from plugins to the broker.
+
+JSON is always available and is the fallback. When msgpack is installed
+plugins and broker can agree on the more compact msgpack encoding, see
+PluginAPI.ready() and Coordinator.handle_plugin_ready().
+'''
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def supported_encodings():
+    '''
+    Returns the encodings available in this installation, in order of preference.
+    '''
+    if msgpack:
+        return ['msgpack', 'json']
+    else:
+        return ['json']
+
+def select_encoding(offered):
+    '''
+    Select the preferred encoding out of the encodings offered by a plugin.
+    @param offered: a list of encoding names
+    
+    @return: the name of the encoding to use
+    '''
+    for encoding in supported_encodings():
+        if encoding in offered:
+            return encoding
+    
+    return 'json'
+
+def encode_value_update(encoding, address, values, time, guid=None):
+    '''
+    Encode a value update.
+    @param encoding: the name of the encoding
+    @param address: the address of the device
+    @param values: a dictionary with value names and values
+    @param time: the time of the update
+    @param guid: the guid of the plugin, only part of the JSON encoding for backwards compatibility
+    
+    @return: the encoded update
+    '''
+    if encoding == 'msgpack':
+        # The broker knows the plugin from the routing information, there's no need to send the guid
+        return msgpack.packb([address, values, time])
+    else:
+        return json.dumps({"address": address,
+                           "values": values, 
+                           "time": time,
+                           'plugin_id': guid})
+
+def _check_value_update(address, values, time):
+    if not isinstance(values, dict):
+        raise ValueError("Values of %r are not a dictionary" % (address,))
+    
+    return address, values, time
+
+def decode_value_update(encoding, data):
+    '''
+    Decode a value update.
+    @param encoding: the name of the encoding
+    @param data: the encoded update
+    
+    @return: a tuple (address, values, time), raises ValueError for an unsupported encoding or a malformed update
+    '''
+    try:
+        if encoding == 'msgpack' and msgpack:
+            address, values, time = msgpack.unpackb(data)
+        elif encoding == 'json':
+            message = json.loads(data)
+            address, values, time = message["address"], message["values"], message["time"]
+        else:
+            raise ValueError("Unsupported encoding %r" % encoding)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError("Malformed value update: %s" % e)
+    
+    return _check_value_update(address, values, time)
+
+def encode_value_updates(encoding, updates):
+    '''
+    Encode a batch of value updates for several devices.
+    @param encoding: the name of the encoding
+    @param updates: a list of (address, values, time) tuples
+    
+    @return: the encoded batch
+    '''
+    updates = [[address, values, time] for address, values, time in updates]
+    
+    if encoding == 'msgpack':
+        return msgpack.packb(updates)
+    else:
+        return json.dumps(updates)
+
+def decode_value_updates(encoding, data):
+    '''
+    Decode a batch of value updates.
+    @param encoding: the name of the encoding
+    @param data: the encoded batch
+    
+    @return: a list of (address, values, time) tuples, raises ValueError for an unsupported encoding or a malformed batch
+    '''
+    try:
+        if encoding == 'msgpack' and msgpack:
+            updates = msgpack.unpackb(data)
+        elif encoding == 'json':
+            updates = json.loads(data)
+        else:
+            raise ValueError("Unsupported encoding %r" % encoding)
+        
+        return [_check_value_update(address, values, time) for address, values, time in updates]
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError("Malformed value update batch: %s" % e)
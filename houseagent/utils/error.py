@@ -30,4 +30,52 @@ class ConfigFileNotFound(Error):
 
     def __repr__(self):
         return("<Configuration file not found in any of the following known locations: \"%s\">"\
-                % (self.identifier))   
\ No newline at end of file
+                % (self.identifier))
+
+class RPCTimeoutError(Error):
+    '''
+    A plugin did not reply to a RPC request in time.
+    '''
+    def __init__(self, identifier):
+        Error.__init__(self)
+        self.identifier = identifier
+
+    def __repr__(self):
+        return("<RPC request \"%s\" timed out>"\
+                % (self.identifier))
+
+class PluginOfflineError(Error):
+    '''
+    A RPC request could not be completed because the plugin is offline.
+    '''
+    def __init__(self, identifier):
+        Error.__init__(self)
+        self.identifier = identifier
+
+    def __repr__(self):
+        return("<Plugin offline, RPC request \"%s\" not completed>"\
+                % (self.identifier))
+
+class UnsupportedCommandError(Error):
+    '''
+    A RPC request was not sent because the plugin doesn't support the command.
+    '''
+    def __init__(self, identifier):
+        Error.__init__(self)
+        self.identifier = identifier
+
+    def __repr__(self):
+        return("<Command \"%s\" not supported by the plugin>"\
+                % (self.identifier))
+
+class PluginNotFoundError(Error):
+    '''
+    A RPC request was not sent because the plugin is unknown.
+    '''
+    def __init__(self, identifier):
+        Error.__init__(self)
+        self.identifier = identifier
+
+    def __repr__(self):
+        return("<Plugin \"%s\" not found>"\
+                % (self.identifier))
@@ -0,0 +1,22 @@
+'''
+Endpoints of the broker.
+
+The broker always listens on TCP, and can listen on extra endpoints as well:
+ipc:// for plugins on the same machine, inproc:// for plugins running inside
+the HouseAgent process, which share its ZmqFactory. Every broker endpoint has
+a CRUD publisher next to it, see crud_endpoint().
+'''
+
+def crud_endpoint(endpoint, crud_port):
+    '''
+    Returns the endpoint of the CRUD publisher that belongs to a broker endpoint.
+    TCP brokers publish on the CRUD port of the same host, other brokers on the
+    broker endpoint with -crud appended.
+    @param endpoint: the broker endpoint, for example tcp://127.0.0.1:13001 or ipc:///tmp/houseagent
+    @param crud_port: the CRUD port of the broker
+    '''
+    if endpoint.startswith('tcp://'):
+        host = endpoint[len('tcp://'):].rsplit(':', 1)[0]
+        return 'tcp://%s:%s' % (host, crud_port)
+    
+    return endpoint + '-crud'
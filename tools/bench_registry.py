@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''
+Benchmark of the per-frame plugin dispatch cost in the coordinator.
+
+For every broker frame the coordinator has to find the plugin the frame 
+belongs to. This script compares the old linear scan over a list of plugins
+against the PluginRegistry lookups for 10, 100 and 1000 plugins.
+
+Run from the HouseAgent source directory: python tools/bench_registry.py
+'''
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from houseagent.core.coordinator import Plugin, PluginRegistry
+
+ROUNDS = 20000
+
+def build(count):
+    '''
+    Build a plugin list and a registry holding the same online plugins.
+    '''
+    plugins = []
+    registry = PluginRegistry()
+    
+    for i in range(count):
+        p = Plugin('guid-%d' % i, i, time.time(), None)
+        p.online = True
+        p.type = 'type-%d' % (i % 10)
+        registry.add(p)
+        registry.update_routing(p, 'routing-%d' % i)
+        plugins.append(p)
+        
+    return plugins, registry
+
+def linear_dispatch(plugins, routing_info):
+    '''
+    The lookup the coordinator did before the registry existed.
+    '''
+    for plugin in plugins:
+        if plugin.routing_info == routing_info and plugin.online:
+            plugin.time = time.time()
+
+def registry_dispatch(registry, routing_info):
+    '''
+    The lookup as done by the coordinator now.
+    '''
+    plugin = registry.by_routing(routing_info)
+    if plugin and plugin.online:
+        plugin.time = time.time()
+
+def main():
+    print "%8s %16s %16s %10s" % ('plugins', 'linear [us]', 'registry [us]', 'speedup')
+    
+    for count in (10, 100, 1000):
+        plugins, registry = build(count)
+        
+        # Worst case for the linear scan: the plugin at the end of the list
+        routing_info = 'routing-%d' % (count - 1)
+
+        linear = min(timeit.repeat(lambda: linear_dispatch(plugins, routing_info), repeat=3, number=ROUNDS))
+        indexed = min(timeit.repeat(lambda: registry_dispatch(registry, routing_info), repeat=3, number=ROUNDS))
+        
+        linear_us = linear / ROUNDS * 1e6
+        indexed_us = indexed / ROUNDS * 1e6
+        print "%8d %16.3f %16.3f %9.1fx" % (count, linear_us, indexed_us, linear_us / indexed_us)
+
+if __name__ == '__main__':
+    main()
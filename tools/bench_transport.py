@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+'''
+Latency benchmark of the broker transports.
+
+Starts a coordinator on a scratch copy of the HouseAgent database, listening
+on tcp://, ipc:// and inproc:// at the same time, and connects one plugin to
+each endpoint; the inproc plugin shares the ZmqFactory of the coordinator like
+a plugin running inside the HouseAgent process would. For every transport the
+script measures, one message at a time:
+
+- value update latency, from PluginAPI.value_update until the coordinator
+  hands the update to the ingester
+- RPC round trip, from Coordinator.send_dim until the reply of the plugin
+
+Plugins and coordinator share one reactor, so the numbers include the time
+the reactor needs to pick up a message on each side.
+
+Run from the HouseAgent source directory: python tools/bench_transport.py [messages]
+'''
+import os
+import sys
+import time
+import uuid
+import shutil
+import sqlite3
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, defer
+from houseagent.core.coordinator import Coordinator
+from houseagent.core.database import Database
+from houseagent.core.stats import percentile
+from houseagent.plugins.pluginapi import PluginAPI, Logging
+
+MESSAGES = 2000
+PORT = 14201
+
+def create_database(location, names):
+    '''
+    Copy the empty HouseAgent database and register a plugin with one device per transport.
+
+    @return: a dictionary with transport names as keys and plugin guids as values
+    '''
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'houseagent.db'), location)
+
+    guids = {}
+    connection = sqlite3.connect(location)
+    for name in names:
+        guid = str(uuid.uuid4())
+        cursor = connection.execute("INSERT INTO plugins (name, authcode, location_id) VALUES (?, ?, NULL)",
+                                    ('bench-%s' % name, guid))
+        connection.execute("INSERT INTO devices (name, address, plugin_id) VALUES (?, ?, ?)",
+                           ('device', 'dev0', cursor.lastrowid))
+        guids[name] = guid
+
+    connection.commit()
+    connection.close()
+    return guids
+
+class Arrivals(object):
+    '''
+    Wraps Coordinator.store_updates to find out when a value update arrived.
+    '''
+
+    def __init__(self, coordinator):
+        self.store_updates = coordinator.store_updates
+        self.waiting = None
+        coordinator.store_updates = self
+
+    def __call__(self, plugin_id, updates, cid=None):
+        self.store_updates(plugin_id, updates, cid)
+
+        if self.waiting is not None:
+            d, self.waiting = self.waiting, None
+            d.callback(time.time())
+
+    def wait(self):
+        self.waiting = defer.Deferred()
+        return self.waiting
+
+def cb_dim(address, level, value_id=None):
+    return defer.succeed({'processed': True})
+
+@defer.inlineCallbacks
+def measure(coordinator, arrivals, plugin, guid, messages):
+    updates = []
+    for index in range(messages):
+        arrived = arrivals.wait()
+        sent = time.time()
+        plugin.value_update('dev0', {'Value': str(index)})
+        updates.append((yield arrived) - sent)
+
+    rtts = []
+    for index in range(messages):
+        sent = time.time()
+        yield coordinator.send_dim(guid, 'dev0', index % 100)
+        rtts.append(time.time() - sent)
+
+    defer.returnValue((sorted(updates), sorted(rtts)))
+
+def report(name, latencies):
+    print "  %-8s p50 %7.3f  p90 %7.3f  p99 %7.3f  max %7.3f" % (name, percentile(latencies, 50) * 1000,
+                                                            percentile(latencies, 90) * 1000,
+                                                            percentile(latencies, 99) * 1000, latencies[-1] * 1000)
+
+@defer.inlineCallbacks
+def run(coordinator, plugins, guids, messages):
+    arrivals = Arrivals(coordinator)
+    results = {}
+
+    for name, plugin in plugins:
+        results[name] = yield measure(coordinator, arrivals, plugin, guids[name], messages)
+
+    print
+    print "%d messages per transport" % messages
+    print
+    print "Value update latency [ms]"
+    for name, plugin in plugins:
+        report(name, results[name][0])
+    print
+    print "RPC round trip [ms]"
+    for name, plugin in plugins:
+        report(name, results[name][1])
+
+    yield coordinator.ingester.stop()
+    reactor.stop()
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+
+    log = Logging("BenchTransport")
+    log.set_level('critical')
+
+    directory = tempfile.mkdtemp()
+    try:
+        location = os.path.join(directory, 'bench.db')
+        names = ['tcp', 'ipc', 'inproc']
+        guids = create_database(location, names)
+
+        ipc = 'ipc://%s' % os.path.join(directory, 'broker')
+        inproc = 'inproc://houseagent-bench'
+
+        coordinator = Coordinator(log, Database(log, location))
+        coordinator.init_broker('127.0.0.1', PORT, endpoints=[ipc, inproc])
+
+        plugins = [('tcp', PluginAPI(guids['tcp'], 'Bench', broker_port=PORT, log=log, dim=cb_dim)),
+                   ('ipc', PluginAPI(guids['ipc'], 'Bench', endpoint=ipc, log=log, dim=cb_dim)),
+                   ('inproc', PluginAPI(guids['inproc'], 'Bench', endpoint=inproc, factory=coordinator.factory,
+                                        log=log, dim=cb_dim))]
+
+        # Give the coordinator time to load the plugins before they announce themselves
+        reactor.callLater(1.0, lambda: [plugin.ready() for name, plugin in plugins])
+        reactor.callLater(2.0, run, coordinator, plugins, guids, messages)
+        reactor.run()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+'''
+Benchmark of the value update encodings.
+
+Compares encode and decode CPU time and the number of bytes per update of
+the available encodings (JSON, and msgpack when it is installed).
+
+Run from the HouseAgent source directory: python tools/bench_wire.py
+'''
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from houseagent.utils.encoding import supported_encodings, encode_value_update, decode_value_update
+
+ROUNDS = 50000
+GUID = '8b8b8b8b-4c4c-4d4d-9e9e-0f0f0f0f0f0f'
+
+# A few typical updates, from a single temperature to a multi-sensor device
+UPDATES = [('0x1a2b', {'Temperature': '21.5'}),
+           ('living/01', {'Temperature': '21.5', 'Humidity': '45', 'Battery': 'OK'}),
+           ('meter1', {'Power': '1234', 'Energy low': '8123.12', 'Energy high': '7001.55', 
+                       'Gas': '4310.001', 'Tariff': '2'})]
+
+def main():
+    print "%-10s %-8s %12s %12s %8s" % ('encoding', 'values', 'encode [us]', 'decode [us]', 'bytes')
+    
+    for address, values in UPDATES:
+        for encoding in supported_encodings():
+            now = time.time()
+            data = encode_value_update(encoding, address, values, now, GUID)
+
+            encode = min(timeit.repeat(lambda: encode_value_update(encoding, address, values, now, GUID), repeat=3, number=ROUNDS))
+            decode = min(timeit.repeat(lambda: decode_value_update(encoding, data), repeat=3, number=ROUNDS))
+            
+            # The encoding name travels with each update as a separate frame
+            size = len(data) + len(encoding)
+            
+            print "%-10s %-8d %12.3f %12.3f %8d" % (encoding, len(values), encode / ROUNDS * 1e6, 
+                                                    decode / ROUNDS * 1e6, size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+'''
+Throughput benchmark of the value update worker processes.
+
+Starts 1 up to N worker processes on a scratch database, pushes value updates
+of a number of simulated plugins to them, routed by consistent hash of the
+plugin GUID like the coordinator does, and measures the time until all
+updates have been committed.
+
+All workers write to the same SQLite database, so the database write is
+serialized; the scaling shows how much of the decoding and coalescing work
+moves off a single core.
+
+Run from the HouseAgent source directory: python tools/bench_workers.py [max workers]
+'''
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import multiprocessing
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from houseagent.core.workers import HashRing, run_worker, STOP
+from houseagent.utils.encoding import supported_encodings, encode_value_update
+
+PLUGINS = 16
+DEVICES = 50
+UPDATES = 100000
+PORT = 15010
+
+def create_database(location):
+    connection = sqlite3.connect(location)
+    connection.execute("CREATE TABLE devices(id INTEGER PRIMARY KEY, name VARCHAR(45), address VARCHAR(45) NOT NULL, plugin_id INTEGER, location_id INTEGER)")
+    connection.execute("CREATE TABLE current_values(id integer PRIMARY KEY AUTOINCREMENT NOT NULL, name varchar(45), value varchar(45), device_id integer NOT NULL, lastupdate datetime)")
+    for plugin_id in range(1, PLUGINS + 1):
+        for device in range(DEVICES):
+            connection.execute("INSERT INTO devices (name, address, plugin_id) VALUES (?, ?, ?)",
+                               ('device', 'dev%d' % device, plugin_id))
+    connection.commit()
+    connection.close()
+
+def run(count, location, encoding, messages):
+    context = zmq.Context()
+    results = context.socket(zmq.PULL)
+    results.bind('tcp://127.0.0.1:%d' % PORT)
+
+    jobs = []
+    processes = []
+    for index in range(count):
+        endpoint = 'tcp://127.0.0.1:%d' % (PORT + 1 + index)
+        socket = context.socket(zmq.PUSH)
+        socket.bind(endpoint)
+        jobs.append(socket)
+
+        process = multiprocessing.Process(target=run_worker, args=(index, endpoint, 'tcp://127.0.0.1:%d' % PORT,
+                                                                   location, 0.5, 500))
+        process.start()
+        processes.append(process)
+
+    ring = HashRing(range(count))
+    time.sleep(0.5) # let the workers connect
+
+    start = time.time()
+    for guid, plugin_id, data in messages:
+        jobs[ring.node(guid)].send_multipart(['\x03', plugin_id, encoding, data])
+
+    for socket in jobs:
+        socket.send_multipart([STOP])
+
+    stopped = 0
+    while stopped < count:
+        if results.recv_multipart()[0] == STOP:
+            stopped += 1
+    elapsed = time.time() - start
+
+    for process in processes:
+        process.join()
+    for socket in jobs + [results]:
+        socket.close(linger=0)
+    context.term()
+
+    return elapsed
+
+def main():
+    maximum = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    encoding = supported_encodings()[0]
+
+    # Every update changes the temperature and humidity of one device
+    messages = []
+    for i in range(UPDATES):
+        plugin_id = i % PLUGINS + 1
+        address = 'dev%d' % (i / PLUGINS % DEVICES)
+        data = encode_value_update(encoding, address, {'Temperature': str(i % 300 / 10.0), 'Humidity': str(i % 100)},
+                                   time.time(), 'plugin-%d' % plugin_id)
+        messages.append(('plugin-%d' % plugin_id, str(plugin_id), data))
+
+    directory = tempfile.mkdtemp()
+    try:
+        print "%d updates of %d plugins, encoding %s" % (UPDATES, PLUGINS, encoding)
+        print "%-8s %10s %14s %8s" % ('workers', 'time [s]', 'updates/s', 'speedup')
+
+        baseline = None
+        for count in range(1, maximum + 1):
+            location = os.path.join(directory, 'bench%d.db' % count)
+            create_database(location)
+
+            elapsed = run(count, location, encoding, messages)
+            baseline = baseline or elapsed
+            print "%-8d %10.2f %14.0f %7.2fx" % (count, elapsed, UPDATES / elapsed, baseline / elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+'''
+Synthetic plugin load generator and end-to-end benchmark.
+
+Starts a coordinator on a scratch copy of the HouseAgent database and runs a
+number of simulated plugins built on the PluginAPI against it. The plugins
+send value updates at a configurable rate and distribution, and answer dim
+commands sent by the coordinator after a configurable latency.
+
+At the end the script reports:
+- ingestion throughput, value updates sent versus committed to the database
+- update-to-commit latency, as measured by the ingester
+- RPC round-trip percentiles, from Coordinator.send_dim to the reply
+- reactor lag, how late a 100 ms timer fires
+
+Plugins, coordinator and database share one reactor, just like a HouseAgent
+installation running its plugins on the same machine would share the CPU.
+
+Run from the HouseAgent source directory: python tools/loadgen.py --help
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import sqlite3
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, task, defer
+from houseagent.core.coordinator import Coordinator
+from houseagent.core.database import Database
+from houseagent.core.stats import percentile
+from houseagent.plugins.pluginapi import PluginAPI, Logging
+
+LAG_INTERVAL = 0.1
+
+def parse_options():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--plugins", type="int", default=10, help="number of simulated plugins [%default]")
+    parser.add_option("--devices", type="int", default=20, help="devices per plugin [%default]")
+    parser.add_option("--values", type="int", default=2, help="values per device update [%default]")
+    parser.add_option("--rate", type="float", default=10.0, help="value updates per second per plugin [%default]")
+    parser.add_option("--distribution", choices=['constant', 'poisson', 'burst'], default='poisson',
+                      help="spread of the updates in time: constant, poisson or burst (once per second) [%default]")
+    parser.add_option("--batch", action="store_true", default=False, help="send the updates of a burst as one batch")
+    parser.add_option("--rpc-rate", type="float", default=5.0, help="dim commands per second, in total [%default]")
+    parser.add_option("--rpc-latency", type="float", default=0.05, help="mean time a plugin takes to answer a command [%default s]")
+    parser.add_option("--duration", type="float", default=30.0, help="length of the run [%default s]")
+    parser.add_option("--port", type="int", default=14001, help="broker port [%default]")
+    parser.add_option("--workers", type="int", default=0, help="number of worker processes [%default]")
+    parser.add_option("--seed", type="int", default=None, help="random seed")
+    parser.add_option("--json", action="store_true", default=False, help="also print all coordinator statistics as JSON")
+    parser.add_option("--verbose", action="store_true", default=False, help="log coordinator warnings and errors")
+    return parser.parse_args()[0]
+
+def create_database(location, plugins, devices):
+    '''
+    Copy the empty HouseAgent database and register the simulated plugins and their devices.
+
+    @return: a list of plugin guids
+    '''
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'houseagent.db'), location)
+
+    guids = []
+    connection = sqlite3.connect(location)
+    for index in range(plugins):
+        guid = str(uuid.uuid4())
+        cursor = connection.execute("INSERT INTO plugins (name, authcode, location_id) VALUES (?, ?, NULL)",
+                                    ('loadgen-%d' % index, guid))
+        for device in range(devices):
+            connection.execute("INSERT INTO devices (name, address, plugin_id) VALUES (?, ?, ?)",
+                               ('device %d' % device, 'dev%d' % device, cursor.lastrowid))
+        guids.append(guid)
+
+    connection.commit()
+    connection.close()
+    return guids
+
+class SimulatedPlugin(object):
+    '''
+    A plugin that sends random value updates and answers dim commands.
+    '''
+
+    def __init__(self, guid, options, counters):
+        self.guid = guid
+        self.options = options
+        self.counters = counters
+        self.addresses = ['dev%d' % device for device in range(options.devices)]
+        self.api = PluginAPI(guid, 'LoadGen', broker_host='127.0.0.1', broker_port=options.port, dim=self.cb_dim)
+
+    def start(self):
+        self.api.ready()
+
+        rate = self.options.rate
+        if self.options.distribution == 'constant':
+            task.LoopingCall(self.send).start(1.0 / rate, False)
+        elif self.options.distribution == 'burst':
+            task.LoopingCall(self.send_burst).start(1.0, False)
+        else:
+            self.schedule()
+
+    def schedule(self):
+        reactor.callLater(random.expovariate(self.options.rate), self.send_and_schedule)
+
+    def send_and_schedule(self):
+        self.send()
+        self.schedule()
+
+    def values(self):
+        return dict(('Value %d' % index, '%.2f' % random.uniform(0, 100)) for index in range(self.options.values))
+
+    def send(self):
+        self.api.value_update(random.choice(self.addresses), self.values())
+        self.counters['messages'] += 1
+        self.counters['values'] += self.options.values
+
+    def send_burst(self):
+        count = int(self.options.rate)
+        if self.options.batch:
+            updates = dict((random.choice(self.addresses), self.values()) for i in range(count))
+            self.api.value_update_many(updates)
+            self.counters['messages'] += 1
+            self.counters['values'] += sum(len(values) for values in updates.itervalues())
+        else:
+            for i in range(count):
+                self.send()
+
+    def cb_dim(self, address, level, value_id=None):
+        latency = random.expovariate(1.0 / self.options.rpc_latency) if self.options.rpc_latency > 0 else 0
+        return task.deferLater(reactor, latency, lambda: {'processed': True})
+
+class LoadGenerator(object):
+
+    def __init__(self, options, coordinator, guids):
+        self.options = options
+        self.coordinator = coordinator
+        self.guids = guids
+        self.counters = {'messages': 0, 'values': 0}
+        self.plugins = [SimulatedPlugin(guid, options, self.counters) for guid in guids]
+
+        self.rtts = []
+        self.rpc_errors = 0
+        self.lags = []
+        self._expected = None
+
+    def start(self):
+        for plugin in self.plugins:
+            plugin.start()
+
+        if self.options.rpc_rate > 0:
+            task.LoopingCall(self.send_rpc).start(1.0 / self.options.rpc_rate, False)
+
+        self._expected = time.time() + LAG_INTERVAL
+        task.LoopingCall(self.measure_lag).start(LAG_INTERVAL, False)
+        self.started = time.time()
+
+    def measure_lag(self):
+        now = time.time()
+        self.lags.append(max(0.0, now - self._expected))
+        self._expected = now + LAG_INTERVAL
+
+    def send_rpc(self):
+        guid = random.choice(self.guids)
+        address = 'dev%d' % random.randrange(self.options.devices)
+        sent = time.time()
+
+        def cb_reply(result):
+            self.rtts.append(time.time() - sent)
+
+        def cb_error(failure):
+            self.rpc_errors += 1
+
+        self.coordinator.send_dim(guid, address, random.randrange(100)).addCallbacks(cb_reply, cb_error)
+
+    def report(self):
+        elapsed = time.time() - self.started
+        stats = self.coordinator.stats()
+        ingestion = stats['ingestion']
+        latency = ingestion['update_to_commit_latency']
+        rtts = sorted(self.rtts)
+        lags = sorted(self.lags)
+
+        # In worker mode the values are committed by the workers
+        committed = ingestion['committed']
+        if 'workers' in stats:
+            committed = sum(worker.get('committed', 0) for worker in stats['workers']['reported'])
+
+        print
+        print "Load: %d plugins, %d devices each, %.1f updates/s per plugin (%s), %.1f commands/s, %.0f s" % (
+              self.options.plugins, self.options.devices, self.options.rate, self.options.distribution,
+              self.options.rpc_rate, elapsed)
+        print
+        print "Ingestion"
+        print "  messages sent          %10d  %10.1f /s" % (self.counters['messages'], self.counters['messages'] / elapsed)
+        print "  values sent            %10d  %10.1f /s" % (self.counters['values'], self.counters['values'] / elapsed)
+        print "  values received        %10d" % ingestion['received']
+        print "  values coalesced       %10d" % ingestion['coalesced']
+        print "  values committed       %10d  %10.1f /s" % (committed, committed / elapsed)
+        if 'workers' not in stats:
+            print "  commits                %10d" % ingestion['commits']
+            print "  update to commit [ms]  avg %.1f  max %.1f" % (latency['avg'] * 1000, latency['max'] * 1000)
+        print
+        print "RPC round trip [ms]"
+        print "  replies %d, errors %d, coalesced %d" % (len(rtts), self.rpc_errors, stats['commands']['coalesced'])
+        if rtts:
+            print "  p50 %.1f  p90 %.1f  p99 %.1f  max %.1f" % (percentile(rtts, 50) * 1000, percentile(rtts, 90) * 1000,
+                                                             percentile(rtts, 99) * 1000, rtts[-1] * 1000)
+        print
+        print "Reactor lag [ms]"
+        if lags:
+            print "  p50 %.1f  p90 %.1f  p99 %.1f  max %.1f" % (percentile(lags, 50) * 1000, percentile(lags, 90) * 1000,
+                                                             percentile(lags, 99) * 1000, lags[-1] * 1000)
+
+        if self.options.json:
+            print
+            print json.dumps(stats, indent=2, default=str)
+
+@defer.inlineCallbacks
+def finish(generator, coordinator):
+    # Let the last updates reach the database before reporting
+    yield coordinator.ingester.stop()
+    generator.report()
+    reactor.stop()
+
+def main():
+    options = parse_options()
+    random.seed(options.seed)
+
+    log = Logging("LoadGen")
+    log.set_level('warning' if options.verbose else 'critical')
+
+    directory = tempfile.mkdtemp()
+    try:
+        location = os.path.join(directory, 'loadgen.db')
+        guids = create_database(location, options.plugins, options.devices)
+
+        coordinator = Coordinator(log, Database(log, location))
+        coordinator.init_broker('127.0.0.1', options.port)
+        if options.workers:
+            coordinator.init_workers(options.workers, location, options.port + 10)
+
+        generator = LoadGenerator(options, coordinator, guids)
+
+        # Give the coordinator time to load the plugins
+        reactor.callLater(1.0, generator.start)
+        reactor.callLater(1.0 + options.duration, finish, generator, coordinator)
+        reactor.run()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+'''
+Replay a recorded value update journal through the coordinator.
+
+Feeds the entries of a journal (see houseagent.core.journal, recorded with
+retain=True) through the filter and ingestion stages of a coordinator running
+on a scratch copy of a HouseAgent database, at the original speed, faster, or
+as fast as possible. The database has to be the one the journal was recorded
+with, or a copy of it, so that the plugins and devices in the journal exist.
+
+Run from the HouseAgent source directory:
+    python tools/replay.py --journal <journal directory> --db <houseagent.db> [--speed 10]
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, defer
+from houseagent.core.coordinator import Coordinator
+from houseagent.core.database import Database
+from houseagent.core.journal import read_journal
+from houseagent.plugins.pluginapi import Logging
+
+# Entries fed in one go when replaying as fast as possible
+CHUNK = 1000
+
+def parse_options():
+    parser = OptionParser(usage="%prog --journal DIRECTORY --db DATABASE [options]")
+    parser.add_option("--journal", help="the journal directory to replay")
+    parser.add_option("--db", help="the HouseAgent database the journal was recorded with, it is not modified")
+    parser.add_option("--speed", type="float", default=1.0,
+                      help="replay speed, 1 is the original speed, 0 as fast as possible [%default]")
+    parser.add_option("--port", type="int", default=14101, help="broker port of the scratch coordinator [%default]")
+    parser.add_option("--json", action="store_true", default=False, help="also print all coordinator statistics as JSON")
+    options = parser.parse_args()[0]
+
+    if not options.journal or not options.db:
+        parser.error("--journal and --db are required")
+
+    return options
+
+class Replayer(object):
+
+    def __init__(self, coordinator, entries, speed):
+        self.coordinator = coordinator
+        self.entries = entries
+        self.speed = speed
+        self.done = defer.Deferred()
+
+        self.count = 0
+        self.updates = 0
+        self.behind = 0.0
+        self._next = None
+        self._first = None
+
+    def start(self):
+        self.started = time.time()
+        self._next = next(self.entries, None)
+        if self._next:
+            self._first = self._next[1]
+        self.feed()
+
+    def feed(self):
+        '''
+        Feed all entries that are due, then wait for the next one.
+        '''
+        fed = 0
+        while self._next is not None:
+            seq, received, plugin_id, updates = self._next
+
+            if self.speed > 0:
+                due = self.started + (received - self._first) / self.speed
+                delay = due - time.time()
+                if delay > 0:
+                    reactor.callLater(delay, self.feed)
+                    return
+                self.behind = max(self.behind, -delay)
+            elif fed >= CHUNK:
+                # Let the reactor breathe, the ingester needs it to commit
+                reactor.callLater(0, self.feed)
+                return
+
+            self.coordinator.store_updates(plugin_id, updates)
+            self.count += 1
+            self.updates += len(updates)
+            fed += 1
+            self._next = next(self.entries, None)
+
+        self.elapsed = time.time() - self.started
+        self.done.callback(None)
+
+    def report(self, stats, as_json):
+        ingestion = stats['ingestion']
+        latency = ingestion['update_to_commit_latency']
+
+        print "Replayed %d entries, %d device updates in %.1f s (%.0f entries/s)" % (
+              self.count, self.updates, self.elapsed, self.count / self.elapsed if self.elapsed else 0)
+        if self.speed > 0:
+            print "  at most %.1f ms behind schedule" % (self.behind * 1000)
+        print "  values received %d, suppressed %d, committed %d in %d commits" % (
+              ingestion['received'], stats['filter']['suppressed'], ingestion['committed'], ingestion['commits'])
+        print "  update to commit [ms] avg %.1f max %.1f" % (latency['avg'] * 1000, latency['max'] * 1000)
+
+        if as_json:
+            print json.dumps(stats, indent=2, default=str)
+
+@defer.inlineCallbacks
+def run(replayer, coordinator, options):
+    replayer.start()
+    yield replayer.done
+    yield coordinator.ingester.stop()
+    replayer.report(coordinator.stats(), options.json)
+    reactor.stop()
+
+def main():
+    options = parse_options()
+
+    log = Logging("Replay")
+    log.set_level('warning')
+
+    directory = tempfile.mkdtemp()
+    try:
+        location = os.path.join(directory, 'replay.db')
+        shutil.copy(options.db, location)
+
+        coordinator = Coordinator(log, Database(log, location))
+        coordinator.init_broker('127.0.0.1', options.port)
+
+        replayer = Replayer(coordinator, read_journal(options.journal), options.speed)
+
+        # Give the coordinator time to load the plugins
+        reactor.callLater(1.0, run, replayer, coordinator, options)
+        reactor.run()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()